@@ -0,0 +1,333 @@
+import ast
+import inspect
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from src import condition_mapping_utils
+
+##################
+##### TABLES #####
+##################
+
+# String columns with a few dozen distinct values, held as dictionary arrays
+DICTIONARY_COLUMNS = [
+    'MODEA', 'MODEB', 'MODEC', 'Last', '2ndLast', '3rdLast', 'SYSTEM_FINALMODE', 'Origin', 'SYSTEM_District',
+    'SYSTEM_COUNTRY', 'AIRPORT_Prefix'
+]
+
+
+def read_table(path: str, columns: list[str] = None, filters=None) -> pa.Table:
+    """
+    Read a Parquet survey file as an Arrow table, with the DICTIONARY_COLUMNS read straight into dictionary arrays.
+
+    columns and filters are passed to pyarrow.parquet.read_table, e.g. filters=[('AIRPORT_Prefix', '==', 'LHR')].
+    """
+    names = pq.read_schema(path).names
+    read_dictionary = [column for column in DICTIONARY_COLUMNS if column in names and (columns is None or column in columns)]
+
+    return pq.read_table(path, columns=columns, filters=filters, read_dictionary=read_dictionary).unify_dictionaries()
+
+
+def to_table(df: pd.DataFrame, columns: list[str]) -> pa.Table:
+    # The given DataFrame columns as an Arrow table, with string columns dictionary encoded
+    table = pa.Table.from_pandas(df[columns], preserve_index=False)
+
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            table = table.set_column(i, field.name, pc.dictionary_encode(table.column(i)))
+
+    return table.unify_dictionaries()
+
+
+def get_column(table: pa.Table, column: str) -> pa.Array:
+    # One contiguous array per column, so dictionary arrays have a single dictionary
+    return table.column(column).combine_chunks()
+
+
+###################
+##### KERNELS #####
+###################
+
+def on_dictionary(values: pa.Array, kernel) -> pa.Array:
+    # Apply a kernel to the dictionary of a dictionary array rather than to every row, and take the result for each row
+    if pa.types.is_dictionary(values.type):
+        return pc.take(kernel(values.dictionary), values.indices)
+    return kernel(values)
+
+
+def value_type(values: pa.Array) -> pa.DataType:
+    return values.type.value_type if pa.types.is_dictionary(values.type) else values.type
+
+
+def equal(values: pa.Array, value) -> pa.BooleanArray:
+    """
+    values == value, False for missing values.
+
+    Like a comparison of Python objects, values of another type (e.g. a string column compared with 5) are not equal.
+    """
+    try:
+        result = on_dictionary(values, lambda array: pc.equal(array, pa.scalar(value, value_type(values))))
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return pa.array(np.zeros(len(values), dtype=bool))
+    return pc.fill_null(result, False)
+
+
+def is_in(values: pa.Array, value_set) -> pa.BooleanArray:
+    # values in value_set, False for missing values
+    value_set = pa.array(list(value_set), type=value_type(values))
+    return pc.fill_null(on_dictionary(values, lambda array: pc.is_in(array, value_set=value_set)), False)
+
+
+def compare(values: pa.Array, kernel, value) -> pa.BooleanArray:
+    # Order comparison (pc.less, ...), False for missing values as for NaN
+    return pc.fill_null(kernel(values, value), False)
+
+
+def contains_text(values: pa.Array, text: str, missing: bool = False) -> pa.BooleanArray:
+    # Case insensitive substring match. missing is the result for missing values
+    return pc.fill_null(on_dictionary(values, lambda array: pc.match_substring(array, text, ignore_case=True)), missing)
+
+
+#########################
+##### V4 CONDITIONS #####
+#########################
+
+ORDER_KERNELS = {ast.Lt: pc.less, ast.LtE: pc.less_equal, ast.Gt: pc.greater, ast.GtE: pc.greater_equal}
+
+# Parsed condition tests by mapper class, the source of a class does not change within a session
+_condition_tests_cache = {}
+
+
+def get_condition_tests(mapper) -> dict[int, tuple[str, ast.AST]]:
+    """
+    Parse the condition methods of a V4 mapper class.
+
+    Each condition returns np.where(<test>, <condition number>, 0) for one row. The test is evaluated on whole columns
+    by evaluate_test, so the Arrow backend always applies the rules as they are written in the mapper.
+
+    Returns
+    -------
+    dict[int, tuple[str, ast.AST]]
+        The name of the row argument and the test expression by condition number.
+    """
+    mapper = mapper if isinstance(mapper, type) else type(mapper)
+    if mapper in _condition_tests_cache:
+        return _condition_tests_cache[mapper]
+
+    condition_tests = {}
+    for function in ast.walk(ast.parse(inspect.getsource(mapper))):
+        if not (isinstance(function, ast.FunctionDef) and re.fullmatch(r'condition_\d+', function.name)):
+            continue
+
+        returned = function.body[-1].value if isinstance(function.body[-1], ast.Return) else None
+        if isinstance(returned, ast.Call) and ast.unparse(returned.func) == 'np.where':
+            condition_tests[int(function.name.split('_')[1])] = (function.args.args[1].arg, returned.args[0])
+
+    _condition_tests_cache[mapper] = condition_tests
+    return condition_tests
+
+
+def get_test_columns(row: str, test: ast.AST) -> set[str]:
+    # Survey columns a condition test reads, row['Last'], ...
+    return {
+        node.slice.value for node in ast.walk(test)
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == row and isinstance(node.slice, ast.Constant)
+    }
+
+
+def evaluate_test(condition_mapper, row: str, test: ast.AST, table: pa.Table) -> pa.BooleanArray:
+    """
+    Evaluate a condition test on every row of the table with Arrow compute kernels.
+
+    The tests use a small set of expressions: row['col'] compared with a constant, a mode set (self.<set>) or a
+    list of modes, 'text' in str(row['col']).lower(), and & | ~ between these. Anything else raises a ValueError,
+    so that a new kind of rule is not silently evaluated differently from the mapper.
+    """
+    def is_row_column(node):
+        return isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == row and isinstance(node.slice, ast.Constant)
+
+    def get_value(node):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'self':
+            return getattr(condition_mapper, node.attr)
+        if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            # A mode is never equal to a set, so row['2ndLast'] in [self.<mode set>] is False for every row, as in the mapper
+            return [value for value in map(get_value, node.elts) if not isinstance(value, (set, frozenset))]
+        raise ValueError(f'cannot evaluate {ast.unparse(node)} with Arrow')
+
+    def evaluate(node):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+            kernel = pc.and_ if isinstance(node.op, ast.BitAnd) else pc.or_
+            return kernel(evaluate(node.left), evaluate(node.right))
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Invert, ast.Not)):
+            return pc.invert(evaluate(node.operand))
+
+        if isinstance(node, ast.Compare) and len(node.ops) == 1:
+            left, op, right = node.left, node.ops[0], node.comparators[0]
+
+            # 'airport' in str(row['SYSTEM_District']).lower(), where a missing value is the string 'nan'
+            if (isinstance(left, ast.Constant) and isinstance(op, ast.In) and isinstance(right, ast.Call) and
+                    isinstance(right.func, ast.Attribute) and right.func.attr == 'lower' and
+                    isinstance(right.func.value, ast.Call) and ast.unparse(right.func.value.func) == 'str' and
+                    is_row_column(right.func.value.args[0])):
+                text = left.value
+                if text != text.lower():
+                    return pa.array(np.zeros(table.num_rows, dtype=bool))
+                return contains_text(get_column(table, right.func.value.args[0].slice.value), text, missing=text in 'nan')
+
+            if is_row_column(left):
+                values = get_column(table, left.slice.value)
+                value = get_value(right)
+
+                if isinstance(op, ast.Eq):
+                    return equal(values, value)
+                if isinstance(op, ast.NotEq):
+                    return pc.invert(equal(values, value))
+                if isinstance(op, ast.In):
+                    return is_in(values, value)
+                if isinstance(op, ast.NotIn):
+                    return pc.invert(is_in(values, value))
+                if type(op) in ORDER_KERNELS:
+                    return compare(values, ORDER_KERNELS[type(op)], value)
+
+        raise ValueError(f'cannot evaluate {ast.unparse(node)} with Arrow')
+
+    return evaluate(test)
+
+
+def get_condition_hits(condition_mapper, table: pa.Table) -> dict[int, pa.BooleanArray]:
+    # Hit mask of every active condition of a V4 mapper instance
+    condition_tests = get_condition_tests(condition_mapper)
+
+    missing = [i for i in condition_mapper.active_conditions if i not in condition_tests]
+    if missing:
+        raise ValueError(f'conditions {missing} of {type(condition_mapper).__name__} do not return np.where(<test>, <id>, 0)')
+
+    return {i: evaluate_test(condition_mapper, *condition_tests[i], table) for i in condition_mapper.active_conditions}
+
+
+def map_conditions(condition_mapper, table: pa.Table, short_circuit: bool = False, count_conditions: bool = False, trace: bool = False) -> pd.DataFrame:
+    """
+    Arrow version of main_run_all of a V4 mapper instance, giving the same output.
+
+    Every active condition is evaluated on whole columns, and the condition ID of each row is the highest priority
+    condition it meets, found with pc.if_else from the lowest priority condition up. 'Condition ID' is int64 on every
+    path, where the row-wise conditions leave it as object without short_circuit.
+    """
+    logging.info(f'skipped {len(condition_mapper.disabled_conditions)} disabled conditions: {condition_mapper.disabled_conditions}')
+    if condition_mapper.pruned_conditions:
+        logging.info(f'skipped {len(condition_mapper.pruned_conditions)} conditions that do not apply at {condition_mapper.airport}: {condition_mapper.pruned_conditions}')
+
+    hits = get_condition_hits(condition_mapper, table)
+
+    condition_id = pa.array(np.full(table.num_rows, -1, dtype=np.int64))
+    for i in reversed(condition_mapper.get_condition_priority_order()):
+        condition_id = pc.if_else(hits[i], pa.scalar(i, pa.int64()), condition_id)
+    condition_id = condition_id.to_numpy()
+
+    df = condition_mapper.df.copy()
+
+    if short_circuit:
+        # the same columns as apply_conditions_by_priority
+        if count_conditions:
+            conditions_met = sum(hit.to_numpy(zero_copy_only=False).astype(np.int64) for hit in hits.values())
+            df['Conditions Met'] = conditions_met
+        else:
+            conditions_met = (condition_id != -1).astype(np.int64)
+
+        df['Mode Process Check'] = condition_mapping_utils.get_mode_process_check(
+            conditions_met, df['Last'], duplicates_counted=count_conditions
+        )
+        df['Condition ID'] = condition_id
+    else:
+        # the same columns and row order as apply_conditions, mode_process_check and get_condition_id
+        condition_columns = pd.DataFrame(
+            {f'Condition_{i}': np.where(hit.to_numpy(zero_copy_only=False), i, 0) for i, hit in hits.items()}, index=df.index
+        )
+        df = condition_mapper.mode_process_check(pd.concat([df, condition_columns], axis=1))
+        df['Condition ID'] = condition_id
+
+        status = df['Mode Process Check'].cat.codes.to_numpy()
+        row_order = np.concatenate([
+            np.flatnonzero(status == condition_mapping_utils.CORRECTLY_ASSIGNED),
+            np.flatnonzero(status == condition_mapping_utils.DUPLICATES_ASSIGNED),
+            np.flatnonzero(np.isin(status, [condition_mapping_utils.NOT_ASSIGNED_DATA, condition_mapping_utils.NOT_ASSIGNED_LOGIC]))
+        ])
+        df = df.iloc[row_order].reset_index(drop=True)
+
+    df = condition_mapper.assign_lasam_mode(df)
+    df = condition_mapper.update_lasam_mode_using_final_mode(df)
+
+    return condition_mapper.set_output_schema(df, trace=trace, keep_conditions_met=count_conditions)
+
+
+###########################
+##### V5 AND V6 STEPS #####
+###########################
+
+def map_steps(step_mapper, trace: bool = False) -> pd.DataFrame:
+    # The steps already work on integer mode codes, so a V5 or V6 mapper instance runs its own apply_steps
+    return step_mapper.main_run_all(trace=trace)
+
+
+###############
+##### RUN #####
+###############
+
+def get_rule_columns(condition_mapper) -> list[str]:
+    # Survey columns read by the active conditions of a V4 mapper instance
+    condition_tests = get_condition_tests(condition_mapper)
+    columns = set().union(*[get_test_columns(*condition_tests[i]) for i in condition_mapper.active_conditions if i in condition_tests])
+    return sorted(columns)
+
+
+def map_table(mapper, data, mode_condition_lu: pd.DataFrame = None, airport=None, **run_kwargs) -> pd.DataFrame:
+    """
+    Map survey rows with the conditions of a V4 mapper class evaluated by Arrow compute kernels.
+
+    The output is the same as mapper(df, mode_condition_lu).main_run_all(**run_kwargs). The conditions run on Arrow
+    arrays, with the mode columns dictionary encoded so that string comparisons and set membership are computed once
+    per distinct mode. The lookup merges and the output schema are the mapper's own. V5 and V6 mappers (steps) already
+    map integer mode codes, so they run their own steps (see map_steps).
+
+    Parameters
+    ----------
+    mapper : type
+        A V4 ModeConditionMapper class (conditions) or a V5 or V6 one (steps).
+    data : pd.DataFrame or pa.Table
+        Prepared CAA survey data, e.g. a table from read_table. A DataFrame is converted for the rule columns only.
+    mode_condition_lu : pd.DataFrame, optional
+        Lookup of the mapper, read by the mapper if not given.
+    airport : str, optional
+        AIRPORT_Prefix of the data, passed to mappers with airport specific conditions (see mapping_runner.map_partition).
+    **run_kwargs
+        Options of main_run_all: short_circuit, count_conditions and trace for V4, trace for V5 and V6.
+
+    Returns
+    -------
+    pd.DataFrame
+        The mapped rows.
+    """
+    if not (hasattr(mapper, 'get_condition_priority_order') or hasattr(mapper, 'apply_steps')):
+        raise ValueError(f'{mapper.__module__} has no Arrow rules, only the V4 conditions and the V5 and V6 steps do')
+
+    df = data.to_pandas() if isinstance(data, pa.Table) else data
+
+    mapper_kwargs = {'mode_condition_lu': mode_condition_lu}
+    if airport is not None and hasattr(mapper, 'airport_conditions'):
+        mapper_kwargs['airport'] = airport
+    condition_mapper = mapper(df, **mapper_kwargs)
+    if not hasattr(condition_mapper, 'active_conditions'):
+        return map_steps(condition_mapper, **run_kwargs)
+
+    rule_columns = get_rule_columns(condition_mapper)
+    table = data.select(rule_columns).unify_dictionaries() if isinstance(data, pa.Table) else to_table(df, rule_columns)
+    return map_conditions(condition_mapper, table, **run_kwargs)
@@ -0,0 +1,343 @@
+"""
+Run the CAA preprocessing and mode condition mapping as a batch job, without the notebooks.
+
+    python -m src.batch_run --config run.json
+
+The run config is a JSON file:
+
+    {
+        "input": "path/to/Full dataset for LASAM Zone Assignment.xlsx",
+        "drop_columns": ["Date", "Mode Group", "Rename", "Tylers proposed change", "Exclusion", "Report Method Timestamp", "Weighting"],
+        "airports": ["LHR"],
+        "years": [2024],
+        "mapper": "V6",
+        "run_options": {},
+        "backend": "pandas",
+        "check_vocabulary": true,
+        "prefetch": 2,
+        "explain_index": false,
+        "output_dir": "path/to/outputs"
+    }
+
+airports and years are optional (all airports and years by default). run_options are passed to the mapper's
+main_run_all, e.g. {"short_circuit": true} for the V4 mappers. backend "arrow" maps the V4 conditions with
+src.arrow_backend instead of the mapper's pandas rules (V5 and V6 mappers run their own steps either way).
+check_vocabulary checks the survey and mapper modes against the mapper's own mode allocation lookup (V5 and V6
+mappers, whose lookup has Mode_Allocated), and is skipped for mappers without one. The mapped rows of each airport and
+year are written to <output_dir>/<mapper>_<airport>_<year>.parquet, with a timing report in
+<output_dir>/timing_report.csv.
+With explain_index (V4, V5 and V6 mappers, needing a unique Row_ID column) the rule hits of the mapping of each
+airport and year are also stored in <mapper>_<airport>_<year>_explain.npz, see src.explain_utils.
+
+For a Parquet extract each airport is read on its own, up to prefetch airports ahead of the one being mapped, and the
+outputs are written by a background thread, so reading and writing overlap with mapping. Set prefetch to 0 to read,
+map and write one after the other.
+"""
+import argparse
+import importlib
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from src import arrow_backend, caa_survey_utils, config, explain_utils, mapping_runner, vocabulary_utils
+
+###########################
+##### MAPPER VERSIONS #####
+###########################
+
+MAPPER_VERSIONS = {
+    'V4': 'src.old_mappers.ModeConditionMapperV4',
+    'V4_Corrected': 'src.old_mappers.ModeConditionMapperV4_Corrected',
+    'V5': 'src.old_mappers.ModeConditionMapperV5',
+    'V6': 'src.old_mappers.ModeConditionMapperV6',
+    'V6_Old_LASAM_Mode_LU': 'src.old_mappers.ModeConditionMapperV6_Old_LASAM_Mode_LU',
+}
+
+
+def get_mapper(version: str):
+    # The ModeConditionMapper class of a mapper version, imported when first needed
+    if version not in MAPPER_VERSIONS:
+        raise ValueError(f'unknown mapper version {version}, expected one of {list(MAPPER_VERSIONS)}')
+    return importlib.import_module(MAPPER_VERSIONS[version]).ModeConditionMapper
+
+
+##################
+##### TIMING #####
+##################
+
+class TimingReport:
+    """Wall time and row count of each stage of the run."""
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, stage: str, partition: str = ''):
+        start = time.perf_counter()
+        record = {'Partition': partition, 'Stage': stage, 'Rows': None}
+        yield record
+        record['Seconds'] = time.perf_counter() - start
+        self.stages.append(record)
+        print(f'{partition} {stage}: {record["Seconds"]:.1f}s' + (f' ({record["Rows"]} rows)' if record['Rows'] is not None else ''))
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.stages, columns=['Partition', 'Stage', 'Rows', 'Seconds'])
+
+
+##############
+##### IO #####
+##############
+
+def read_extract(path: str, airports: list[str] = None, drop_columns: list[str] = None) -> pd.DataFrame:
+    """
+    Read the CAA extract, keeping only the given airports.
+
+    Parquet extracts are filtered while reading, other formats after.
+    """
+    extension = os.path.splitext(path)[1].lower()
+
+    if extension == '.parquet':
+        filters = [('AIRPORT_Prefix', 'in', airports)] if airports else None
+        caa_df = pd.read_parquet(path, filters=filters)
+    elif extension == '.csv':
+        caa_df = pd.read_csv(path)
+    else:
+        caa_df = pd.read_excel(path, engine='openpyxl')
+
+    if airports:
+        caa_df = caa_df[caa_df['AIRPORT_Prefix'].isin(airports)]
+
+    return caa_df.drop(columns=drop_columns or [], errors='ignore')
+
+
+def get_extract_columns(path: str) -> list[str]:
+    # Column names of the extract, reading only its schema or header
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.parquet':
+        return pq.read_schema(path).names
+    if extension == '.csv':
+        return pd.read_csv(path, nrows=0).columns.tolist()
+    return pd.read_excel(path, engine='openpyxl', nrows=0).columns.tolist()
+
+
+def get_extract_airports(path: str) -> list[str]:
+    # Airports of a Parquet extract, reading only the AIRPORT_Prefix column
+    return sorted(pd.read_parquet(path, columns=['AIRPORT_Prefix'])['AIRPORT_Prefix'].dropna().unique())
+
+
+def prefetch(read, items: list, workers: int = 2):
+    """
+    Yield (item, read(item)) for each item in order, reading up to workers items ahead in background threads.
+
+    With workers=0 each item is read when it is needed.
+    """
+    if workers == 0:
+        for item in items:
+            yield item, read(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = [(item, executor.submit(read, item)) for item in items[:workers]]
+        for item in items[workers:]:
+            next_item, future = pending.pop(0)
+            pending.append((item, executor.submit(read, item)))
+            yield next_item, future.result()
+
+        for next_item, future in pending:
+            yield next_item, future.result()
+
+
+class BackgroundWriter:
+    """
+    Write DataFrames to Parquet from a background thread, holding at most max_pending frames not yet written.
+
+    With max_pending=0 each frame is written when it is given. Used as a context manager, the frames given before an
+    error in the with block are still written, and the error of the block is raised rather than one of the writer.
+    """
+    def __init__(self, report: TimingReport, max_pending: int = 2):
+        self.report = report
+        self.error = None
+        self.thread = None
+        if max_pending > 0:
+            self.pending = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self._write_pending, daemon=True)
+            self.thread.start()
+
+    def _write(self, df: pd.DataFrame, path: str, partition: str):
+        with self.report.stage('write', partition):
+            df.to_parquet(path, index=False)
+
+    def _write_pending(self):
+        while (item := self.pending.get()) is not None:
+            try:
+                if self.error is None:
+                    self._write(*item)
+            except Exception as error:
+                self.error = error
+
+    def write(self, df: pd.DataFrame, path: str, partition: str = ''):
+        if self.error is not None:
+            raise self.error
+        if self.thread is None:
+            self._write(df, path, partition)
+        else:
+            self.pending.put((df, path, partition))
+
+    def close(self):
+        # Wait for the pending frames to be written, raising the first error
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            with suppress(Exception):
+                self.close()
+
+
+def get_airport_partitions(run_config: dict, report: TimingReport):
+    """
+    Yield (airport, DataFrame) for each airport of the run.
+
+    A Parquet extract is read one airport at a time with prefetch, other formats are read whole and split, dropping
+    each airport from the extract once it is taken out.
+    """
+    path, drop_columns = run_config['input'], run_config.get('drop_columns')
+
+    if os.path.splitext(path)[1].lower() == '.parquet':
+        def read_airport(airport):
+            with report.stage('read', airport) as record:
+                airport_df = read_extract(path, [airport], drop_columns).reset_index(drop=True)
+                record['Rows'] = len(airport_df)
+            return airport_df
+
+        airports = run_config.get('airports') or get_extract_airports(path)
+        yield from prefetch(read_airport, list(airports), run_config.get('prefetch', 2))
+        return
+
+    with report.stage('read extract') as record:
+        caa_df = read_extract(path, run_config.get('airports'), drop_columns)
+        record['Rows'] = len(caa_df)
+
+    for airport in run_config.get('airports') or sorted(caa_df['AIRPORT_Prefix'].dropna().unique()):
+        airport_rows = (caa_df['AIRPORT_Prefix'] == airport).to_numpy()
+        airport_df = caa_df[airport_rows].reset_index(drop=True)
+        caa_df = caa_df[~airport_rows]
+        yield airport, airport_df
+
+
+###############
+##### RUN #####
+###############
+
+def run(run_config: dict) -> pd.DataFrame:
+    """
+    Preprocess and map the CAA extract one airport at a time, writing one Parquet file per airport and year.
+
+    Only one airport's intermediates are held at a time, plus the prefetched airports and the outputs waiting to be
+    written (see get_airport_partitions and BackgroundWriter).
+
+    Returns
+    -------
+    pd.DataFrame
+        The timing report, also written to timing_report.csv in the output directory.
+    """
+    start = time.perf_counter()
+    report = TimingReport()
+    output_dir = run_config['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+
+    version = run_config['mapper']
+    mapper = get_mapper(version)
+    years = run_config.get('years')
+
+    # Checked before anything is mapped, rather than failing after the first partition
+    explain_index = run_config.get('explain_index', False)
+    if explain_index and 'Row_ID' not in get_extract_columns(run_config['input']):
+        raise ValueError(f'explain_index needs a unique Row_ID column, which {run_config["input"]} does not have')
+
+    with report.stage('read lookups'):
+        mode_condition_lu = mapping_runner.load_mapper_lookup(mapper)
+        segment_lu = config.segment_lu
+        final_mode_lasam_mode_lu = config.caa_final_mode_lasam_mode_lu
+
+    # Modes are checked against the lookup the mapper allocates with, so only mappers with a mode allocation lookup
+    check_vocabulary = run_config.get('check_vocabulary', True)
+    if check_vocabulary and 'Mode_Allocated' not in mode_condition_lu.columns:
+        print(f'{version} has no mode allocation lookup, the vocabulary is not checked')
+        check_vocabulary = False
+    if check_vocabulary:
+        with report.stage('check vocabulary'):
+            vocabulary_utils.check_vocabulary(mapper=mapper, mode_allocation_lu=mode_condition_lu)
+
+    backend = run_config.get('backend', 'pandas')
+    run_options = run_config.get('run_options', {})
+
+    # the partitions mapped before an error are still written
+    with BackgroundWriter(report, run_config.get('prefetch', 2)) as writer:
+        for airport, airport_df in get_airport_partitions(run_config, report):
+            with report.stage('preprocess', airport) as record:
+                airport_df = caa_survey_utils.preprocess_caa(airport_df, segment_lu, final_mode_lasam_mode_lu)
+                record['Rows'] = len(airport_df)
+
+            if check_vocabulary:
+                with report.stage('check vocabulary', airport):
+                    vocabulary_utils.check_vocabulary(airport_df, mode_allocation_lu=mode_condition_lu)
+
+            for year in (years or sorted(airport_df['Year'].dropna().unique())):
+                partition = f'{airport}_{year}'
+                year_df = airport_df[airport_df['Year'] == year].copy()
+
+                with report.stage('map', partition) as record:
+                    # the explain index is built from the same run as the output, so the hits explain the allocation written
+                    if explain_index:
+                        mapped_df, partition_index = explain_utils.map_and_explain(mapper, year_df, mode_condition_lu, airport, backend=backend, **run_options)
+                    elif backend == 'arrow':
+                        mapped_df = arrow_backend.map_table(mapper, year_df, mode_condition_lu, airport, **run_options)
+                    else:
+                        mapped_df = mapping_runner.map_partition(mapper, year_df, mode_condition_lu, airport, run_options)
+                    record['Rows'] = len(mapped_df)
+
+                # the output is handed to the writer first, so it is written even if the explain index fails
+                writer.write(mapped_df, os.path.join(output_dir, f'{version}_{partition}.parquet'), partition)
+
+                if explain_index:
+                    with report.stage('explain index', partition):
+                        explain_utils.write_explain_index(os.path.join(output_dir, f'{version}_{partition}_explain.npz'), partition_index)
+                    del partition_index
+                del year_df, mapped_df
+
+            del airport_df
+
+    timing_df = report.to_frame()
+    timing_df.to_csv(os.path.join(output_dir, 'timing_report.csv'), index=False)
+    # Stages overlap when prefetching, so the run time is less than the sum of the stage times
+    print(f'total: {time.perf_counter() - start:.1f}s wall, {timing_df["Seconds"].sum():.1f}s in stages')
+
+    return timing_df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Preprocess the CAA survey and assign LASAM modes.')
+    parser.add_argument('--config', required=True, help='path of the JSON run config')
+    args = parser.parse_args()
+
+    with open(args.config) as config_file:
+        run(json.load(config_file))
+
+
+if __name__ == '__main__':
+    main()
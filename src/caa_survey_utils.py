@@ -1,6 +1,12 @@
 import pandas as pd
 import numpy as np
 
+from src.condition_mapping_utils import ModeVocabulary, RaggedModes
+
+# Columns with the mode of each leg of the journey
+MODE_COLUMNS = ['MODEA', 'MODEB', 'MODEC']
+
+
 def process_dummy_records(caa_df: pd.DataFrame) -> pd.DataFrame:
     """
     Remove dummy records from the CAA DataFrame and uplift remaining records to maintain the original population.
@@ -109,6 +115,52 @@ def apply_3rdlast_mode(row):
     
 
 
+def get_ragged_modes(caa_df: pd.DataFrame, vocabulary: ModeVocabulary = None, mode_columns: list[str] = None) -> RaggedModes:
+    """
+    Get the modes of each journey as RaggedModes, for surveys with any number of legs.
+
+    Parameters
+    ----------
+    caa_df : pd.DataFrame
+        CAA survey data.
+    vocabulary : ModeVocabulary, optional
+        Vocabulary used to code the modes. A new one is created if not given.
+    mode_columns : list[str], optional
+        Columns with the mode of each leg, in travel order. Defaults to all the MODEA, MODEB, ... columns.
+
+    Returns
+    -------
+    RaggedModes
+        The legs of each journey as a flat array of mode codes and offsets.
+    """
+    if mode_columns is None:
+        mode_columns = sorted(column for column in caa_df.columns if len(column) == 5 and column.startswith('MODE') and column[-1].isupper())
+
+    return RaggedModes.from_columns(caa_df, mode_columns, vocabulary)
+
+
+def get_last_mode_column(k: int) -> str:
+    # 'Last', '2ndLast', '3rdLast', '4thLast', ...
+    if k == 1:
+        return 'Last'
+
+    suffix = 'th' if k % 100 in [11, 12, 13] else {1: 'st', 2: 'nd', 3: 'rd'}.get(k % 10, 'th')
+    return f'{k}{suffix}Last'
+
+
+def add_last_modes(caa_df: pd.DataFrame, modes: RaggedModes, number_of_modes: int = 3) -> pd.DataFrame:
+    """
+    Add the 'Last', '2ndLast', '3rdLast', ... columns from the ragged modes.
+
+    Vectorised version of apply_last_mode, apply_2ndlast_mode and apply_3rdlast_mode, which also works for
+    journeys with more than three legs.
+    """
+    for k in range(1, number_of_modes + 1):
+        caa_df[get_last_mode_column(k)] = np.asarray(modes.vocabulary.decode(modes.kth_last(k)), dtype=object)
+
+    return caa_df
+
+
 def apply_contains_mode(row: pd.Series, mode: str|list[str]) -> pd.Series:
     # returns true or false based on wether any of the modes contain the mode passed as an argument
 
@@ -119,4 +171,111 @@ def apply_contains_mode(row: pd.Series, mode: str|list[str]) -> pd.Series:
         row['Last'] in mode or
         row['2ndLast'] in mode or
         row['3rdLast'] in mode
-    )
\ No newline at end of file
+    )
+
+
+def get_modes_used(caa_df: pd.DataFrame, vocabulary: ModeVocabulary, mode_columns: list[str] = None) -> pd.Series:
+    """
+    Get a bitmask of the modes used by each journey.
+
+    Bit i of the mask is set if the mode with code i in the vocabulary is used in any of the mode columns,
+    so checking whether a journey contains any of a set of modes is a single bitwise AND (see get_contains_mode).
+
+    Parameters
+    ----------
+    caa_df : pd.DataFrame
+        CAA survey data.
+    vocabulary : ModeVocabulary
+        Vocabulary giving each mode its bit. The same vocabulary must be used to test the mask.
+    mode_columns : list[str], optional
+        Columns with the modes of each leg of the journey, MODE_COLUMNS by default.
+
+    Returns
+    -------
+    pd.Series
+        Bitmask of the modes used by each row: uint64, or Python ints if the vocabulary has more than 64 modes
+        (see ModeVocabulary.bits).
+    """
+    mode_columns = mode_columns if mode_columns is not None else MODE_COLUMNS
+
+    # encoded first, so that the vocabulary holds every mode of the columns when the bit width is chosen
+    leg_codes = [vocabulary.encode(caa_df[column]) for column in mode_columns]
+    modes_used = vocabulary.bits(np.full(len(caa_df), -1))
+    for codes in leg_codes:
+        modes_used = modes_used | vocabulary.bits(codes)
+
+    return pd.Series(modes_used, index=caa_df.index, name='Modes_Used')
+
+
+def get_contains_mode(modes_used: pd.Series, vocabulary: ModeVocabulary, mode: str|list[str]) -> pd.Series:
+    # vectorised version of apply_contains_mode: true where any of the modes is set in the modes used bitmask
+
+    if type(mode) != list:
+        mode = [mode]
+
+    mode_mask = vocabulary.mask(mode)
+    if modes_used.dtype == np.uint64:
+        # modes coded after the modes used were taken have no bit in them, so they are not used by any row
+        mode_mask = np.uint64(mode_mask & 0xFFFFFFFFFFFFFFFF)
+
+    return (modes_used & mode_mask) != 0
+
+
+def get_origin(caa_df: pd.DataFrame) -> pd.Series:
+    # vectorised version of the Origin column: AIRPORT for the Heathrow district, LDN for Greater London, NonLDN otherwise
+    return pd.Series(
+        np.select(
+            [caa_df['SYSTEM_District'].isin(['Heathrow Airport (SE)']), caa_df['SYSTEM_County'] == 'Greater London'],
+            ['AIRPORT', 'LDN'],
+            default='NonLDN'
+        ),
+        index=caa_df.index,
+        name='Origin'
+    )
+
+
+def preprocess_caa(caa_df: pd.DataFrame, segment_lu: pd.DataFrame, final_mode_lasam_mode_lu: pd.DataFrame) -> pd.DataFrame:
+    """
+    Prepare the CAA survey of one airport for the mode condition mappers.
+
+    These are the preprocessing steps of condition_mapping_rework.ipynb, with the row-wise steps vectorised.
+
+    Parameters
+    ----------
+    caa_df : pd.DataFrame
+        CAA survey data of one airport. Dummy records are removed in place.
+    segment_lu : pd.DataFrame
+        LASAM segment lookup, config.segment_lu.
+    final_mode_lasam_mode_lu : pd.DataFrame
+        LASAM mode of each CAA final mode, config.caa_final_mode_lasam_mode_lu.
+
+    Returns
+    -------
+    pd.DataFrame
+        The prepared survey with the LASAM segment, Last/2ndLast/3rdLast, Origin and Contains_* columns.
+    """
+    caa_df = process_dummy_records(caa_df)
+    caa_df = remove_interline_pax(caa_df)
+
+    # Assign LASAM segment
+    caa_df = pd.merge(caa_df, segment_lu, on=['SYSTEM_COUNTRY', 'SYSTEM_RouteTo', 'SYSTEM_PURPOSE1', 'SYSTEM_Market'], how='left')
+
+    # update mode fields from TfL Rail to Elizabeth Line
+    columns_to_update = ['MODEA', 'MODEB', 'MODEC', 'SYSTEM_FINALMODE']
+    caa_df[columns_to_update] = caa_df[columns_to_update].replace('TfL Rail (formerly Heathrow Connect)', 'Elizabeth Line')
+    caa_df = caa_df.rename(columns={'APT_TERMINAL': 'Terminal'})
+
+    # LASAM mode based on CAA final mode, used where the mode conditions have a logic gap
+    caa_df = pd.merge(caa_df, final_mode_lasam_mode_lu, on='SYSTEM_FINALMODE', how='left')
+
+    vocabulary = ModeVocabulary()
+    caa_df = add_last_modes(caa_df, get_ragged_modes(caa_df, vocabulary, MODE_COLUMNS))
+    caa_df['Origin'] = get_origin(caa_df)
+
+    caa_df['Modes_Used'] = get_modes_used(caa_df, vocabulary)
+    caa_df['Contains_Elizabeth_Line'] = get_contains_mode(caa_df['Modes_Used'], vocabulary, 'Elizabeth Line')
+    caa_df['Contains_Heathrow_Express'] = get_contains_mode(caa_df['Modes_Used'], vocabulary, 'Heathrow Express')
+    caa_df['Contains_Tube'] = get_contains_mode(caa_df['Modes_Used'], vocabulary, 'Tube/Metro/Subway')
+    caa_df['Contains_Rental'] = get_contains_mode(caa_df['Modes_Used'], vocabulary, ['Rental car - short term car park', 'Rental car - hire car courtesy bus'])
+
+    return caa_df
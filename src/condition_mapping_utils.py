@@ -1 +1,337 @@
+import ast
+import inspect
+import os
+import re
 
+import pandas as pd
+import numpy as np
+
+#######################
+##### MODE GROUPS #####
+#######################
+
+# Groups of CAA modes used by the mode condition rules.
+# These are frozensets so that they are built once, shared by every mapper and give constant time membership checks.
+MINICAB = frozenset(['Minicab', 'Uber'])
+HOTEL_BUS = frozenset(['Courtesy bus (travel agent)', 'Hotel bus'])
+NATIONAL_COACH = frozenset(['LHR-LTN Coach Service', 'National Express Coach', 'Other National/Regional coach service'])
+LOCAL_BUS = frozenset(['Local bus companies', 'Luton airport parkway DART'])
+TUBE = frozenset(['Docklands Light Railway', 'Tram', 'Tube/Metro/Subway'])
+NATIONAL_RAILWAYS = frozenset(['National railways', 'National railways (MAN only) - changed trains', 'National railways (MAN only) - not changed trains'])
+UNSPECIFIED_MODES = frozenset(['Car Unspecified', 'Bus Unspecified', 'Taxi/Minicab Unspecified', 'Rail Unspecified'])
+
+# Private car park types
+PRIVATE_CAR_SHORT_TERM = frozenset(['Private car - short term car park', 'Private car - short term car park - meet/greet'])
+PRIVATE_CAR_LONG_TERM = frozenset([
+    'Private car - valet service - Off airport', 'Private car - valet service - On airport', 'Private car - airport long term car park bus',
+    'Private car - private long term car park bus', 'Private car - business car park', 'Private car - mid stay car park bus',
+    'Private car - staff car park bus', 'Private car - hotel car park bus', 'Private car - type of car park unknown'
+])
+
+
+##############################
+##### MODE PROCESS CHECK #####
+##############################
+
+# Integer codes of the 'Mode Process Check' categories, so that filtering on the status is an integer comparison
+CORRECTLY_ASSIGNED = 0
+DUPLICATES_ASSIGNED = 1
+NOT_ASSIGNED_DATA = 2
+NOT_ASSIGNED_LOGIC = 3
+# Used when conditions are short-circuited and duplicates are not counted
+ASSIGNED = 4
+
+MODE_PROCESS_CHECK_DTYPE = pd.CategoricalDtype(
+    ['Correctly Assigned', 'Duplicates Assigned', 'Not Assigned - Data', 'Not Assigned - Logic', 'Assigned']
+)
+
+
+def get_mode_process_check(conditions_met: pd.Series, last_mode: pd.Series, duplicates_counted: bool = True) -> pd.Categorical:
+    """
+    Classify how each row was assigned by the mode conditions.
+
+    Parameters
+    ----------
+    conditions_met : pd.Series
+        Number of conditions met by each row.
+    last_mode : pd.Series
+        The 'Last' mode of each row, used to separate data issues from logic gaps when no condition is met.
+    duplicates_counted : bool, optional
+        Whether conditions_met counts every condition met. If False, rows meeting a condition are 'Assigned'.
+
+    Returns
+    -------
+    pd.Categorical
+        The 'Mode Process Check' status with the categories of MODE_PROCESS_CHECK_DTYPE.
+    """
+    conditions_met = np.asarray(conditions_met)
+
+    status_codes = np.select(
+        [
+            conditions_met == 1,
+            conditions_met > 0,
+            np.asarray(last_mode.isin(['Airport to airport coach service', 'No Mode']))
+        ],
+        [
+            CORRECTLY_ASSIGNED if duplicates_counted else ASSIGNED,
+            DUPLICATES_ASSIGNED if duplicates_counted else ASSIGNED,
+            NOT_ASSIGNED_DATA
+        ],
+        default=NOT_ASSIGNED_LOGIC
+    )
+
+    return pd.Categorical.from_codes(status_codes, dtype=MODE_PROCESS_CHECK_DTYPE)
+
+
+###########################
+##### CONDITION STUBS #####
+###########################
+
+# Disabled conditions of each V4 mapper class, parsed once per process
+_disabled_conditions_cache = {}
+
+
+def get_disabled_conditions(mapper: type) -> list[int]:
+    """
+    Numbers of the conditions of a V4 mapper class that are not coded, i.e. whose method is only 'return 0'.
+
+    These conditions (specific to LGW/STN, superseded or needing data we do not have) are read from the mapper's own
+    source, so a condition is enabled again by coding its method, in whichever mapper it is coded.
+    """
+    if mapper in _disabled_conditions_cache:
+        return list(_disabled_conditions_cache[mapper])
+
+    disabled_conditions = []
+    for function in ast.walk(ast.parse(inspect.getsource(mapper))):
+        if not (isinstance(function, ast.FunctionDef) and re.fullmatch(r'condition_\d+', function.name)):
+            continue
+        body = function.body
+        if len(body) == 1 and isinstance(body[0], ast.Return) and isinstance(body[0].value, ast.Constant) and body[0].value.value == 0:
+            disabled_conditions.append(int(function.name.split('_')[1]))
+
+    _disabled_conditions_cache[mapper] = sorted(disabled_conditions)
+    return list(_disabled_conditions_cache[mapper])
+
+
+#########################
+##### OUTPUT SCHEMA #####
+#########################
+
+def to_categorical(df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """
+    Convert the given columns of the DataFrame to categoricals in place, skipping columns that are not present.
+
+    The mapped modes only take a few dozen distinct values, so a categorical stores them as small integer codes
+    rather than one Python string per row.
+    """
+    for column in columns:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+
+    return df
+
+
+def encode_condition_columns(condition_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcast condition columns (condition number if met, 0 if not) to the smallest integer type.
+
+    Columns holding NaN, where a condition raised an error, stay as floats.
+    """
+    return condition_df.apply(lambda column: pd.to_numeric(column.astype(float), downcast='integer'))
+
+
+#########################
+##### MODE ENCODING #####
+#########################
+
+class ModeVocabulary:
+    """
+    Integer codes for CAA mode strings.
+
+    A mode's code is its position in the vocabulary. Codes are stable: modes are only ever appended, the first time
+    they are seen. Missing values (NaN) are coded as -1.
+    """
+    def __init__(self, modes=()):
+        self.modes = []
+        self.mode_codes = {}
+        self.add(modes)
+
+    def __len__(self):
+        return len(self.modes)
+
+    def add(self, modes):
+        for mode in modes:
+            if isinstance(mode, str) and mode not in self.mode_codes:
+                self.mode_codes[mode] = len(self.modes)
+                self.modes.append(mode)
+
+    def code(self, mode: str) -> int:
+        self.add([mode])
+        return self.mode_codes[mode]
+
+    def encode(self, values) -> np.ndarray:
+        values = np.asarray(values, dtype=object)
+        self.add(pd.unique(values))
+        return pd.Index(self.modes, dtype=object).get_indexer(values).astype(np.int16)
+
+    def decode(self, codes: np.ndarray) -> pd.Categorical:
+        return pd.Categorical.from_codes(codes, categories=pd.Index(self.modes, dtype=object))
+
+    def table(self, modes) -> np.ndarray:
+        mode_codes = [self.code(mode) for mode in modes]
+
+        # One flag per code plus a final False flag, which is where the missing code -1 indexes
+        flags = np.zeros(len(self) + 1, dtype=bool)
+        flags[mode_codes] = True
+        return flags
+
+    def match(self, predicate) -> np.ndarray:
+        # Same as table() for the modes where predicate(mode) is True, e.g. substring matches
+        return self.table([mode for mode in self.modes if predicate(mode)])
+
+    def isin(self, codes: np.ndarray, modes) -> np.ndarray:
+        return self.table(modes)[codes]
+
+    def bits(self, codes: np.ndarray) -> np.ndarray:
+        """
+        One bit per mode: bit i is set for the mode with code i. Missing values (-1) have no bit set.
+
+        The bits are uint64 while the vocabulary has at most 64 modes. Above that they are Python ints (an object
+        array), which hold as many bits as there are modes, so the masks work the same for any number of modes.
+        """
+        codes = np.asarray(codes)
+        if len(self) <= 64:
+            return np.where(codes >= 0, np.left_shift(np.uint64(1), np.maximum(codes, 0).astype(np.uint64)), np.uint64(0))
+
+        # One bit per code plus a final 0, which is where the missing code -1 indexes
+        bit_table = np.array([1 << code for code in range(len(self))] + [0], dtype=object)
+        return bit_table[codes]
+
+    def mask(self, modes) -> int:
+        # Mask with the bits of all the given modes, so "uses any of modes" is (modes_used & mask) != 0
+        mode_mask = 0
+        for mode in modes:
+            mode_mask |= 1 << self.code(mode)
+        return mode_mask
+
+
+class RaggedModes:
+    """
+    Modes of journeys with any number of legs, stored as one flat array of mode codes and the offsets of each journey.
+
+    The legs of journey i are codes[offsets[i]:offsets[i + 1]] in travel order, coded with a shared ModeVocabulary.
+    Empty legs ('No Mode' or missing) after a journey's last mode are not stored, but every journey keeps at least its
+    first leg and gaps between legs are kept, which matches how Last/2ndLast/3rdLast are derived from MODEA/B/C.
+    """
+    def __init__(self, codes: np.ndarray, offsets: np.ndarray, vocabulary: ModeVocabulary):
+        self.codes = codes
+        self.offsets = offsets
+        self.vocabulary = vocabulary
+
+    @classmethod
+    def from_columns(cls, df: pd.DataFrame, mode_columns: list[str], vocabulary: ModeVocabulary = None, empty_modes=('No Mode',)):
+        """
+        Build the ragged modes from one column per leg, e.g. ['MODEA', 'MODEB', 'MODEC'], in travel order.
+        """
+        vocabulary = vocabulary if vocabulary is not None else ModeVocabulary()
+
+        legs = np.column_stack([vocabulary.encode(df[column]) for column in mode_columns])
+        used = ~(vocabulary.isin(legs, empty_modes) | (legs < 0))
+
+        # Number of legs up to and including the last used one, at least 1
+        number_of_columns = len(mode_columns)
+        n_legs = np.where(used.any(axis=1), number_of_columns - np.argmax(used[:, ::-1], axis=1), 1)
+
+        # Legs are read row by row, so the kept legs of each journey are contiguous and in order
+        codes = legs[np.arange(number_of_columns) < n_legs[:, None]]
+        offsets = np.concatenate([[0], np.cumsum(n_legs)])
+
+        return cls(codes, offsets, vocabulary)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def n_legs(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def kth_last(self, k: int, fill: str = 'No Mode') -> np.ndarray:
+        """
+        Code of the k-th last mode of each journey (k=1 is the last mode), or the code of fill for journeys with fewer
+        than k legs.
+        """
+        has_leg = self.n_legs >= k
+        positions = np.where(has_leg, self.offsets[1:] - k, 0)
+
+        kth_last = np.full(len(self), self.vocabulary.code(fill), dtype=np.int16)
+        kth_last[has_leg] = self.codes[positions[has_leg]]
+        return kth_last
+
+    def contains(self, modes) -> np.ndarray:
+        """Whether any leg of each journey is one of the modes."""
+        if len(self) == 0:
+            return np.zeros(0, dtype=bool)
+
+        return np.logical_or.reduceat(self.vocabulary.isin(self.codes, modes), self.offsets[:-1])
+
+
+def select_update(mode: np.ndarray, conditions: list[np.ndarray], choices: list, default=None) -> np.ndarray:
+    """
+    In place version of np.select for an array of mode codes.
+
+    mode is updated with the choice of the first condition each row meets. Rows meeting no condition keep their mode,
+    or take the default if one is given. Choices and default can be a single code or an array of codes.
+    The conditions must be computed before calling, so that they all see the mode before the update.
+    """
+    unmatched = np.ones(len(mode), dtype=bool)
+
+    for condition, choice in zip(conditions, choices):
+        rows = condition & unmatched
+        mode[rows] = choice[rows] if isinstance(choice, np.ndarray) else choice
+        unmatched &= ~condition
+
+    if default is not None:
+        mode[unmatched] = default[unmatched] if isinstance(default, np.ndarray) else default
+
+    return mode
+
+
+###################
+##### LOOKUPS #####
+###################
+
+# Parsed lookup tables, shared by every mapper in the process
+_lookup_cache = {}
+
+
+def read_lookup(path: str, reader=pd.read_csv, **kwargs) -> pd.DataFrame:
+    """
+    Read a lookup table, caching the parsed table for the rest of the process.
+
+    Parameters
+    ----------
+    path : str
+        Path of the lookup file.
+    reader : callable, optional
+        Function used to parse the file, pd.read_csv by default.
+    **kwargs
+        Passed on to the reader.
+
+    Returns
+    -------
+    pd.DataFrame
+        A copy of the cached table, so callers can modify it without changing the cache.
+
+    Notes
+    -----
+    The cache is keyed by the path, the reader and its arguments and the file's modification time,
+    so a lookup is parsed again once the file has been edited.
+    """
+    key = (path, reader, repr(sorted(kwargs.items())))
+    mtime = os.path.getmtime(path)
+
+    cached = _lookup_cache.get(key)
+    if cached is None or cached[0] != mtime:
+        _lookup_cache[key] = (mtime, reader(path, **kwargs))
+
+    return _lookup_cache[key][1].copy()
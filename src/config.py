@@ -1,18 +1,36 @@
-import pandas as pd
+import os
+
+from src import condition_mapping_utils
 
 #################
 ##### PATHS #####
 #################
-MAIN_DIR= r'\\GBLON7VS01.europe.jacobs.com\Projects\UNIF\Projects\60H700SA - Heathrow SAS 2024\04 Technical\03 LASAM Development\2024 Base Mtx\Matrix Development'
-DATA_DIR = rf'{MAIN_DIR}\02_data'
-LOOKUP_DIR = rf'{MAIN_DIR}\03_lookups'
+# MAIN_DIR can be pointed elsewhere (e.g. a local copy of the share) with the LASAM_MAIN_DIR environment variable
+MAIN_DIR = os.environ.get('LASAM_MAIN_DIR', r'\\GBLON7VS01.europe.jacobs.com\Projects\UNIF\Projects\60H700SA - Heathrow SAS 2024\04 Technical\03 LASAM Development\2024 Base Mtx\Matrix Development')
+DATA_DIR = os.path.join(MAIN_DIR, '02_data')
+LOOKUP_DIR = os.path.join(MAIN_DIR, '03_lookups')
+
+MODE_CONDITION_MAPPING_PATH = os.path.join(DATA_DIR, 'mode_conditions', 'version1', 'mode_condition_mapping.xlsx')
+CAA_MODE_ALLOCATION_LASAM_MODE_LU_PATH = os.path.join(DATA_DIR, 'mode_conditions', 'version2', 'caa_mode_allocation_lasam_mode_lu.csv')
+CAA_MODE_ALLOCATION_LASAM_MODE_LU_02_PATH = os.path.join(DATA_DIR, 'mode_conditions', 'version2', 'caa_mode_allocation_lasam_mode_lu_02.csv')
+
+# Golden mapper outputs of the regression checks (see regression_utils), next to the lookups they were mapped with
+GOLDEN_DIR = os.path.join(DATA_DIR, 'mode_conditions', 'golden')
 
 ###################
 ##### LOOKUPS #####
 ###################
+# The lookups are read when first used (e.g. config.segment_lu), not when config is imported
+LOOKUP_PATHS = {
+    'caa_final_mode_lasam_mode_lu': os.path.join(LOOKUP_DIR, 'caa_final_mode_lasam_mode_lu.csv'),
+    'cube_segment_mode_index_lu': os.path.join(LOOKUP_DIR, 'cube_segment_mode_index_lu.csv'),
+    'lasam_zone_district_lu': os.path.join(LOOKUP_DIR, 'lasam_zone_district_lu.csv'),
+    'segment_lu': os.path.join(LOOKUP_DIR, 'segment_lu.csv'),
+    'caa_mode_allocation_lasam_mode_lu': CAA_MODE_ALLOCATION_LASAM_MODE_LU_PATH,
+}
+
 
-caa_final_mode_lasam_mode_lu = pd.read_csv(rf'{LOOKUP_DIR}\caa_final_mode_lasam_mode_lu.csv')
-cube_segment_mode_index_lu = pd.read_csv(rf'{LOOKUP_DIR}\cube_segment_mode_index_lu.csv')
-lasam_zone_district_lu = pd.read_csv(rf'{LOOKUP_DIR}\lasam_zone_district_lu.csv')
-segment_lu = pd.read_csv(rf'{LOOKUP_DIR}\segment_lu.csv')
-caa_mode_allocation_lasam_mode_lu = pd.read_csv(rf'{DATA_DIR}\mode_conditions\version2\caa_mode_allocation_lasam_mode_lu.csv')
\ No newline at end of file
+def __getattr__(name):
+    if name in LOOKUP_PATHS:
+        return condition_mapping_utils.read_lookup(LOOKUP_PATHS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
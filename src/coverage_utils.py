@@ -0,0 +1,208 @@
+import numpy as np
+import pandas as pd
+
+from src import arrow_backend
+
+########################
+##### HIT MATRICES #####
+########################
+
+def get_condition_hit_matrix(condition_mapper, caa_df: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Rows x conditions hit matrix of the active conditions of a V4 mapper instance, evaluated with arrow_backend.
+
+    Returns the hits, with one column per condition of condition_mapper.active_conditions, and the priority rank
+    (0 for the highest priority) of each of these conditions.
+    """
+    table = arrow_backend.to_table(caa_df, arrow_backend.get_rule_columns(condition_mapper))
+    condition_hits = arrow_backend.get_condition_hits(condition_mapper, table)
+
+    active_conditions = condition_mapper.active_conditions
+    hits = np.column_stack([condition_hits[i].to_numpy(zero_copy_only=False) for i in active_conditions])
+
+    condition_order = condition_mapper.get_condition_priority_order()
+    rank = np.array([condition_order.index(i) for i in active_conditions])
+
+    return hits, rank
+
+
+def get_first_met(hits: np.ndarray, rank: np.ndarray) -> np.ndarray:
+    # Column of the highest priority condition met by each row, -1 if none is met
+    first_met = np.where(hits, rank, len(rank)).argmin(axis=1)
+    return np.where(hits.any(axis=1), first_met, -1)
+
+
+def get_step_hit_matrix(step_mapper) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Rows x steps hit matrix of a step mapper instance (V5, V6) that has run apply_steps with record_steps=True.
+
+    A step hits a row when it changes the row's mode. Returns the hits and the mode code of each row after each step
+    (-1 if missing), in the codes of step_mapper.vocabulary.
+    """
+    codes = step_mapper.step_codes
+    previous = np.column_stack([np.full(len(codes), -1, dtype=codes.dtype), codes[:, :-1]])
+    return codes != previous, codes
+
+
+####################
+##### COVERAGE #####
+####################
+
+def get_cofiring(hits: np.ndarray, rules: pd.Index, weight: np.ndarray = None) -> pd.DataFrame:
+    """
+    Rows hit by each pair of rules, from a rows x rules hit matrix.
+
+    cofiring.loc[a, b] is the number of rows (or their weight, if given) hit by both rule a and rule b, and the diagonal
+    the rows hit by each rule. All pairs are computed at once as hits.T @ hits.
+    """
+    hits = hits.astype(np.float64)
+    weighted_hits = hits if weight is None else hits * weight[:, None]
+    cofiring = weighted_hits.T @ hits
+
+    return pd.DataFrame(cofiring if weight is not None else cofiring.astype(np.int64), index=rules, columns=rules)
+
+
+def get_coverage(hits: np.ndarray, changed: np.ndarray, rules: pd.Index, weight: np.ndarray) -> pd.DataFrame:
+    """
+    Coverage of each rule from its rows x rules hit and changed matrices.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per rule with 'Rows_Hit', 'Rows_Changed' (rows whose result the rule set), 'Rows_Co_Fired' (rows also
+        hit by another rule), 'POP_Hit', 'POP_Changed' and 'prop', the share of the total weight hit in percent.
+    """
+    co_fired = hits & (hits.sum(axis=1) > 1)[:, None]
+
+    coverage_df = pd.DataFrame({
+        'Rows_Hit': hits.sum(axis=0),
+        'Rows_Changed': changed.sum(axis=0),
+        'Rows_Co_Fired': co_fired.sum(axis=0),
+        'POP_Hit': weight @ hits,
+        'POP_Changed': weight @ changed,
+    }, index=rules)
+    coverage_df['prop'] = coverage_df['POP_Hit'] / weight.sum() * 100
+
+    return coverage_df
+
+
+def get_condition_coverage(mapper, caa_df: pd.DataFrame, mode_condition_lu: pd.DataFrame = None, airport=None, weight_col: str = 'POP',
+                           cofiring_weight: bool = False) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Profile which conditions of a V4 mapper are met, by how many rows and how much weight.
+
+    The conditions are evaluated once on whole columns with arrow_backend, giving a rows x conditions hit matrix from
+    which every count is taken.
+
+    Parameters
+    ----------
+    mapper : type
+        A V4 ModeConditionMapper class.
+    caa_df : pd.DataFrame
+        Prepared CAA survey data, as passed to the mapper.
+    mode_condition_lu : pd.DataFrame, optional
+        Mode condition lookup of the mapper, read by the mapper if not given.
+    airport : str, optional
+        AIRPORT_Prefix of the data, so that the conditions of other airports are pruned (see mapping_runner.map_partition).
+    weight_col : str, optional
+        Column with the weight of each row.
+    cofiring_weight : bool, optional
+        Give the co-firing matrix as weight rather than rows.
+
+    Returns
+    -------
+    tuple[pd.DataFrame, pd.DataFrame]
+        The coverage of every condition, see get_coverage, with its 'Status' (active, disabled or pruned), the 'Priority
+        Rank' it is checked in, and its LASAM mode and priority. 'Rows_Changed' are the rows the condition assigns,
+        i.e. where it is the highest priority condition met, and 'Rows_Co_Fired' the rows that mode_process_check finds
+        as duplicates. Then the co-firing matrix of the active conditions.
+    """
+    mapper_kwargs = {'mode_condition_lu': mode_condition_lu}
+    if airport is not None:
+        mapper_kwargs['airport'] = airport
+    condition_mapper = mapper(caa_df, **mapper_kwargs)
+
+    hits, rank = get_condition_hit_matrix(condition_mapper, caa_df)
+    active_conditions = condition_mapper.active_conditions
+
+    # Rows assigned by each condition: the first met in priority order
+    first_met = get_first_met(hits, rank)
+    met = first_met >= 0
+    changed = np.zeros_like(hits)
+    changed[np.flatnonzero(met), first_met[met]] = True
+
+    conditions = pd.Index(active_conditions, name='Condition ID')
+    weight = caa_df[weight_col].to_numpy(dtype=float)
+    active_df = get_coverage(hits, changed, conditions, weight)
+    active_df['Priority Rank'] = rank + 1
+
+    all_conditions = pd.Index(range(1, condition_mapper.number_of_conditions + 1), name='Condition ID')
+    coverage_df = active_df.reindex(all_conditions)
+    coverage_df.insert(0, 'Status', np.select(
+        [all_conditions.isin(condition_mapper.disabled_conditions), all_conditions.isin(condition_mapper.pruned_conditions)],
+        ['disabled', 'pruned'], default='active'
+    ))
+    count_columns = ['Rows_Hit', 'Rows_Changed', 'Rows_Co_Fired', 'POP_Hit', 'POP_Changed', 'prop']
+    coverage_df[count_columns] = coverage_df[count_columns].fillna(0)
+    coverage_df[count_columns[:3]] = coverage_df[count_columns[:3]].astype(np.int64)
+    coverage_df['Priority Rank'] = coverage_df['Priority Rank'].astype('Int64')
+
+    condition_lu = condition_mapper.mode_condition_lu.drop_duplicates('Condition ID').set_index('Condition ID')
+    coverage_df = coverage_df.join(condition_lu[['LASAM Mode', 'LASAM Mode Priority']])
+
+    dead = coverage_df.index[(coverage_df['Status'] == 'active') & (coverage_df['Rows_Hit'] == 0)].tolist()
+    print(f'{len(active_conditions)} active conditions, {len(dead)} never met: {dead}')
+
+    return coverage_df.reset_index(), get_cofiring(hits, conditions, weight if cofiring_weight else None)
+
+
+def get_step_coverage(mapper, caa_df: pd.DataFrame, mode_condition_lu: pd.DataFrame = None, weight_col: str = 'POP',
+                      cofiring_weight: bool = False) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Profile which steps of a V5 or V6 mapper apply, by how many rows and how much weight.
+
+    The mapper's own steps are run once with record_steps=True, which keeps the mode codes after every step.
+
+    Parameters
+    ----------
+    mapper : type
+        A V5 or V6 ModeConditionMapper class.
+    caa_df : pd.DataFrame
+        Prepared CAA survey data, as passed to the mapper.
+    mode_condition_lu : pd.DataFrame, optional
+        Mode allocation lookup of the mapper, read by the mapper if not given.
+    weight_col : str, optional
+        Column with the weight of each row.
+    cofiring_weight : bool, optional
+        Give the co-firing matrix as weight rather than rows.
+
+    Returns
+    -------
+    tuple[pd.DataFrame, pd.DataFrame]
+        The coverage of every step, see get_coverage. A step hits the rows whose mode it changes, so 'Rows_Hit' and
+        'Rows_Changed' are the same. Then the co-firing matrix of the steps.
+    """
+    step_mapper = mapper(caa_df.copy(), mode_condition_lu=mode_condition_lu)
+    step_mapper.apply_steps(record_steps=True)
+    hits, _ = get_step_hit_matrix(step_mapper)
+
+    steps = pd.Index(step_mapper.step_columns, name='Step')
+    weight = caa_df[weight_col].to_numpy(dtype=float)
+    coverage_df = get_coverage(hits, hits, steps, weight)
+
+    return coverage_df.reset_index(), get_cofiring(hits, steps, weight if cofiring_weight else None)
+
+
+def get_rule_coverage(mapper, caa_df: pd.DataFrame, weight_col: str = 'POP', cofiring_weight: bool = False, **mapper_kwargs) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Coverage of the conditions of a V4 mapper (get_condition_coverage) or of the steps of a V5 or V6 mapper
+    (get_step_coverage).
+
+    mapper_kwargs (mode_condition_lu, and airport for the conditions) are passed to the coverage function.
+    """
+    if hasattr(mapper, 'get_condition_priority_order'):
+        return get_condition_coverage(mapper, caa_df, weight_col=weight_col, cofiring_weight=cofiring_weight, **mapper_kwargs)
+    if hasattr(mapper, 'apply_steps'):
+        mapper_kwargs.pop('airport', None)
+        return get_step_coverage(mapper, caa_df, weight_col=weight_col, cofiring_weight=cofiring_weight, **mapper_kwargs)
+    raise ValueError(f'{mapper.__module__} has no coverage profile, only the V4 conditions and the V5 and V6 steps do')
@@ -0,0 +1,271 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src import arrow_backend, coverage_utils, mapping_runner, regression_utils
+
+#####################
+##### HIT INDEX #####
+#####################
+
+class ExplainIndex:
+    """
+    Rule hits and final allocation of mapped survey rows, stored so that the allocation of any row can be explained
+    without running the mapper again.
+
+    row_ids are sorted, and row r of hits (a sparse rows x rules CSR matrix) holds the rules met by row row_ids[r].
+    For conditions (kind 'conditions') the rules are in priority order, so the first rule of a row is the one that
+    assigns it. For steps (kind 'steps') they are in step order, with the mode code of each row after each step in
+    step_codes (-1 if missing) and the modes of the codes in modes.
+    """
+    def __init__(self, kind: str, id_col: str, row_ids: np.ndarray, hits: sparse.csr_matrix, rules: pd.DataFrame,
+                 allocation: pd.DataFrame, step_codes: np.ndarray = None, modes: np.ndarray = None):
+        self.kind = kind
+        self.id_col = id_col
+        self.row_ids = row_ids
+        self.hits = hits
+        self.rules = rules
+        self.allocation = allocation
+        self.step_codes = step_codes
+        self.modes = modes
+
+    @property
+    def shape(self):
+        return self.hits.shape
+
+    def get_positions(self, row_ids) -> np.ndarray:
+        # Position of each row ID in the index, raising for IDs that are not in it
+        row_ids = np.asarray(row_ids)
+        positions = np.searchsorted(self.row_ids, row_ids).clip(max=len(self.row_ids) - 1)
+        missing = self.row_ids[positions] != row_ids
+        if missing.any():
+            raise ValueError(f'{missing.sum()} row IDs are not in the explain index, e.g. {row_ids[missing][:5].tolist()}')
+        return positions
+
+    def explain(self, row_ids) -> pd.DataFrame:
+        """
+        Explain the allocation of survey rows from the stored hits.
+
+        Parameters
+        ----------
+        row_ids : list-like
+            IDs of the rows to explain.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per rule met by each row, in the order of row_ids and then priority (conditions) or step order
+            (steps), with the final allocation of the row. Rows meeting no rule have one row with no rule.
+
+            For conditions: 'Fired Condition ID', its 'Priority Rank' and 'Fired LASAM Mode', and 'Selected' for the
+            condition that assigns the row; the others met are the duplicates found by mode_process_check.
+            For steps: 'Step', and 'Mode Before' and 'Mode After' the step, later steps overriding earlier ones.
+        """
+        positions = self.get_positions(row_ids)
+        row_hits = self.hits[positions]
+
+        # One slot per rule met, or one empty slot for rows meeting none
+        counts = np.diff(row_hits.indptr)
+        slots = np.maximum(counts, 1)
+        query = np.repeat(np.arange(len(positions)), slots)
+        within = np.arange(slots.sum()) - np.repeat(np.cumsum(slots) - slots, slots)
+        met = within < np.repeat(counts, slots)
+
+        rule = np.full(len(query), -1)
+        rule[met] = row_hits.indices
+
+        explain_df = pd.DataFrame({self.id_col: self.row_ids[positions[query]]})
+        rules_df = self.rules.take(np.where(met, rule, 0)).reset_index(drop=True)
+        rules_df[~met] = None
+
+        if self.kind == 'conditions':
+            explain_df['Fired Condition ID'] = rules_df['Condition ID'].astype('Int64')
+            explain_df['Priority Rank'] = rules_df['Priority Rank'].astype('Int64')
+            explain_df['Fired LASAM Mode'] = rules_df['LASAM Mode']
+            explain_df['Selected'] = met & (within == 0)
+        else:
+            explain_df['Step'] = rules_df['Step']
+            after = self.step_codes[positions[query], rule.clip(min=0)]
+            before = np.where(rule > 0, self.step_codes[positions[query], (rule - 1).clip(min=0)], -1)
+            explain_df['Mode Before'] = self.decode(np.where(met, before, -1))
+            explain_df['Mode After'] = self.decode(np.where(met, after, -1))
+
+        allocation_df = self.allocation.take(positions[query]).reset_index(drop=True)
+        return pd.concat([explain_df, allocation_df], axis=1)
+
+    def trace(self, row_ids) -> pd.DataFrame:
+        # Mode of each row after every step (steps only), as the Step_N columns of main_run_all(trace=True)
+        if self.kind != 'steps':
+            raise ValueError('only an explain index of steps has a trace')
+        positions = self.get_positions(row_ids)
+        trace_df = pd.DataFrame({self.id_col: self.row_ids[positions]})
+        for step, codes in zip(self.rules['Step'], self.step_codes[positions].T):
+            trace_df[step] = self.decode(codes)
+        return trace_df
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        # Modes of step codes, None for -1
+        return np.where(codes >= 0, self.modes.astype(object)[codes.clip(min=0)], None)
+
+
+def get_allocation(mapped_df: pd.DataFrame, row_ids: np.ndarray, id_col: str) -> pd.DataFrame:
+    # Normalised output columns of the mapper (see regression_utils.get_golden) in the order of the sorted row IDs
+    allocation = regression_utils.get_golden(mapped_df, id_col)
+    if not np.array_equal(allocation[id_col].to_numpy(), row_ids):
+        raise ValueError(f'the rows of the mapper output are not the rows of the survey by {id_col}')
+    return allocation.drop(columns=id_col)
+
+
+def map_and_explain(mapper, caa_df: pd.DataFrame, mode_condition_lu: pd.DataFrame = None, airport=None, id_col: str = 'Row_ID',
+                    backend: str = 'pandas', **run_kwargs) -> tuple[pd.DataFrame, ExplainIndex]:
+    """
+    Map survey rows with a mapper and store the rule hits of that run with the final allocation of each row.
+
+    A V5 or V6 mapper (steps) is run once with record_steps=True, so the mode after each step and the allocation come
+    from the same run of the mapper's own steps. For a V4 mapper (conditions) the hits are its conditions, evaluated
+    with arrow_backend from the mapper's source, and the allocation is the output of the mapping.
+
+    Parameters
+    ----------
+    mapper : type
+        A V4, V5 or V6 ModeConditionMapper class.
+    caa_df : pd.DataFrame
+        Prepared CAA survey data with a unique row ID.
+    mode_condition_lu : pd.DataFrame, optional
+        Lookup of the mapper, read by the mapper if not given.
+    airport : str, optional
+        AIRPORT_Prefix of the data, so that the conditions of other airports are pruned (see mapping_runner.map_partition).
+    id_col : str, optional
+        Column identifying the rows.
+    backend : str, optional
+        'pandas' to map the conditions with the mapper itself, 'arrow' with arrow_backend.
+    **run_kwargs
+        Options of main_run_all, e.g. short_circuit=True.
+
+    Returns
+    -------
+    tuple[pd.DataFrame, ExplainIndex]
+        The mapper output and the explain index of its rows, see ExplainIndex.explain.
+    """
+    if not (hasattr(mapper, 'get_condition_priority_order') or hasattr(mapper, 'apply_steps')):
+        raise ValueError(f'{mapper.__module__} has no explain index, only the V4 conditions and the V5 and V6 steps do')
+    if caa_df[id_col].duplicated().any():
+        raise ValueError(f'{id_col} is not unique, so rows cannot be explained by ID')
+
+    mode_condition_lu = mode_condition_lu if mode_condition_lu is not None else mapping_runner.load_mapper_lookup(mapper)
+    row_order = np.argsort(caa_df[id_col].to_numpy(), kind='stable')
+    row_ids = caa_df[id_col].to_numpy()[row_order]
+
+    if hasattr(mapper, 'apply_steps'):
+        step_mapper = mapper(caa_df.copy(), mode_condition_lu=mode_condition_lu)
+        mapped_df = step_mapper.main_run_all(record_steps=True, **run_kwargs)
+        hits, codes = coverage_utils.get_step_hit_matrix(step_mapper)
+
+        rules = pd.DataFrame({'Step': step_mapper.step_columns})
+        return mapped_df, ExplainIndex(
+            'steps', id_col, row_ids, sparse.csr_matrix(hits[row_order]), rules, get_allocation(mapped_df, row_ids, id_col),
+            codes[row_order], np.asarray(step_mapper.vocabulary.modes, dtype=object)
+        )
+
+    if backend == 'arrow':
+        mapped_df = arrow_backend.map_table(mapper, caa_df.copy(), mode_condition_lu, airport, **run_kwargs)
+    else:
+        mapped_df = mapping_runner.map_partition(mapper, caa_df.copy(), mode_condition_lu, airport, run_kwargs)
+
+    mapper_kwargs = {'mode_condition_lu': mode_condition_lu}
+    if airport is not None and hasattr(mapper, 'airport_conditions'):
+        mapper_kwargs['airport'] = airport
+    condition_mapper = mapper(caa_df, **mapper_kwargs)
+
+    hits, rank = coverage_utils.get_condition_hit_matrix(condition_mapper, caa_df)
+    priority_order = np.argsort(rank)
+    condition_lu = condition_mapper.mode_condition_lu.drop_duplicates('Condition ID').set_index('Condition ID')
+    conditions = np.asarray(condition_mapper.active_conditions)[priority_order]
+
+    rules = pd.DataFrame({
+        'Condition ID': conditions,
+        'Priority Rank': rank[priority_order] + 1,
+        'LASAM Mode': condition_lu['LASAM Mode'].reindex(conditions).to_numpy(),
+    })
+    return mapped_df, ExplainIndex(
+        'conditions', id_col, row_ids, sparse.csr_matrix(hits[row_order][:, priority_order]), rules, get_allocation(mapped_df, row_ids, id_col)
+    )
+
+
+def build_explain_index(mapper, caa_df: pd.DataFrame, mode_condition_lu: pd.DataFrame = None, airport=None, id_col: str = 'Row_ID') -> ExplainIndex:
+    """
+    Map survey rows and keep only the explain index of the run, see map_and_explain.
+
+    The V4 conditions are mapped with arrow_backend, short-circuited and with the duplicates counted, so that the
+    'Mode Process Check' of each row is kept.
+    """
+    backend, run_kwargs = ('arrow', {'short_circuit': True, 'count_conditions': True}) if hasattr(mapper, 'get_condition_priority_order') else ('pandas', {})
+    return map_and_explain(mapper, caa_df, mode_condition_lu, airport, id_col, backend, **run_kwargs)[1]
+
+
+###################
+##### STORAGE #####
+###################
+
+def get_frame_arrays(prefix: str, df: pd.DataFrame) -> dict[str, np.ndarray]:
+    # Arrays of a DataFrame for np.savez: numbers as they are, anything else as integer codes and string labels
+    arrays = {f'{prefix}_columns': np.asarray(df.columns, dtype=str)}
+    for i, column in enumerate(df.columns):
+        values = regression_utils.normalise_column(df[column])
+        if values.dtype == object:
+            codes, labels = pd.factorize(values)
+            arrays[f'{prefix}_{i}_codes'] = codes.astype(np.int32)
+            arrays[f'{prefix}_{i}_labels'] = np.asarray(labels, dtype=str)
+        else:
+            arrays[f'{prefix}_{i}_values'] = values.to_numpy()
+    return arrays
+
+
+def read_frame_arrays(prefix: str, index_file) -> pd.DataFrame:
+    # DataFrame of the arrays written by get_frame_arrays
+    df = pd.DataFrame()
+    for i, column in enumerate(index_file[f'{prefix}_columns']):
+        if f'{prefix}_{i}_values' in index_file:
+            df[column] = index_file[f'{prefix}_{i}_values']
+        else:
+            labels = index_file[f'{prefix}_{i}_labels'].astype(object)
+            codes = index_file[f'{prefix}_{i}_codes']
+            df[column] = np.where(codes >= 0, labels[codes.clip(min=0)] if len(labels) else None, None)
+    return df
+
+
+def write_explain_index(path: str, explain_index: ExplainIndex):
+    """
+    Write an explain index to a compressed NumPy .npz file.
+
+    The hits are stored as the CSR index arrays (one int32 per rule met), the allocation and rule columns as codes and
+    labels, and the step codes as int16, so the file is a few bytes per row.
+    """
+    arrays = {
+        'kind': np.asarray(explain_index.kind), 'id_col': np.asarray(explain_index.id_col), 'row_ids': explain_index.row_ids,
+        'indptr': explain_index.hits.indptr.astype(np.int64), 'indices': explain_index.hits.indices.astype(np.int32),
+        'n_rules': np.asarray(explain_index.shape[1]),
+    }
+    arrays.update(get_frame_arrays('rules', explain_index.rules))
+    arrays.update(get_frame_arrays('allocation', explain_index.allocation))
+    if explain_index.kind == 'steps':
+        arrays['step_codes'], arrays['modes'] = explain_index.step_codes, np.asarray(explain_index.modes, dtype=str)
+
+    np.savez_compressed(path, **arrays)
+
+
+def read_explain_index(path: str) -> ExplainIndex:
+    # Explain index of a file written by write_explain_index
+    with np.load(path, allow_pickle=False) as index_file:
+        row_ids = index_file['row_ids']
+        indices = index_file['indices']
+        hits = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=bool), indices, index_file['indptr']), shape=(len(row_ids), int(index_file['n_rules']))
+        )
+        kind = str(index_file['kind'])
+        steps = {'step_codes': index_file['step_codes'], 'modes': index_file['modes']} if kind == 'steps' else {}
+
+        return ExplainIndex(
+            kind, str(index_file['id_col']), row_ids, hits, read_frame_arrays('rules', index_file),
+            read_frame_arrays('allocation', index_file), **steps
+        )
@@ -0,0 +1,77 @@
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+##########################
+##### AIRPORT RUNNER #####
+##########################
+
+def load_mapper_lookup(mapper) -> pd.DataFrame:
+    # The mode condition lookup of a mapper class, read by its module's load_mode_condition_lu
+    return sys.modules[mapper.__module__].load_mode_condition_lu()
+
+
+def map_partition(mapper, partition_df: pd.DataFrame, mode_condition_lu: pd.DataFrame, airport=None, run_kwargs: dict = None) -> pd.DataFrame:
+    """
+    Map one partition of the survey. Runs in a worker process, so the lookup is passed in rather than read again.
+
+    Mappers with airport specific conditions (an airport_conditions attribute) are given the airport of the partition,
+    so that the conditions which cannot apply there are pruned.
+    """
+    mapper_kwargs = {'mode_condition_lu': mode_condition_lu}
+    if airport is not None and hasattr(mapper, 'airport_conditions'):
+        mapper_kwargs['airport'] = airport
+
+    return mapper(partition_df, **mapper_kwargs).main_run_all(**(run_kwargs or {}))
+
+
+def run_by_airport(mapper, caa_df: pd.DataFrame, mode_condition_lu: pd.DataFrame = None, max_workers: int = None, **run_kwargs) -> pd.DataFrame:
+    """
+    Map a multi-airport CAA extract by partitioning it on AIRPORT_Prefix and mapping the airports concurrently.
+
+    Parameters
+    ----------
+    mapper : type
+        A ModeConditionMapper class, e.g. ModeConditionMapperV4_Corrected.
+    caa_df : pd.DataFrame
+        Prepared CAA survey data for any number of airports.
+    mode_condition_lu : pd.DataFrame, optional
+        Mode condition lookup of the mapper. It is read once here if not given, and passed to every worker.
+    max_workers : int, optional
+        Number of worker processes. Defaults to one per airport, up to the number of CPUs. With 1, the airports are
+        mapped one after the other in this process.
+    **run_kwargs
+        Passed on to main_run_all, e.g. short_circuit=True.
+
+    Returns
+    -------
+    pd.DataFrame
+        The mapped rows of all airports.
+    """
+    mode_condition_lu = mode_condition_lu if mode_condition_lu is not None else load_mapper_lookup(mapper)
+
+    # Largest airport first, so that it is not left running on its own at the end
+    partitions = sorted(caa_df.groupby('AIRPORT_Prefix', dropna=False, sort=False), key=lambda partition: -len(partition[1]))
+    airports = [None if pd.isna(airport) else airport for airport, _ in partitions]
+
+    start = time.time()
+
+    if max_workers == 1 or len(partitions) == 1:
+        mapped = [
+            map_partition(mapper, partition_df, mode_condition_lu, airport, run_kwargs)
+            for airport, (_, partition_df) in zip(airports, partitions)
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(map_partition, mapper, partition_df, mode_condition_lu, airport, run_kwargs)
+                for airport, (_, partition_df) in zip(airports, partitions)
+            ]
+            mapped = [future.result() for future in futures]
+
+    print(f'mapped {len(caa_df)} rows for {len(partitions)} airports in {time.time() - start:.1f}s: ' +
+          ', '.join(f'{airport} ({len(partition_df)})' for airport, (_, partition_df) in zip(airports, partitions)))
+
+    return pd.concat(mapped, ignore_index=True)
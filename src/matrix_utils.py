@@ -0,0 +1,303 @@
+import os
+
+import pandas as pd
+import numpy as np
+from scipy import sparse
+
+#######################
+##### BASE MATRIX #####
+#######################
+
+def get_lasam_mode_code_column(mapped_df: pd.DataFrame) -> str:
+    # V4 mappers output 'LASAM Mode Code', V5 and later 'LASAM_Mode_Code'
+    return 'LASAM_Mode_Code' if 'LASAM_Mode_Code' in mapped_df.columns else 'LASAM Mode Code'
+
+
+def get_axis_codes(values: pd.Series, labels=None) -> tuple[np.ndarray, pd.Index]:
+    """
+    Integer code of each value along a matrix axis.
+
+    If labels are given (e.g. every LASAM zone) the axis has exactly those labels and values not in them are coded -1,
+    otherwise the axis is the sorted distinct values.
+    """
+    if labels is None:
+        codes, labels = pd.factorize(values, sort=True)
+        return codes, pd.Index(np.asarray(labels))
+
+    labels = pd.Index(labels)
+    return labels.get_indexer(values), labels
+
+
+class SurveyMatrix:
+    """
+    Weight (POP) of the survey by zone, segment and LASAM mode code, as a dense array with the labels of each axis.
+
+    values[z, s, m] is the weight of zone zones[z], segment segments[s] and mode modes[m].
+    """
+    def __init__(self, values: np.ndarray, zones: pd.Index, segments: pd.Index, modes: pd.Index):
+        self.values = values
+        self.zones = zones
+        self.segments = segments
+        self.modes = modes
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def get(self, segment, mode) -> pd.Series:
+        # Weight by zone of one segment and mode
+        return pd.Series(self.values[:, self.segments.get_loc(segment), self.modes.get_loc(mode)], index=self.zones)
+
+    def to_frame(self) -> pd.DataFrame:
+        # Non-zero cells as a long DataFrame
+        zone, segment, mode = np.nonzero(self.values)
+        return pd.DataFrame({
+            'Zone': self.zones[zone], 'Segment': self.segments[segment], 'Mode': self.modes[mode],
+            'Value': self.values[zone, segment, mode]
+        })
+
+
+def build_survey_matrix(mapped_df: pd.DataFrame, zones=None, segments=None, modes=None, zone_col: str = 'LASAM_Zone',
+                        segment_col: str = 'Segment_4_ID', mode_col: str = None, weight_col: str = 'POP') -> SurveyMatrix:
+    """
+    Accumulate the weight of mapped survey rows into a zone x segment x mode array.
+
+    Each row's zone, segment and mode are integer coded and combined into one flat cell index, and the weights of all
+    rows are summed per cell with a single np.bincount.
+
+    Parameters
+    ----------
+    mapped_df : pd.DataFrame
+        Mapper output with a zone, segment and LASAM mode code per row.
+    zones, segments, modes : list-like, optional
+        Labels of each axis, e.g. every zone of lasam_zone_district_lu so that zones without survey rows are included.
+        Rows with a value that is not in the labels are left out. Defaults to the distinct values of the data.
+    zone_col : str, optional
+        Column with the zone of each row. Use 'SYSTEM_District' for a district matrix.
+    segment_col : str, optional
+        Column with the segment of each row.
+    mode_col : str, optional
+        Column with the LASAM mode code of each row. Defaults to the LASAM mode code column of the mapper output.
+    weight_col : str, optional
+        Column with the weight of each row.
+
+    Returns
+    -------
+    SurveyMatrix
+        The summed weights with the labels of each axis.
+    """
+    mode_col = mode_col if mode_col is not None else get_lasam_mode_code_column(mapped_df)
+
+    zone_codes, zones = get_axis_codes(mapped_df[zone_col], zones)
+    segment_codes, segments = get_axis_codes(mapped_df[segment_col], segments)
+    mode_codes, modes = get_axis_codes(mapped_df[mode_col], modes)
+
+    weight = mapped_df[weight_col].to_numpy(dtype=float)
+    shape = (len(zones), len(segments), len(modes))
+
+    # Rows without a zone, segment or mode (e.g. 'Not Assigned - Data') have no cell
+    valid = (zone_codes >= 0) & (segment_codes >= 0) & (mode_codes >= 0)
+    if not valid.all():
+        print(f'{(~valid).sum()} rows with {weight[~valid].sum():.1f} {weight_col} have no {zone_col}, {segment_col} or {mode_col} on the matrix axes')
+
+    cells = np.ravel_multi_index((zone_codes[valid], segment_codes[valid], mode_codes[valid]), shape)
+    values = np.bincount(cells, weights=weight[valid], minlength=int(np.prod(shape))).reshape(shape)
+
+    return SurveyMatrix(values, zones, segments, modes)
+
+
+##########################
+##### DISAGGREGATION #####
+##########################
+
+def get_district_zone_split(zone_district_lu: pd.DataFrame, districts=None, zones=None, district_col: str = 'SYSTEM_District',
+                            zone_col: str = 'LASAM_Zone', split_col: str = None) -> tuple[sparse.csr_matrix, pd.Index, pd.Index]:
+    """
+    Get the share of each district that goes to each zone as a sparse district x zone matrix.
+
+    Parameters
+    ----------
+    zone_district_lu : pd.DataFrame
+        Lookup with one row per zone and district pair, e.g. config.lasam_zone_district_lu.
+    districts, zones : list-like, optional
+        Labels of the matrix rows and columns. Default to the distinct values of the lookup.
+    district_col, zone_col : str, optional
+        Columns of the lookup with the district and the zone.
+    split_col : str, optional
+        Column with the weight of each zone within its district (e.g. population). If not given, a district is split
+        equally between its zones.
+
+    Returns
+    -------
+    tuple[sparse.csr_matrix, pd.Index, pd.Index]
+        The split, whose rows sum to 1 (or 0 for districts without zones), and the district and zone labels.
+    """
+    zone_district_lu = zone_district_lu.dropna(subset=[district_col, zone_col])
+
+    district_codes, districts = get_axis_codes(zone_district_lu[district_col], districts)
+    zone_codes, zones = get_axis_codes(zone_district_lu[zone_col], zones)
+    weight = zone_district_lu[split_col].to_numpy(dtype=float) if split_col is not None else np.ones(len(zone_district_lu))
+
+    on_axes = (district_codes >= 0) & (zone_codes >= 0)
+    split = sparse.csr_matrix(
+        (weight[on_axes], (district_codes[on_axes], zone_codes[on_axes])), shape=(len(districts), len(zones))
+    )
+
+    # Normalise each district's row to 1
+    district_totals = np.asarray(split.sum(axis=1)).ravel()
+    scale = np.divide(1, district_totals, out=np.zeros_like(district_totals), where=district_totals > 0)
+    split = sparse.diags(scale) @ split
+
+    return split.tocsr(), districts, zones
+
+
+def disaggregate_to_zones(district_matrix: SurveyMatrix, zone_district_lu: pd.DataFrame, zones=None, district_col: str = 'SYSTEM_District',
+                          zone_col: str = 'LASAM_Zone', split_col: str = None) -> SurveyMatrix:
+    """
+    Distribute a district x segment x mode matrix to zones with one sparse matrix product.
+
+    The survey rows are not merged with the zone lookup, so memory does not grow with the number of zones per district.
+
+    Parameters
+    ----------
+    district_matrix : SurveyMatrix
+        Matrix by district, e.g. build_survey_matrix(mapped_df, zone_col='SYSTEM_District').
+    zone_district_lu : pd.DataFrame
+        Lookup with one row per zone and district pair, see get_district_zone_split.
+    zones : list-like, optional
+        Zone labels of the result. Default to the zones of the lookup.
+    district_col, zone_col, split_col : str, optional
+        Columns of the lookup, see get_district_zone_split.
+
+    Returns
+    -------
+    SurveyMatrix
+        The matrix by zone, with the segments and modes of the district matrix.
+    """
+    split, districts, zones = get_district_zone_split(zone_district_lu, district_matrix.zones, zones, district_col, zone_col, split_col)
+
+    unsplit = np.asarray(split.sum(axis=1)).ravel() == 0
+    if unsplit.any():
+        print(f'{unsplit.sum()} districts with {district_matrix.values[unsplit].sum():.1f} weight have no zones: {districts[unsplit].tolist()}')
+
+    n_districts, n_segments, n_modes = district_matrix.shape
+    values = split.T @ district_matrix.values.reshape(n_districts, n_segments * n_modes)
+
+    return SurveyMatrix(np.asarray(values).reshape(len(zones), n_segments, n_modes), zones, district_matrix.segments, district_matrix.modes)
+
+
+##################
+##### EXPORT #####
+##################
+
+def get_export_tables(matrix: SurveyMatrix, segment_mode_index_lu: pd.DataFrame, segment_col: str = 'Segment_4_ID',
+                      mode_col: str = 'LASAM_Mode_Code', table_col: str = 'Index') -> tuple[np.ndarray, np.ndarray]:
+    """
+    Arrange the segment and mode slices of a matrix as numbered tables.
+
+    Parameters
+    ----------
+    matrix : SurveyMatrix
+        Zone x segment x mode matrix.
+    segment_mode_index_lu : pd.DataFrame
+        Lookup with the table number of each segment and mode, e.g. config.cube_segment_mode_index_lu.
+    segment_col, mode_col, table_col : str, optional
+        Columns of the lookup with the segment, the LASAM mode code and the table number.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The table numbers in ascending order, and the tables as a zone x table array.
+    """
+    index_lu = segment_mode_index_lu.sort_values(table_col)
+
+    segment_codes = matrix.segments.get_indexer(index_lu[segment_col])
+    mode_codes = matrix.modes.get_indexer(index_lu[mode_col])
+    in_matrix = (segment_codes >= 0) & (mode_codes >= 0)
+
+    # Weight in segments and modes without a table would be lost from the export
+    has_table = np.zeros(matrix.shape[1:], dtype=bool)
+    has_table[segment_codes[in_matrix], mode_codes[in_matrix]] = True
+    untabled = matrix.values[:, ~has_table].sum()
+    if untabled > 0:
+        print(f'{untabled:.1f} weight is in segments and modes without a table in the index lookup')
+
+    tables = np.zeros((matrix.shape[0], len(index_lu)))
+    tables[:, in_matrix] = matrix.values[:, segment_codes[in_matrix], mode_codes[in_matrix]]
+
+    return index_lu[table_col].to_numpy(), tables
+
+
+def get_binary_index_paths(path: str) -> tuple[str, str]:
+    # Table and zone index CSV files written next to a binary matrix file, e.g. lhr.bin -> lhr_tables.csv, lhr_zones.csv
+    stem = os.path.splitext(path)[0]
+    return f'{stem}_tables.csv', f'{stem}_zones.csv'
+
+
+def write_matrix_binary(path: str, matrix: SurveyMatrix, segment_mode_index_lu: pd.DataFrame, **index_cols):
+    """
+    Write the tables of a matrix to a headerless binary file with fixed length records, for a CUBE script to read.
+
+    The file holds one record per table in ascending table number order, each record the little-endian float32 value
+    of every zone in zone order (4 bytes x number of zones), and nothing else. Two CSV files are written next to it:
+    <stem>_tables.csv with the 'Record' (from 1), 'Table' number and byte 'Offset' of each table, and <stem>_zones.csv
+    with the 'Zone' of each value within a record. index_cols are the lookup column names, see get_export_tables.
+    """
+    table_numbers, tables = get_export_tables(matrix, segment_mode_index_lu, **index_cols)
+    zones = np.asarray(matrix.zones)
+
+    np.ascontiguousarray(tables.T, dtype='<f4').tofile(path)
+
+    tables_path, zones_path = get_binary_index_paths(path)
+    pd.DataFrame({
+        'Record': np.arange(1, len(table_numbers) + 1), 'Table': table_numbers,
+        'Offset': np.arange(len(table_numbers)) * len(zones) * 4
+    }).to_csv(tables_path, index=False)
+    pd.DataFrame({'Zone': zones}).to_csv(zones_path, index=False)
+
+
+def read_matrix_binary(path: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # zones, table numbers and table x zone values of a file written by write_matrix_binary
+    tables_path, zones_path = get_binary_index_paths(path)
+    zones = pd.read_csv(zones_path)['Zone'].to_numpy()
+    table_numbers = pd.read_csv(tables_path)['Table'].to_numpy()
+    return zones, table_numbers, np.fromfile(path, dtype='<f4').reshape(len(table_numbers), len(zones))
+
+
+def write_matrix_npz(path: str, matrix: SurveyMatrix, segment_mode_index_lu: pd.DataFrame, **index_cols):
+    """
+    Write the tables of a matrix to a compressed NumPy .npz file, to be read back in Python with read_matrix_npz.
+
+    The file holds 'zones', 'tables' (the table numbers) and 'values', the float32 table x zone array of
+    write_matrix_binary. index_cols are the lookup column names, see get_export_tables.
+    """
+    table_numbers, tables = get_export_tables(matrix, segment_mode_index_lu, **index_cols)
+
+    np.savez_compressed(
+        path, zones=np.asarray(matrix.zones), tables=table_numbers, values=np.ascontiguousarray(tables.T, dtype=np.float32)
+    )
+
+
+def read_matrix_npz(path: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # zones, table numbers and table x zone values of a file written by write_matrix_npz
+    with np.load(path, allow_pickle=False) as matrix_file:
+        return matrix_file['zones'], matrix_file['tables'], matrix_file['values']
+
+
+def write_matrix_csv(path: str, matrix: SurveyMatrix, segment_mode_index_lu: pd.DataFrame, float_format: str = '%.6f', **index_cols):
+    """
+    Write the tables of a matrix to a CSV file with one row per zone and one column per table ('Zone', 'T<number>', ...).
+
+    The zone x table array is written with one np.savetxt call, so the cost grows with the zones rather than with a
+    loop over the tables. index_cols are the lookup column names, see get_export_tables.
+    """
+    table_numbers, tables = get_export_tables(matrix, segment_mode_index_lu, **index_cols)
+
+    zones = np.asarray(matrix.zones)
+    if np.issubdtype(zones.dtype, np.integer):
+        zone_format, rows = '%d', np.column_stack([zones, tables])
+    else:
+        zone_format, rows = '%s', np.column_stack([zones.astype(object), tables])
+
+    header = ','.join(['Zone'] + [f'T{table}' for table in table_numbers])
+    np.savetxt(path, rows, fmt=[zone_format] + [float_format] * len(table_numbers), delimiter=',', header=header, comments='')
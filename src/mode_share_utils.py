@@ -0,0 +1,429 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+
+#######################
+##### MODE SHARES #####
+#######################
+
+def get_lasam_mode_column(caa_df: pd.DataFrame) -> str:
+    # V4 mappers output 'LASAM Mode', V5 and later 'LASAM_Mode'
+    return 'LASAM_Mode' if 'LASAM_Mode' in caa_df.columns else 'LASAM Mode'
+
+
+def get_column_codes(values: pd.Series) -> tuple[np.ndarray, pd.Index]:
+    # Integer codes and labels of a column, using the codes of categorical columns directly. Missing values are -1
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy(), pd.Index(values.cat.categories)
+
+    codes, labels = pd.factorize(values, sort=True)
+    return codes, pd.Index(labels)
+
+
+def weighted_crosstab(caa_df: pd.DataFrame, columns: list[str], weight_col: str = 'POP') -> pd.Series:
+    """
+    Weighted N-way contingency table of the given columns, holding only the cells that have rows.
+
+    The columns are integer coded (categorical columns use their codes) and combined into one cell code per row, and
+    the weights are summed per cell with np.bincount. Tables with more cells than rows are not allocated in full:
+    their occupied cells are found with np.unique first. Rows with a missing value in any of the columns are left out,
+    as in a groupby.
+
+    Parameters
+    ----------
+    caa_df : pd.DataFrame
+        CAA survey data, mapped or not.
+    columns : list[str]
+        Columns to cross-tabulate, e.g. ['SYSTEM_FINALMODE', 'LASAM_Mode', 'Origin', 'Terminal'].
+    weight_col : str, optional
+        Column with the weight of each row.
+
+    Returns
+    -------
+    pd.Series
+        Total weight of each occupied cell, indexed by a MultiIndex of the columns.
+    """
+    column_codes, labels = zip(*[get_column_codes(caa_df[column]) for column in columns])
+    column_codes = np.vstack(column_codes)
+    shape = tuple(len(column_labels) for column_labels in labels)
+
+    complete = (column_codes >= 0).all(axis=0)
+    cells = np.ravel_multi_index(column_codes[:, complete], shape)
+    weight = caa_df[weight_col].to_numpy(dtype=float)[complete]
+
+    if np.prod(shape, dtype=float) <= max(len(cells), 2 ** 20):
+        # Small tables are counted densely, then reduced to the occupied cells
+        occupied = np.flatnonzero(np.bincount(cells, minlength=int(np.prod(shape))))
+        weights = np.bincount(cells, weights=weight, minlength=int(np.prod(shape)))[occupied]
+    else:
+        occupied, cell_codes = np.unique(cells, return_inverse=True)
+        weights = np.bincount(cell_codes, weights=weight, minlength=len(occupied))
+
+    index = pd.MultiIndex(levels=labels, codes=np.unravel_index(occupied, shape), names=columns)
+    return pd.Series(weights, index=index, name=weight_col)
+
+
+def get_unique_lookup(lookup: pd.Series) -> pd.Series:
+    # Lookup with each key once: repeated key and value pairs (e.g. from set_index on a lookup table) are dropped,
+    # and keys with different values raise, as Series.map needs unique keys
+    if lookup.index.is_unique:
+        return lookup
+
+    pairs = pd.DataFrame({'key': lookup.index, 'value': lookup.to_numpy()}).drop_duplicates()
+    conflicting = pairs.loc[pairs['key'].duplicated(), 'key'].unique()
+    if len(conflicting) > 0:
+        raise ValueError(f'lookup {lookup.name} has different values for {len(conflicting)} keys, e.g. {conflicting[:5].tolist()}')
+
+    return pd.Series(pairs['value'].to_numpy(), index=pd.Index(pairs['key'], name=lookup.index.name), name=lookup.name)
+
+
+def get_mode_summary(caa_df: pd.DataFrame, columns: list[str], weight_col: str = 'POP', lookups: dict[str, pd.Series] = None) -> pd.DataFrame:
+    """
+    Get the total weight and percentage share of each combination of the columns, from a weighted crosstab.
+
+    For example, with caa_lhr a prepared survey and caa_lhr_mapped its mapper output:
+        get_mode_summary(caa_lhr, ['SYSTEM_FINALMODE'])
+        get_mode_summary(caa_lhr, ['SYSTEM_FINALMODE'], lookups={'SYSTEM_FINALMODE': lu.set_index('Mode_Allocated')['LASAM_Mode']})
+        get_mode_summary(caa_lhr_mapped, [get_lasam_mode_column(caa_lhr_mapped), 'Origin', 'Terminal'])
+
+    Parameters
+    ----------
+    caa_df : pd.DataFrame
+        CAA survey data, mapped or not.
+    columns : list[str]
+        Columns to summarise by.
+    weight_col : str, optional
+        Column with the weight of each row.
+    lookups : dict[str, pd.Series], optional
+        Recode a column with a lookup Series indexed by its values. The column is replaced by one named after the
+        Series. Values not in the lookup are left out, as in an inner merge. The lookup is applied to the labels of
+        the crosstab, not to the rows. Repeated keys with the same value are allowed, a key with different values
+        raises a ValueError.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per combination with the total weight and 'prop', the share in percent.
+    """
+    summary_df = weighted_crosstab(caa_df, columns, weight_col).reset_index()
+
+    if lookups:
+        for column, lookup in lookups.items():
+            lookup = get_unique_lookup(lookup)
+            summary_df[column] = summary_df[column].map(lookup)
+            summary_df = summary_df.rename(columns={column: lookup.name}).dropna(subset=[lookup.name])
+
+        summary_columns = [lookups[column].name if column in lookups else column for column in columns]
+        summary_df = summary_df.groupby(summary_columns, as_index=False)[weight_col].sum()
+
+    summary_df['prop'] = summary_df[weight_col] / summary_df[weight_col].sum() * 100
+    return summary_df
+
+
+def get_mode_share_summary(caa_df: pd.DataFrame, mode_col: str = None, weight_col: str = 'POP') -> pd.DataFrame:
+    """
+    Get the total weight and the percentage share of each mode.
+
+    Parameters
+    ----------
+    caa_df : pd.DataFrame
+        Mapped CAA survey data.
+    mode_col : str, optional
+        Column with the modes. Defaults to the LASAM mode column of the mapper output.
+    weight_col : str, optional
+        Column with the weight of each row.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per mode with the total weight and 'prop', the share in percent.
+    """
+    mode_col = mode_col if mode_col is not None else get_lasam_mode_column(caa_df)
+
+    return get_mode_summary(caa_df, [mode_col], weight_col)
+
+
+###################
+##### PREVIEW #####
+###################
+
+PREVIEW_STRATA = ['SYSTEM_FINALMODE', 'Origin', 'Terminal']
+
+
+def get_stratified_sample(caa_df: pd.DataFrame, sample_size: int, strata: list[str] = PREVIEW_STRATA, weight_col: str = 'POP', seed=None) -> pd.DataFrame:
+    """
+    Draw a stratified random sample of the survey, allocated to the strata in proportion to their weight.
+
+    Each stratum gets round(sample_size * stratum weight / total weight) rows, at least one and at most all of its rows,
+    drawn at random without replacement. The sample size is therefore close to, but not exactly, sample_size.
+
+    Parameters
+    ----------
+    caa_df : pd.DataFrame
+        CAA survey data.
+    sample_size : int
+        Target number of rows in the sample.
+    strata : list[str], optional
+        Columns defining the strata.
+    weight_col : str, optional
+        Column with the weight of each row, used to allocate the sample.
+    seed : int or np.random.Generator, optional
+        Seed of the random draw.
+
+    Returns
+    -------
+    pd.DataFrame
+        The sampled rows with two extra columns: 'Stratum', an integer stratum id, and 'Sample_Weight', the number of
+        survey rows each sampled row stands for (rows in the stratum / rows sampled from it).
+    """
+    rng = np.random.default_rng(seed)
+
+    stratum = caa_df.groupby(strata, dropna=False, sort=False).ngroup().to_numpy()
+    stratum_rows = np.bincount(stratum)
+    stratum_weight = np.bincount(stratum, weights=caa_df[weight_col].to_numpy(dtype=float))
+
+    allocation = np.rint(sample_size * stratum_weight / stratum_weight.sum()).astype(int)
+    allocation = np.clip(allocation, 1, stratum_rows)
+
+    # Shuffle the rows, then keep the first allocation[h] rows of each stratum h
+    order = rng.permutation(len(caa_df))
+    order = order[np.argsort(stratum[order], kind='stable')]
+    rank = np.arange(len(order)) - np.repeat(np.cumsum(stratum_rows) - stratum_rows, stratum_rows)
+    sampled = np.sort(order[rank < allocation[stratum[order]]])
+
+    sample_df = caa_df.iloc[sampled].copy()
+    sample_df['Stratum'] = stratum[sampled]
+    sample_df['Sample_Weight'] = stratum_rows[stratum[sampled]] / allocation[stratum[sampled]]
+    return sample_df
+
+
+def get_sample_mode_shares(sample_df: pd.DataFrame, mode_col: str = None, weight_col: str = 'POP', z: float = 1.96) -> pd.DataFrame:
+    """
+    Estimate the mode shares of the full survey from a mapped stratified sample, with sampling error bounds.
+
+    The shares are ratio estimates (estimated weight of the mode / estimated total weight). Their standard errors are
+    linearisation estimates for stratified sampling without replacement. Strata with a single sampled row are given
+    the pooled within-stratum variance of the other strata. Rows without a mode are left out of the shares and of the
+    total, as in get_mode_share_summary.
+
+    Parameters
+    ----------
+    sample_df : pd.DataFrame
+        Mapped sample with the 'Stratum' and 'Sample_Weight' columns of get_stratified_sample.
+    mode_col : str, optional
+        Column with the modes. Defaults to the LASAM mode column of the mapper output.
+    weight_col : str, optional
+        Column with the weight of each row.
+    z : float, optional
+        Normal quantile of the bounds, 1.96 for 95% bounds.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per mode with the estimated weight, 'prop', its standard error 'se' and the bounds 'lower' and 'upper',
+        all in percent.
+    """
+    mode_col = mode_col if mode_col is not None else get_lasam_mode_column(sample_df)
+
+    mode_codes, modes = pd.factorize(sample_df[mode_col], sort=True)
+    modes = np.asarray(modes, dtype=object)
+    # Rows without a mode (code -1) weigh nothing, so they are in neither a mode nor the total
+    has_mode = mode_codes >= 0
+    weight = np.where(has_mode, sample_df[weight_col].to_numpy(dtype=float), 0)
+    expansion = sample_df['Sample_Weight'].to_numpy(dtype=float)
+    stratum = sample_df['Stratum'].to_numpy()
+
+    # Weight of each sampled row by mode, one column per mode
+    mode_weight = np.zeros((len(sample_df), len(modes)))
+    mode_weight[np.flatnonzero(has_mode), mode_codes[has_mode]] = weight[has_mode]
+
+    total = (expansion * weight).sum()
+    mode_total = expansion @ mode_weight
+    share = mode_total / total
+
+    # Linearised variable of the ratio estimator, then its stratified variance
+    residual = (mode_weight - weight[:, None] * share) / total
+    residual_df = pd.DataFrame(residual).groupby(stratum)
+    sampled_rows = residual_df.size().to_numpy()
+    stratum_rows = pd.Series(expansion).groupby(stratum).first().to_numpy() * sampled_rows
+
+    # A single sampled row gives no variance estimate, so those strata take the pooled variance of the others
+    stratum_variance = residual_df.var(ddof=1).to_numpy()
+    singleton = sampled_rows < 2
+    if singleton.any():
+        pooled_variance = np.average(stratum_variance[~singleton], axis=0, weights=sampled_rows[~singleton] - 1) if (~singleton).any() else 0
+        stratum_variance[singleton] = pooled_variance
+    finite_population = (1 - sampled_rows / stratum_rows)[:, None]
+    variance = (stratum_rows[:, None] ** 2 * finite_population * stratum_variance / sampled_rows[:, None]).sum(axis=0)
+    se = np.sqrt(variance)
+
+    return pd.DataFrame({
+        mode_col: modes,
+        weight_col: mode_total,
+        'prop': share * 100,
+        'se': se * 100,
+        'lower': np.clip(share - z * se, 0, 1) * 100,
+        'upper': np.clip(share + z * se, 0, 1) * 100,
+    })
+
+
+def preview_mode_shares(mapper, caa_df: pd.DataFrame, sample_size: int = 2000, strata: list[str] = PREVIEW_STRATA,
+                        weight_col: str = 'POP', seed=None, mapper_kwargs: dict = None, **run_kwargs) -> pd.DataFrame:
+    """
+    Preview the mode shares of a mapper by mapping a stratified sample of the survey instead of all of it.
+
+    Parameters
+    ----------
+    mapper : type
+        A ModeConditionMapper class, e.g. ModeConditionMapperV6.
+    caa_df : pd.DataFrame
+        Prepared CAA survey data, as passed to the mapper.
+    sample_size : int, optional
+        Target number of rows to map.
+    strata : list[str], optional
+        Columns defining the strata of the sample.
+    weight_col : str, optional
+        Column with the weight of each row.
+    seed : int or np.random.Generator, optional
+        Seed of the sample.
+    mapper_kwargs : dict, optional
+        Passed on to the mapper constructor, e.g. a preloaded mode_condition_lu.
+    **run_kwargs
+        Passed on to main_run_all.
+
+    Returns
+    -------
+    pd.DataFrame
+        Estimated mode shares with sampling error bounds, see get_sample_mode_shares.
+    """
+    sample_df = get_stratified_sample(caa_df, sample_size, strata, weight_col, seed)
+    mapped_df = mapper(sample_df, **(mapper_kwargs or {})).main_run_all(**run_kwargs)
+
+    print(f'Preview: mapped {len(sample_df)} of {len(caa_df)} rows in {sample_df["Stratum"].nunique()} strata')
+    return get_sample_mode_shares(mapped_df, weight_col=weight_col)
+
+
+#####################
+##### BOOTSTRAP #####
+#####################
+
+def _bootstrap_batch(mode_weight: np.ndarray, n_replicates: int, seed: np.random.SeedSequence) -> np.ndarray:
+    # Mode shares of n_replicates resamples of the rows: each row of counts is how often each survey row was drawn
+    rng = np.random.default_rng(seed)
+    n_rows = len(mode_weight)
+
+    # Multinomial counts, drawn as n_rows row indices per replicate and counted with one bincount for the whole batch
+    draws = rng.integers(0, n_rows, size=(n_replicates, n_rows))
+    draws += (np.arange(n_replicates) * n_rows)[:, None]
+    counts = np.bincount(draws.ravel(), minlength=n_replicates * n_rows).reshape(n_replicates, n_rows).astype(np.float32)
+    mode_totals = counts @ mode_weight
+    return mode_totals / mode_totals.sum(axis=1, keepdims=True)
+
+
+def get_bootstrap_shares(caa_df: pd.DataFrame, mode_col: str = None, weight_col: str = 'POP', n_replicates: int = 2000,
+                         batch_size: int = 200, seed=None, max_workers: int = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Bootstrap the mode shares of mapped survey data.
+
+    Each replicate draws len(caa_df) rows with replacement and takes the weighted mode shares of the draw. The draws are
+    made as multinomial counts per row, in batches of batch_size replicates, and multiplied with the weight of each row
+    by mode, so no data is copied per replicate. Each batch has its own seed spawned from seed, so the replicates are
+    the same whether or not they are spread across processes.
+
+    Parameters
+    ----------
+    caa_df : pd.DataFrame
+        Mapped CAA survey data.
+    mode_col : str, optional
+        Column with the modes. Defaults to the LASAM mode column of the mapper output.
+    weight_col : str, optional
+        Column with the weight of each row.
+    n_replicates : int, optional
+        Number of bootstrap replicates.
+    batch_size : int, optional
+        Replicates drawn at once. Memory use is about batch_size * len(caa_df) * 28 bytes.
+    seed : int, optional
+        Seed of the resampling.
+    max_workers : int, optional
+        Number of processes to spread the batches over. By default the batches are run in this process.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        The modes, and the replicate shares as an array of n_replicates rows by mode.
+    """
+    mode_col = mode_col if mode_col is not None else get_lasam_mode_column(caa_df)
+
+    mode_codes, modes = pd.factorize(caa_df[mode_col], sort=True)
+    modes = np.asarray(modes, dtype=object)
+
+    # Rows without a mode keep a weight of zero, so like get_mode_share_summary the shares are of the mapped rows
+    mapped = mode_codes >= 0
+    mode_weight = np.zeros((len(caa_df), len(modes)), dtype=np.float32)
+    mode_weight[np.flatnonzero(mapped), mode_codes[mapped]] = caa_df[weight_col].to_numpy(dtype=float)[mapped]
+
+    batch_sizes = [min(batch_size, n_replicates - start) for start in range(0, n_replicates, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batch_sizes))
+
+    if max_workers is None or max_workers <= 1:
+        batches = [_bootstrap_batch(mode_weight, size, batch_seed) for size, batch_seed in zip(batch_sizes, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            batches = list(executor.map(_bootstrap_batch, [mode_weight] * len(batch_sizes), batch_sizes, seeds))
+
+    return modes, np.concatenate(batches)
+
+
+def get_bootstrap_mode_shares(mapped: dict[str, pd.DataFrame] | pd.DataFrame, weight_col: str = 'POP', n_replicates: int = 2000,
+                              confidence: float = 0.95, seed=None, max_workers: int = None, **bootstrap_kwargs) -> pd.DataFrame:
+    """
+    Get the mode shares of one or more mapper versions with bootstrap confidence intervals.
+
+    Parameters
+    ----------
+    mapped : dict[str, pd.DataFrame] or pd.DataFrame
+        Mapped survey data by mapper version, e.g. {'V4_Corrected': ..., 'V6': ...}, or a single mapped DataFrame.
+    weight_col : str, optional
+        Column with the weight of each row.
+    n_replicates : int, optional
+        Number of bootstrap replicates per version.
+    confidence : float, optional
+        Confidence level of the percentile intervals.
+    seed : int, optional
+        Seed of the resampling, the same for every version.
+    max_workers : int, optional
+        Number of processes to spread the replicates of each version over.
+    **bootstrap_kwargs
+        Passed on to get_bootstrap_shares, e.g. batch_size.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per version and LASAM mode with the POP share 'prop', the bootstrap standard error 'se' and the interval
+        'lower' to 'upper', all in percent.
+    """
+    if isinstance(mapped, pd.DataFrame):
+        mapped = {'': mapped}
+
+    tail = (1 - confidence) / 2
+    summaries = []
+
+    for version, caa_df in mapped.items():
+        summary_df = get_mode_share_summary(caa_df, weight_col=weight_col)
+        summary_df.columns = ['LASAM_Mode', weight_col, 'prop']
+
+        modes, shares = get_bootstrap_shares(caa_df, weight_col=weight_col, n_replicates=n_replicates, seed=seed,
+                                             max_workers=max_workers, **bootstrap_kwargs)
+        bounds = pd.DataFrame({
+            'LASAM_Mode': modes,
+            'se': shares.std(axis=0, ddof=1) * 100,
+            'lower': np.quantile(shares, tail, axis=0) * 100,
+            'upper': np.quantile(shares, 1 - tail, axis=0) * 100,
+        })
+
+        summary_df = summary_df.merge(bounds, on='LASAM_Mode', how='left')
+        summary_df.insert(0, 'Version', version)
+        summaries.append(summary_df)
+
+    return pd.concat(summaries, ignore_index=True)
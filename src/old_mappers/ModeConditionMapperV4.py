@@ -2,9 +2,10 @@ import pandas as pd
 import numpy as np
 import logging
 
+import os
 import sys
-sys.path.append('..\..')
-from src import config
+sys.path.append(os.path.join('..', '..'))
+from src import config, condition_mapping_utils
 
 logging.basicConfig(level=logging.ERROR)
 
@@ -24,26 +25,115 @@ def auto_apply_decorator(cls):
             setattr(cls, attr_name, error_handling_decorator(attr_value))
     return cls
 
+def load_mode_condition_lu():
+    """Read the mode condition lookup (once per process) with the column names used by the mapper."""
+    mode_condition_lu = condition_mapping_utils.read_lookup(config.MODE_CONDITION_MAPPING_PATH, pd.read_excel, sheet_name='Mode_Conditions', usecols = ['Condition_Id', 'LASAM_Main_Mode_2024', 'LASAM_Mode_2024', 'LASAM_Mode_Code_2024', 'LASAM_Mode_Priority_2024'])
+    mode_condition_lu.columns = ['Condition ID', 'LASAM Main Mode', 'LASAM Mode', 'LASAM Mode Code', 'LASAM Mode Priority']
+    return mode_condition_lu
+
 @auto_apply_decorator
 # Define the class
 class ModeConditionMapper:
-    def __init__(self, dataframe):
-        """Initialize with the DataFrame."""
+    # Mode groups, shared by all mapper instances
+    minicab = condition_mapping_utils.MINICAB
+    hotel_bus = condition_mapping_utils.HOTEL_BUS
+    national_coach = condition_mapping_utils.NATIONAL_COACH
+    local_bus = condition_mapping_utils.LOCAL_BUS
+    tube = condition_mapping_utils.TUBE
+    national_railways = condition_mapping_utils.NATIONAL_RAILWAYS
+    unspecified_modes = condition_mapping_utils.UNSPECIFIED_MODES
+    private_car_short_term = condition_mapping_utils.PRIVATE_CAR_SHORT_TERM
+    private_car_long_term = condition_mapping_utils.PRIVATE_CAR_LONG_TERM
+
+    # Include/exclude mode sets of the individual conditions.
+    # They are built once when the class is created rather than on every row a condition is applied to
+    condition_9_excluded_modes = national_coach | tube | local_bus | national_railways | frozenset([
+        'Airport to airport coach service', 'London bus companies', 'Bus/coach company unknown', 'Heathrow Express',
+        'Elizabeth Line', 'Stansted Express', 'Gatwick Express'
+    ])
+    condition_11_excluded_modes = national_coach | local_bus | tube | national_railways | frozenset([
+        'Airport to airport coach service', 'London bus companies', 'Bus/coach company unknown',
+        'Heathrow Express', 'Elizabeth Line', 'Gatwick Express'
+    ])
+    condition_12_excluded_modes = national_coach | national_railways
+    condition_13_excluded_modes = national_coach | local_bus | tube | national_railways | frozenset([
+        'Charter coach', 'Airport to airport coach service', 'London bus companies', 'Bus/coach company unknown',
+        'Heathrow Express', 'Elizabeth Line'
+    ])
+    condition_14_excluded_modes = national_coach | local_bus | tube | national_railways | frozenset([
+        'Airport to airport coach service', 'London bus companies', 'Bus/coach company unknown',
+        'Heathrow Express', 'Elizabeth Line', 'Stansted Express', 'Gatwick Express'
+    ])
+    condition_17_included_modes = tube | national_railways
+    condition_19_excluded_2ndlast_modes = frozenset(['Charter coach', 'Airport to airport coach service', 'Heathrow Express'])
+    condition_24_excluded_modes = tube | national_railways
+    condition_25_included_2ndlast_modes = national_coach | frozenset(['Airport to airport coach service', 'Bus/Coach company unknown'])
+    condition_25_included_3rdlast_modes = national_coach | local_bus | national_railways | minicab | frozenset([
+        'Airport to airport coach service', 'Bus/Coach company unknown', 'No Mode', 'Private car - driven away', 'Chauffer',
+        'RailAir Bus (Reading/Woking/Feltham)'
+    ])
+    condition_25_excluded_2ndlast_modes = national_railways | frozenset(['Heathrow Express'])
+    condition_29_included_last_modes = frozenset(['London bus companies']) | local_bus
+    condition_29_excluded_2ndlast_modes = national_railways | frozenset(['Heathrow Express', 'Stansted Express', 'Gatwick Express'])
+    condition_30_included_last_modes = frozenset([
+        'Boat', 'Walk (where only mode)', 'Cycle', 'Motorcycle', 'Car Unspecified', 'Bus Unspecified', 'Taxi/Minicab Unspecified',
+        'Rail Unspecified', 'Other'
+    ])
+    condition_32_excluded_2ndlast_modes = frozenset(['Charter coach']) | national_railways
+    condition_36_included_2ndlast_modes = national_railways | frozenset(['Airport to airport coach service', 'Bus/coach company unknown'])
+    condition_37_included_2ndlast_modes = local_bus | frozenset(['London bus companies'])
+    condition_44_included_2ndlast_modes = national_coach | frozenset(['Airport to airport coach service', 'Bus/coach company unknown'])
+    condition_46_included_2ndlast_modes = local_bus | frozenset(['London bus companies'])
+    condition_51_included_2ndlast_modes = national_coach | frozenset(['Airport to airport coach service', 'London bus companies'])
+    condition_52_included_2ndlast_modes = local_bus | frozenset(['London bus companies'])
+    condition_62_included_2ndlast_modes = local_bus | frozenset(['London bus companies'])
+    condition_70_included_2ndlast_modes = local_bus | frozenset(['London bus companies'])
+    condition_106_included_last_modes = national_railways | frozenset(['Rail Unspecified'])
+    # K&F, P&F or Taxi modes
+    condition_109_included_last_modes = minicab | tube | frozenset([
+        'Private car - driven away', 'Chauffer','Private car - short term car park', 'Private car - short term car park - meet/greet',
+        'Private car - valet service - Off airport', 'Private car - valet service - On airport', 'Private car - airport long term car park bus',
+        'Private car - private long term car park bus', 'Private car - business car park', 'Private car - mid stay car park bus',
+        'Private car - staff car park bus', 'Private car - hotel car park bus', 'Private car - type of car park unknown'
+        'Taxi'
+    ])
+    # Condition 100 applies to segments with a Segment_4_ID below this limit
+    condition_100_segment_limit = 2
+
+    # Conditions that only apply at some airports (AIRPORT_Prefix), pruned when mapping a single other airport
+    airport_conditions = {18: ['LHR'], 19: ['LHR'], 25: ['LHR'], 34: ['LHR'], 49: ['LHR'], 106: ['LHR']}
+
+    def __init__(self, dataframe, mode_condition_lu=None, airport=None):
+        """
+        Initialize with the DataFrame.
+
+        mode_condition_lu can be passed in to construct the mapper without reading any files, e.g. a lookup loaded once
+        by a parent process. It must have the column names returned by load_mode_condition_lu, which is used by default.
+
+        airport can be set to the AIRPORT_Prefix of the DataFrame when it only holds one airport, so that the conditions
+        which only apply at other airports are not evaluated.
+        """
         self.df = dataframe
-        self.minicab = ['Minicab', 'Uber']
-        self.hotel_bus = ['Courtesy bus (travel agent)', 'Hotel bus']
-        self.national_coach = ['LHR-LTN Coach Service', 'National Express Coach', 'Other National/Regional coach service']
-        self.local_bus = ['Local bus companies', 'Luton airport parkway DART']
-        self.tube = ['Docklands Light Railway', 'Tram', 'Tube/Metro/Subway']
-        self.national_railways = ['National railways', 'National railways (MAN only) - changed trains', 'National railways (MAN only) - not changed trains']
-        self.unspecified_modes = ['Car Unspecified', 'Bus Unspecified', 'Taxi/Minicab Unspecified', 'Rail Unspecified']
-        
-        self.mode_condition_lu = pd.read_excel(rf'{config.DATA_DIR}\mode_conditions\version1\mode_condition_mapping.xlsx', sheet_name='Mode_Conditions', usecols = ['Condition_Id', 'LASAM_Main_Mode_2024', 'LASAM_Mode_2024', 'LASAM_Mode_Code_2024', 'LASAM_Mode_Priority_2024'])
-        self.mode_condition_lu.columns = ['Condition ID', 'LASAM Main Mode', 'LASAM Mode', 'LASAM Mode Code', 'LASAM Mode Priority']
+
+        if airport is not None and (self.df['AIRPORT_Prefix'] != airport).any():
+            raise ValueError(f'airport is {airport} but the DataFrame has rows for other airports')
+        self.airport = airport
+
+        self.mode_condition_lu = mode_condition_lu if mode_condition_lu is not None else load_mode_condition_lu()
 
         # columns 'condition_1' to 'condition_109'
         self.number_of_conditions = 109
-        self.condition_columns = [f"Condition_{i}" for i in range(1, self.number_of_conditions + 1)]
+
+        # Conditions that are not coded always return 0, see condition_mapping_utils.get_disabled_conditions.
+        # They are skipped when applying the conditions and no column is created for them
+        self.disabled_conditions = condition_mapping_utils.get_disabled_conditions(type(self))
+        self.pruned_conditions = [] if airport is None else [
+            i for i, airports in self.airport_conditions.items() if airport not in airports
+        ]
+        self.active_conditions = [
+            i for i in range(1, self.number_of_conditions + 1) if i not in self.disabled_conditions and i not in self.pruned_conditions
+        ]
+        self.condition_columns = [f"Condition_{i}" for i in self.active_conditions]
 
 
     def condition_1(self, row):
@@ -129,14 +219,8 @@ class ModeConditionMapper:
         )
 
     def condition_9(self, row):
-        excluded_modes = (
-            self.national_coach + self.tube + self.local_bus + self.national_railways +
-            ['Airport to airport coach service', 'London bus companies', 'Bus/coach company unknown', 'Heathrow Express',
-             'Elizabeth Line', 'Stansted Express', 'Gatwick Express']
-        )
-
         return np.where(
-            (row['Last'] in ['Private car - short term car park', 'Private car - short term car park - meet/greet']) & 
+            (row['Last'] in self.private_car_short_term) & 
             (row['Segment_4_ID'] < 3) & 
             # We do not know the trip total (days), could set to 999999
             # (
@@ -148,7 +232,7 @@ class ModeConditionMapper:
                 (row['Origin'] == 'LDN') |
                 (
                     (row['Origin'] == 'NonLDN') & 
-                    (row['2ndLast'] not in excluded_modes)
+                    (row['2ndLast'] not in self.condition_9_excluded_modes)
                 )
             ),
             9,
@@ -163,24 +247,13 @@ class ModeConditionMapper:
         )
     
     def condition_11(self, row):
-        included_modes = ['Private car - valet service - Off airport', 'Private car - valet service - On airport', 'Private car - airport long term car park bus',
-                          'Private car - private long term car park bus', 'Private car - business car park', 'Private car - mid stay car park bus',
-                          'Private car - staff car park bus', 'Private car - hotel car park bus', 'Private car - type of car park unknown'
-                          ]
-
-        excluded_modes = (
-            self.national_coach + self.local_bus + self.tube + self.national_railways +
-            ['Airport to airport coach service', 'London bus companies', 'Bus/coach company unknown', 
-             'Heathrow Express', 'Elizabeth Line', 'Gatwick Express']
-        )
-
         return np.where(
-            (row['Last'] in included_modes) & 
+            (row['Last'] in self.private_car_long_term) & 
             (
                 (row['Origin'] == 'LDN') | 
                 (
                     (row['Origin'] == 'NonLDN') & 
-                    (row['2ndLast'] not in excluded_modes)
+                    (row['2ndLast'] not in self.condition_11_excluded_modes)
                 )
             ),
             11,
@@ -188,15 +261,13 @@ class ModeConditionMapper:
         )
     
     def condition_12(self, row):
-        excluded_modes = self.national_coach + self.national_railways
-        
         return np.where(
             (row['Last'] == 'Rental car - hire car courtesy bus') & 
             (
                 (row['Origin'] == 'LDN') | 
                 (
                     (row['Origin'] == 'NonLDN') & 
-                    (row['2ndLast'] not in excluded_modes)
+                    (row['2ndLast'] not in self.condition_12_excluded_modes)
                 )
             ),
             12,
@@ -204,19 +275,13 @@ class ModeConditionMapper:
         )
     
     def condition_13(self, row):
-        excluded_modes = (
-            self.national_coach + self.local_bus + self.tube + self.national_railways +
-            ['Charter coach', 'Airport to airport coach service', 'London bus companies', 'Bus/coach company unknown',
-             'Heathrow Express', 'Elizabeth Line']
-        )
-        
         return np.where(
             (row['Last'] in ['Chauffer', 'Private car - driven away']) & 
             (
                 (row['Origin'] == 'LDN') | 
                 (
                     (row['Origin'] == 'NonLDN') & 
-                    (row['2ndLast'] not in excluded_modes)
+                    (row['2ndLast'] not in self.condition_13_excluded_modes)
                 ) | 
                 (
                     (row['Origin'] == 'AIRPORT') & 
@@ -229,34 +294,26 @@ class ModeConditionMapper:
         )
     
     def condition_14(self, row):
-        included_modes =['Private car - short term car park', 'Private car - short term car park - meet/greet']
-        
-        excluded_modes = (
-            self.national_coach + self.local_bus + self.tube + self.national_railways +
-            ['Airport to airport coach service', 'London bus companies', 'Bus/coach company unknown',
-             'Heathrow Express', 'Elizabeth Line', 'Stansted Express', 'Gatwick Express']
-        )
-
         return np.where(
             # Cannot do this entire block as we do not have trip_total_days
-            # Taken (row['Last'] in included_modes) out to ensure the condition still works correctly
+            # Taken (row['Last'] in self.private_car_short_term) out to ensure the condition still works correctly
             # (
             #     (
-            #         (row['Last'] in included_modes) & 
+            #         (row['Last'] in self.private_car_short_term) & 
             #         (row['trip_total_days'] > 1)
             #     ) | 
             #     (
-            #         (row['Last'] in included_modes) & 
+            #         (row['Last'] in self.private_car_short_term) & 
             #         (row['Segment_4_ID'] > 2) & 
             #         (row['trip_total_days'] <= 1)
             #     )
             # ) &
-            (row['Last'] in included_modes) &  
+            (row['Last'] in self.private_car_short_term) &  
             (
                 (row['Origin'] == 'LDN') | 
                 (
                     (row['Origin'] == 'NonLDN') & 
-                    (row['2ndLast'] not in excluded_modes)
+                    (row['2ndLast'] not in self.condition_14_excluded_modes)
                 )
             ),
             14,
@@ -276,13 +333,11 @@ class ModeConditionMapper:
         return 0
 
     def condition_17(self, row):
-        included_modes = self.tube + self.national_railways
-
         return np.where(
             (row['Last'] == 'RailAir Bus (Reading/Woking/Feltham)') & 
             (
-                (row['2ndLast'] in included_modes) |  
-                (row['3rdLast'] in included_modes) 
+                (row['2ndLast'] in self.condition_17_included_modes) |  
+                (row['3rdLast'] in self.condition_17_included_modes) 
             ),
             17,
             0
@@ -299,12 +354,10 @@ class ModeConditionMapper:
         )
     
     def condition_19(self, row):
-        excluded_2ndlast_modes = ['Charter coach', 'Airport to airport coach service', 'Heathrow Express']
-        
         return np.where(
             (row['AIRPORT_Prefix'] == 'LHR') & 
             (row['Last'] in self.tube) & 
-            (row['2ndLast'] not in excluded_2ndlast_modes) &
+            (row['2ndLast'] not in self.condition_19_excluded_2ndlast_modes) &
             (row['Origin'] == 'NonLDN'),
             19,
             0
@@ -334,32 +387,21 @@ class ModeConditionMapper:
         )
 
     def condition_24(self, row):
-        excluded_modes = self.tube + self.national_railways
-
         return np.where(
             (row['Last'] == 'RailAir Bus (Reading/Woking/Feltham)') & 
-            (row['2ndLast'] not in excluded_modes) & 
-            (row['3rdLast'] not in excluded_modes),
+            (row['2ndLast'] not in self.condition_24_excluded_modes) & 
+            (row['3rdLast'] not in self.condition_24_excluded_modes),
             24,
             0
         )
     
     def condition_25(self, row):
-        included_2ndlast_modes = self.national_coach + ['Airport to airport coach service', 'Bus/Coach company unknown']
-        included_3rdlast_modes = (
-            self.national_coach + self.local_bus + self.national_railways +  self.minicab + 
-            ['Airport to airport coach service', 'Bus/Coach company unknown', 'No Mode', 'Private car - driven away', 'Chauffer',
-             'RailAir Bus (Reading/Woking/Feltham)']
-        )
-
-        excluded_2ndlast_modes = self.national_railways + ['Heathrow Express']
-
         return np.where(
             (row['AIRPORT_Prefix'] == 'LHR') & 
             (row['Last'] in self.tube) & 
-            (row['2ndLast'] in [included_2ndlast_modes]) & 
-            (row['2ndLast'] not in excluded_2ndlast_modes) & 
-            (row['3rdLast'] in included_3rdlast_modes) & 
+            (row['2ndLast'] in [self.condition_25_included_2ndlast_modes]) & 
+            (row['2ndLast'] not in self.condition_25_excluded_2ndlast_modes) & 
+            (row['3rdLast'] in self.condition_25_included_3rdlast_modes) & 
             (row['Origin'] == 'NonLDN'),
             25,
             0
@@ -381,14 +423,11 @@ class ModeConditionMapper:
         return 0
     
     def condition_29(self, row):
-        included_last_modes = ['London bus companies'] + self.local_bus
-        excluded_2ndlast_modes = self.national_railways + ['Heathrow Express', 'Stansted Express', 'Gatwick Express']
-
         return np.where(
-            (row['Last'] in included_last_modes) & 
+            (row['Last'] in self.condition_29_included_last_modes) & 
             (
                 (
-                    (row['2ndLast'] not in excluded_2ndlast_modes) & 
+                    (row['2ndLast'] not in self.condition_29_excluded_2ndlast_modes) & 
                     (row['3rdLast'] not in self.national_railways) & 
                     (row['Origin'] == 'NonLDN')
                 ) | 
@@ -402,13 +441,8 @@ class ModeConditionMapper:
         )
     
     def condition_30(self, row):
-        included_last_modes = [
-            'Boat', 'Walk (where only mode)', 'Cycle', 'Motorcycle', 'Car Unspecified', 'Bus Unspecified', 'Taxi/Minicab Unspecified', 
-            'Rail Unspecified', 'Other'
-        ]
-
         return np.where(
-            (row['Last'] in included_last_modes) & 
+            (row['Last'] in self.condition_30_included_last_modes) & 
             (row['2ndLast'] not in ['Heathrow Express', 'Elizabeth Line', 'Stansted Express', 'Gatwick Express']),
             30,
             0
@@ -419,13 +453,11 @@ class ModeConditionMapper:
         return 0
     
     def condition_32(self, row):
-        excluded_2ndlast_modes = ['Charter coach'] + self.national_railways
-
         return np.where(
             (row['Last'] == 'Bus/coach company unknown') & 
             (
                 (
-                    (row['2ndLast'] not in excluded_2ndlast_modes) & 
+                    (row['2ndLast'] not in self.condition_32_excluded_2ndlast_modes) & 
                     (row['3rdLast'] not in self.national_railways) & 
                     (row['Origin'] == 'NonLDN')
                 ) | 
@@ -452,23 +484,19 @@ class ModeConditionMapper:
         return 0
     
     def condition_36(self, row):
-        included_2ndlast_modes = self.national_railways + ['Airport to airport coach service', 'Bus/coach company unknown']
-
         return np.where(
             (row['Last'] in ['Private car - driven away', 'Chauffer']) & 
             (row['Origin'] == 'NonLDN') & 
-            (row['2ndLast'] in included_2ndlast_modes),
+            (row['2ndLast'] in self.condition_36_included_2ndlast_modes),
             36,  
             0 
         )    
     
     def condition_37(self, row):
-        included_2ndlast_modes = self.local_bus + ['London bus companies']
-
         return np.where(
             (row['Last'] in ['Private car - driven away', 'Chauffer']) & 
             (row['Origin'] == 'NonLDN') & 
-            (row['2ndLast'] in included_2ndlast_modes),
+            (row['2ndLast'] in self.condition_37_included_2ndlast_modes),
             37,
             0
         )
@@ -489,12 +517,12 @@ class ModeConditionMapper:
     def condition_42(self, row):
         return np.where(
             # Cannot do this entire block as we do not have trip_total_days
-            # Taken (row['Last'] in ['Private car - short term car park', 'Private car - short term car park - meet/greet']) out to ensure the condition still works correctly
+            # Taken (row['Last'] in self.private_car_short_term) out to ensure the condition still works correctly
             # (
-            #     ((row['Last'] in ['Private car - short term car park', 'Private car - short term car park - meet/greet']) & (row['trip_total_days'] > 1)) | 
-            #     ((row['Last'] in ['Private car - short term car park', 'Private car - short term car park - meet/greet']) & (row['Segment_4_ID'] > 2) & (row['trip_total_days'] <= 1))
+            #     ((row['Last'] in self.private_car_short_term) & (row['trip_total_days'] > 1)) | 
+            #     ((row['Last'] in self.private_car_short_term) & (row['Segment_4_ID'] > 2) & (row['trip_total_days'] <= 1))
             # ) & 
-            (row['Last'] in ['Private car - short term car park', 'Private car - short term car park - meet/greet']) & 
+            (row['Last'] in self.private_car_short_term) & 
             (row['Origin'] == 'NonLDN') & 
             (row['2ndLast'] in self.tube),
             42,
@@ -505,12 +533,10 @@ class ModeConditionMapper:
         return 0
     
     def condition_44(self, row):
-        included_2ndlast_modes = self.national_coach + ['Airport to airport coach service', 'Bus/coach company unknown']
-
         return np.where(
-            (row['Last'] in ['Private car - short term car park', 'Private car - short term car park - meet/greet']) & 
+            (row['Last'] in self.private_car_short_term) & 
             (row['Origin'] == 'NonLDN') & 
-            (row['2ndLast'] in included_2ndlast_modes),
+            (row['2ndLast'] in self.condition_44_included_2ndlast_modes),
             44,
             0
         )
@@ -519,12 +545,10 @@ class ModeConditionMapper:
         return 0
 
     def condition_46(self, row):
-        included_2ndlast_modes = self.local_bus + ['London bus companies']
-
         return np.where(
-            (row['Last'] in ['Private car - short term car park', 'Private car - short term car park - meet/greet']) & 
+            (row['Last'] in self.private_car_short_term) & 
             (row['Origin'] == 'NonLDN') & 
-            (row['2ndLast'] in included_2ndlast_modes),
+            (row['2ndLast'] in self.condition_46_included_2ndlast_modes),
             46,
             0
         )
@@ -536,14 +560,9 @@ class ModeConditionMapper:
         return 0
 
     def condition_49(self, row):
-        included_modes = ['Private car - valet service - Off airport', 'Private car - valet service - On airport', 'Private car - airport long term car park bus',
-                          'Private car - private long term car park bus', 'Private car - business car park', 'Private car - mid stay car park bus',
-                          'Private car - staff car park bus', 'Private car - hotel car park bus', 'Private car - type of car park unknown'
-                          ]
-
         return np.where(
             (row['AIRPORT_Prefix'] == 'LHR') & 
-            (row['Last'] in included_modes) &
+            (row['Last'] in self.private_car_long_term) &
             (row['Origin'] == 'NonLDN') & 
             (row['2ndLast'] in self.tube),
             49,
@@ -554,33 +573,19 @@ class ModeConditionMapper:
         return 0
 
     def condition_51(self, row):
-        included_modes = ['Private car - valet service - Off airport', 'Private car - valet service - On airport', 'Private car - airport long term car park bus',
-                          'Private car - private long term car park bus', 'Private car - business car park', 'Private car - mid stay car park bus',
-                          'Private car - staff car park bus', 'Private car - hotel car park bus', 'Private car - type of car park unknown'
-                          ]
-        
-        included_2ndlast_modes = self.national_coach + ['Airport to airport coach service', 'London bus companies']
-        
         return np.where(
-            (row['Last'] in included_modes) & 
+            (row['Last'] in self.private_car_long_term) & 
             (row['Origin'] == 'NonLDN') & 
-            (row['2ndLast'] in included_2ndlast_modes),
+            (row['2ndLast'] in self.condition_51_included_2ndlast_modes),
             51,  
             0
         )
 
     def condition_52(self, row):
-        included_last_modes = ['Private car - valet service - Off airport', 'Private car - valet service - On airport', 'Private car - airport long term car park bus',
-                               'Private car - private long term car park bus', 'Private car - business car park', 'Private car - mid stay car park bus',
-                               'Private car - staff car park bus', 'Private car - hotel car park bus', 'Private car - type of car park unknown'
-                               ]
-        
-        included_2ndlast_modes = self.local_bus + ['London bus companies']
-
         return np.where(
-            (row['Last'] in included_last_modes) & 
+            (row['Last'] in self.private_car_long_term) & 
             (row['Origin'] == 'NonLDN') & 
-            (row['2ndLast'] in included_2ndlast_modes),
+            (row['2ndLast'] in self.condition_52_included_2ndlast_modes),
             52,
             0
         )
@@ -631,7 +636,7 @@ class ModeConditionMapper:
         return np.where(
             (row['Last'] == 'Taxi') & 
             (
-                (row['2ndLast'] in self. national_coach) | 
+                (row['2ndLast'] in self.national_coach) | 
                 (row['2ndLast'] == 'Airport to airport coach service') | 
                 (row['2ndLast'] == 'Bus/coach company unknown')
             ) & 
@@ -641,12 +646,10 @@ class ModeConditionMapper:
         )
 
     def condition_62(self, row):
-        included_2ndlast_modes = self.local_bus + ['London bus companies']
-
         return np.where(
             (row['Last'] == 'Taxi') & 
             (row['Origin'] == 'NonLDN') & 
-            (row['2ndLast'] in included_2ndlast_modes),
+            (row['2ndLast'] in self.condition_62_included_2ndlast_modes),
             62,  
             0    
         )
@@ -701,12 +704,10 @@ class ModeConditionMapper:
         )
 
     def condition_70(self, row):
-        included_2ndlast_modes = self.local_bus + ['London bus companies']
-
         return np.where(
             (row['Last'] in self.minicab) & 
             (row['Origin'] == 'NonLDN') & 
-            (row['2ndLast'] in included_2ndlast_modes),
+            (row['2ndLast'] in self.condition_70_included_2ndlast_modes),
             70,
             0 
         )
@@ -846,7 +847,7 @@ class ModeConditionMapper:
             #     ((row['AIRPORT_Prefix'] == 'LHR') & (row['trip_total_days'] <= 1) & (row['trip_total_days'] > 0) & (row['Segment_4_ID'] < 3)) | 
             #     ((row['AIRPORT_Prefix'] != 'LHR') & (row['trip_total_days'] <= 2) & (row['trip_total_days'] > 0) & (row['Segment_4_ID'] < 3))
             # ),
-            (row['Segment_4_ID'] < 2),
+            (row['Segment_4_ID'] < self.condition_100_segment_limit),
             100,  # Value if condition is met
             0     # Value if condition is not met
         )
@@ -885,11 +886,9 @@ class ModeConditionMapper:
         )
 
     def condition_106(self, row):
-        included_last_modes = self.national_railways + ['Rail Unspecified']
-        
         return np.where(
             (row['AIRPORT_Prefix'] == 'LHR') & 
-            (row['Last'] in included_last_modes),
+            (row['Last'] in self.condition_106_included_last_modes),
             106, 
             0   
         )
@@ -906,18 +905,8 @@ class ModeConditionMapper:
         )    
 
     def condition_109(self, row):
-        # K&F, P&F or Taxi modes
-        included_last_modes = (
-            self.minicab + self.tube + 
-            ['Private car - driven away', 'Chauffer','Private car - short term car park', 'Private car - short term car park - meet/greet',
-            'Private car - valet service - Off airport', 'Private car - valet service - On airport', 'Private car - airport long term car park bus',
-            'Private car - private long term car park bus', 'Private car - business car park', 'Private car - mid stay car park bus', 
-            'Private car - staff car park bus', 'Private car - hotel car park bus', 'Private car - type of car park unknown'
-            'Taxi']
-            )
-        
         return np.where(
-            (row['Last'] in included_last_modes) &
+            (row['Last'] in self.condition_109_included_last_modes) &
             (row['Origin'] == 'NonLDN') & 
             (row['2ndLast'] == 'Elizabeth Line'),
             109, 
@@ -930,8 +919,12 @@ class ModeConditionMapper:
         # Temporary storage for all new columns
         condition_columns = {}
         
-        # Loop through all conditions dynamically
-        for i in range(1, self.number_of_conditions + 1):
+        logging.info(f'skipped {len(self.disabled_conditions)} disabled conditions: {self.disabled_conditions}')
+        if self.pruned_conditions:
+            logging.info(f'skipped {len(self.pruned_conditions)} conditions that do not apply at {self.airport}: {self.pruned_conditions}')
+
+        # Loop through all active conditions dynamically
+        for i in self.active_conditions:
             condition_method = getattr(self, f'condition_{i}')
             # Compute the condition using apply and store in dictionary
             condition_columns[f'Condition_{i}'] = df.apply(condition_method, axis=1)
@@ -941,6 +934,66 @@ class ModeConditionMapper:
         
         return df
     
+    def get_condition_priority_order(self):
+        # Condition numbers ordered from the highest LASAM mode priority (1) to the lowest.
+        # Ties are broken on the condition number, the same way idxmin resolves duplicates in get_condition_id.
+        # Disabled conditions are left out as they can never be met
+        priorities = self.mode_condition_lu.drop_duplicates('Condition ID').set_index('Condition ID')['LASAM Mode Priority']
+
+        condition_order = pd.DataFrame({'Condition ID': self.active_conditions})
+        condition_order['LASAM Mode Priority'] = condition_order['Condition ID'].map(priorities)
+        condition_order = condition_order.sort_values(['LASAM Mode Priority', 'Condition ID'], na_position='last', kind='stable')
+
+        return condition_order['Condition ID'].tolist()
+
+    def apply_conditions_by_priority(self, dataframe, count_conditions=False):
+        """
+        Assign condition ID's by evaluating the conditions in priority order.
+
+        Each condition is only evaluated on the rows that no higher priority condition has resolved,
+        so the few high-frequency conditions resolve most rows and the rest only see the remainder.
+        The result is the same condition ID that apply_conditions, mode_process_check and get_condition_id produce.
+
+        If count_conditions is True every condition is still evaluated on every row so that
+        'Conditions Met' and the full 'Mode Process Check' are available for QA.
+        Otherwise the assigned rows are flagged as 'Assigned' as duplicates are not counted.
+        """
+        df = dataframe.copy()
+
+        condition_id = pd.Series(-1, index=df.index)
+        conditions_met = pd.Series(0, index=df.index)
+        unresolved = pd.Series(True, index=df.index)
+
+        logging.info(f'skipped {len(self.disabled_conditions)} disabled conditions: {self.disabled_conditions}')
+        if self.pruned_conditions:
+            logging.info(f'skipped {len(self.pruned_conditions)} conditions that do not apply at {self.airport}: {self.pruned_conditions}')
+
+        for i in self.get_condition_priority_order():
+            rows = df if count_conditions else df[unresolved]
+            if rows.empty:
+                break
+
+            condition_method = getattr(self, f'condition_{i}')
+            hits = (rows.apply(condition_method, axis=1) != 0).to_numpy(dtype=bool)
+            hit_index = rows.index[hits]
+
+            # the first (highest priority) condition met by a row gives its condition ID
+            conditions_met.loc[hit_index] += 1
+            newly_resolved = hit_index[unresolved.loc[hit_index].to_numpy()]
+            condition_id.loc[newly_resolved] = i
+            unresolved.loc[newly_resolved] = False
+
+        if count_conditions:
+            df['Conditions Met'] = conditions_met
+
+        df['Mode Process Check'] = condition_mapping_utils.get_mode_process_check(
+            conditions_met, df['Last'], duplicates_counted=count_conditions
+        )
+
+        df['Condition ID'] = condition_id
+
+        return df
+
     def mode_process_check(self, dataframe):
         df = dataframe.copy()
 
@@ -978,40 +1031,24 @@ class ModeConditionMapper:
         #         ),
         #     )
 
-        def process_assignment_status(row):
-            return np.where(
-                (row['Conditions Met'] == 1), 
-                'Correctly Assigned',
-                np.where(
-                    (row['Conditions Met'] > 0),
-                    'Duplicates Assigned',
-                    np.where(
-                        (row['Conditions Met'] == 0) &
-                        (   
-                            (row['Last']=='Airport to airport coach service') |
-                            (row['Last'] == 'No Mode')   
-                        ),
-                        'Not Assigned - Data',
-                        'Not Assigned - Logic'
-                    )
-                ),
-            )
-
-        df['Mode Process Check'] = df.apply(process_assignment_status, axis=1)
-        df['Mode Process Check'] = df['Mode Process Check'].astype(str)
+        # 'Correctly Assigned' if one condition is met, 'Duplicates Assigned' if more than one is met,
+        # otherwise 'Not Assigned - Data' if the last mode is missing or airport to airport coach and 'Not Assigned - Logic' if not
+        df['Mode Process Check'] = condition_mapping_utils.get_mode_process_check(df['Conditions Met'], df['Last'])
 
         return df
     
     def get_condition_id(self, dataframe):
         df = dataframe.copy()
 
+        status = df['Mode Process Check'].cat.codes
+
         # Assign condition ID's to the correctly assigned rows
-        df_correctly_assigned = df[df['Mode Process Check']=='Correctly Assigned'].copy()
+        df_correctly_assigned = df[status == condition_mapping_utils.CORRECTLY_ASSIGNED].copy()
         df_correctly_assigned['Condition ID'] = df_correctly_assigned['Condition Sum']
         
         # Process and assigned condition ID's to rows with duplicate modes
         # The process looks at all the conditions that passed then return the condition ID with the highest priority (1=highest priority)
-        df_duplicates_assigned = df[df['Mode Process Check']=='Duplicates Assigned'].copy()
+        df_duplicates_assigned = df[status == condition_mapping_utils.DUPLICATES_ASSIGNED].copy()
         
         # Function to determine the lowest priority LASAM mode
         def get_lowest_priority_mode_condition(row, condition_columns):
@@ -1036,7 +1073,7 @@ class ModeConditionMapper:
         # Apply the function row-wise
         df_duplicates_assigned["Condition ID"] = df_duplicates_assigned.apply(lambda row: get_lowest_priority_mode_condition(row, self.condition_columns), axis=1)
         
-        df_not_assigned = df[df['Mode Process Check'].isin(['Not Assigned - Data', 'Not Assigned - Logic'])].copy()
+        df_not_assigned = df[status.isin([condition_mapping_utils.NOT_ASSIGNED_DATA, condition_mapping_utils.NOT_ASSIGNED_LOGIC])].copy()
         df_not_assigned['Condition ID'] = -1
 
         df_condition_id = pd.concat([df_correctly_assigned, df_duplicates_assigned, df_not_assigned], ignore_index=True)
@@ -1053,29 +1090,36 @@ class ModeConditionMapper:
     def update_lasam_mode_using_final_mode(self, dataframe):
         df = dataframe.copy()
 
+        not_assigned_logic = df['Mode Process Check'].cat.codes == condition_mapping_utils.NOT_ASSIGNED_LOGIC
+
         df.loc[
-            df['Mode Process Check'] == 'Not Assigned - Logic',
+            not_assigned_logic,
             ['LASAM Mode', 'LASAM Mode Code']
         ] = df.loc[
-            df['Mode Process Check'] == 'Not Assigned - Logic',
+            not_assigned_logic,
             ['SYSTEM_FINALMODE_LASAM_Mode', 'SYSTEM_FINALMODE_LASAM_Mode_Code']
         ].values
 
         return df
 
-    def main_mode_condition_mapping(self):
+    def main_mode_condition_mapping(self, short_circuit=False, count_conditions=False):
 
-        # Step 1: apply conditions
-        self.df = self.apply_conditions(self.df)
+        if short_circuit:
+            # Steps 1 to 3 in one pass: conditions are evaluated in priority order and
+            # a row is no longer checked once a condition has been met
+            self.df = self.apply_conditions_by_priority(self.df, count_conditions=count_conditions)
+        else:
+            # Step 1: apply conditions
+            self.df = self.apply_conditions(self.df)
 
-        # Step 2: mode process check
-        self.df = self.mode_process_check(self.df)
+            # Step 2: mode process check
+            self.df = self.mode_process_check(self.df)
 
-        # Step 3: get condition ID
-            # If there is only 1 condition then the condition ID is the value of the ID
-            # If more than one condition was met then we need to run a separate function to identify the condition with the highest priority
-            # If no conditions where met then the condition ID is -1.
-        self.df = self.get_condition_id(self.df)
+            # Step 3: get condition ID
+                # If there is only 1 condition then the condition ID is the value of the ID
+                # If more than one condition was met then we need to run a separate function to identify the condition with the highest priority
+                # If no conditions where met then the condition ID is -1.
+            self.df = self.get_condition_id(self.df)
 
         # Step 4: assign LASAM main mode and mode based on the condition ID
         self.df = self.assign_lasam_mode(self.df)
@@ -1085,11 +1129,35 @@ class ModeConditionMapper:
 
         return self.df
     
-    def main_run_all(self):
-        df_mode_mapped = self.main_mode_condition_mapping()
+    def set_output_schema(self, dataframe, trace=False, keep_conditions_met=False):
+        """
+        Reduce the mapped DataFrame to the output columns.
+
+        By default the condition columns, 'Condition Sum', 'LASAM Mode Priority' and 'Conditions Met' are dropped
+        ('Conditions Met' is kept if keep_conditions_met is True) and the LASAM modes are stored as categoricals.
+        If trace is True all of these are kept for auditing, with the condition columns downcast to small integers.
+        """
+        trace_columns = self.condition_columns + ['Condition Sum', 'LASAM Mode Priority']
+        if not keep_conditions_met:
+            trace_columns.append('Conditions Met')
+
+        if trace:
+            df = dataframe.copy()
+            condition_columns = [column for column in self.condition_columns if column in df.columns]
+            df[condition_columns] = condition_mapping_utils.encode_condition_columns(df[condition_columns])
+        else:
+            # the condition columns are not created when the conditions are short-circuited
+            df = dataframe.drop(columns=trace_columns, errors='ignore')
+
+        df = condition_mapping_utils.to_categorical(df, ['LASAM Main Mode', 'LASAM Mode', 'LASAM Mode Code'])
+
+        return df
+
+    def main_run_all(self, short_circuit=False, count_conditions=False, trace=False):
+        df_mode_mapped = self.main_mode_condition_mapping(short_circuit=short_circuit, count_conditions=count_conditions)
 
-        # drop condition columns
-        df_mode_mapped.drop(columns=self.condition_columns, inplace=True)
+        # keep the condition columns only if the conditions are traced
+        df_mode_mapped = self.set_output_schema(df_mode_mapped, trace=trace, keep_conditions_met=count_conditions)
 
         return df_mode_mapped
 
@@ -2,9 +2,10 @@ import pandas as pd
 import numpy as np
 import logging
 
+import os
 import sys
-sys.path.append('..\..')
-from src import config
+sys.path.append(os.path.join('..', '..'))
+from src import config, condition_mapping_utils
 logging.basicConfig(level=logging.ERROR)
 
 def error_handling_decorator(func):
@@ -16,128 +17,192 @@ def error_handling_decorator(func):
             return np.nan
     return wrapper
 
+# The steps update one array of mode codes in place, so an error in a step must stop the run rather than be logged
+# and skipped, which would carry on from a partial update
+UNWRAPPED_METHODS = ('apply_steps', 'main_run_all')
+
 def auto_apply_decorator(cls):
     for attr_name, attr_value in cls.__dict__.items():
         if callable(attr_value) and not attr_name.startswith('__'):  # Ignore built-in methods
+            if attr_name.startswith('step_') or attr_name in UNWRAPPED_METHODS:
+                continue
             setattr(cls, attr_name, error_handling_decorator(attr_value))
     return cls
 
+def load_mode_condition_lu():
+    """Read the CAA mode allocation to LASAM mode lookup (once per process)."""
+    return condition_mapping_utils.read_lookup(config.CAA_MODE_ALLOCATION_LASAM_MODE_LU_02_PATH)
+
 @auto_apply_decorator
 # Define the class
 class ModeConditionMapper:
-    def __init__(self, dataframe):
-        """Initialize with the DataFrame."""
+    def __init__(self, dataframe, mode_condition_lu=None, modes=None):
+        """
+        Initialize with the DataFrame.
+
+        mode_condition_lu can be passed in to construct the mapper without reading any files, e.g. a lookup loaded once
+        by a parent process. By default it is read with load_mode_condition_lu.
+
+        modes can be a condition_mapping_utils.RaggedModes of the journeys (in the order of the DataFrame rows), used
+        instead of the 'Last', '2ndLast', '3rdLast' and 'Contains_*' columns, e.g. for surveys with more than three legs.
+        """
         self.df = dataframe
+        self.modes = modes
 
-        self.mode_condition_lu = pd.read_csv(rf'{config.DATA_DIR}\mode_conditions\version2\caa_mode_allocation_lasam_mode_lu_02.csv')
+        self.mode_condition_lu = mode_condition_lu if mode_condition_lu is not None else load_mode_condition_lu()
+
+        # columns 'Step_1' to 'Step_11'
+        self.number_of_steps = 11
+        self.step_columns = [f'Step_{i}' for i in range(1, self.number_of_steps + 1)]
         
-    def step_1(self):
+    def encode_modes(self):
+        """
+        Encode the modes used by the steps as integer codes of one ModeVocabulary.
+
+        The steps work on these code arrays rather than on object columns of strings.
+        """
+        if self.modes is not None:
+            self.vocabulary = self.modes.vocabulary
+
+            self.last = self.modes.kth_last(1)
+            self.second_last = self.modes.kth_last(2)
+            self.third_last = self.modes.kth_last(3)
+
+            self.contains_heathrow_express = self.modes.contains(['Heathrow Express'])
+            self.contains_elizabeth_line = self.modes.contains(['Elizabeth Line'])
+            self.contains_tube = self.modes.contains(['Tube/Metro/Subway'])
+            self.contains_rental = self.modes.contains(['Rental car - short term car park', 'Rental car - hire car courtesy bus'])
+            return
+
+        self.vocabulary = condition_mapping_utils.ModeVocabulary()
+
+        self.last = self.vocabulary.encode(self.df['Last'])
+        self.second_last = self.vocabulary.encode(self.df['2ndLast'])
+        self.third_last = self.vocabulary.encode(self.df['3rdLast'])
+
+        self.contains_heathrow_express = (self.df['Contains_Heathrow_Express'] == True).to_numpy()
+        self.contains_elizabeth_line = (self.df['Contains_Elizabeth_Line'] == True).to_numpy()
+        self.contains_tube = (self.df['Contains_Tube'] == True).to_numpy()
+        self.contains_rental = (self.df['Contains_Rental'] == True).to_numpy()
+
+    def step_1(self, mode):
+        v = self.vocabulary
+
+        last_other = self.last == v.code("Other")
+        second_last_other = v.isin(self.second_last, ["Other", "No Mode"])
+        third_last_other = v.isin(self.third_last, ["Other", "No Mode"])
+
         conditions = [
-            (self.df['Last'] == "Other") & (self.df['2ndLast'].isin(["Other", "No Mode"])) & (self.df['3rdLast'].isin(["Other", "No Mode"])),
-            (self.df['Last'] == "Other") & (self.df['2ndLast'].isin(["Other", "No Mode"])) & (~self.df['3rdLast'].isin(["Other", "No Mode"])),
-            (self.df['Last'] == "Other") & (~self.df['2ndLast'].isin(["Other", "No Mode"])),
-            (self.df['Last'] != "Other")
+            last_other & second_last_other & third_last_other,
+            last_other & second_last_other & ~third_last_other,
+            last_other & ~second_last_other,
+            ~last_other
         ]
-        
+
         choices = [
-            "Other",
-            self.df['3rdLast'],
-            self.df['2ndLast'],
-            self.df['Last']
+            v.code("Other"),
+            self.third_last,
+            self.second_last,
+            self.last
         ]
-        
-        return np.select(conditions, choices, default=np.nan)
+
+        return condition_mapping_utils.select_update(mode, conditions, choices, default=-1)
     
-    def step_2(self):
+    def step_2(self, mode):
+        v = self.vocabulary
+
+        # masks shared by the conditions are only computed once
+        cycle_walk = v.isin(mode, ["Cycle", "Walk (where only mode)"])
+        second_last_cycle_walk = v.isin(self.second_last, ["Cycle", "Walk (where only mode)"])
+        second_last_no_mode = self.second_last == v.code('No Mode')
+        third_last_no_mode = self.third_last == v.code('No Mode')
+        no_mode = mode == v.code('No Mode')
+
         conditions = [
-            ((self.df['Step_1'].isin(["Cycle", "Walk (where only mode)"])) & 
-            (self.df['2ndLast'].isin(["Cycle", "Walk (where only mode)"])) & 
-            (self.df['3rdLast'] == 'No Mode')),
-            
-            ((self.df['Step_1'].isin(["Cycle", "Walk (where only mode)"])) & 
-            (self.df['2ndLast'].isin(["Cycle", "Walk (where only mode)"])) & 
-            (self.df['3rdLast'] != 'No Mode')),
-            
-            ((self.df['Step_1'].isin(["Cycle", "Walk (where only mode)"])) & 
-            (self.df['2ndLast'] == 'No Mode')),
-            
-            ((self.df['Step_1'].isin(["Cycle", "Walk (where only mode)"])) & 
-            (self.df['2ndLast'] != 'No Mode')),
-            
-            (~self.df['Step_1'].isin(["Cycle", "Walk (where only mode)"]) & 
-             (self.df['Step_1'] == 'No Mode')),
-            
-            (~self.df['Step_1'].isin(["Cycle", "Walk (where only mode)"]) & 
-             (self.df['Step_1'] != 'No Mode'))
+            cycle_walk & second_last_cycle_walk & third_last_no_mode,
+            cycle_walk & second_last_cycle_walk & ~third_last_no_mode,
+            cycle_walk & second_last_no_mode,
+            cycle_walk & ~second_last_no_mode,
+            ~cycle_walk & no_mode,
+            ~cycle_walk & ~no_mode
         ]
         
         choices = [
-            "Other",
-            self.df['3rdLast'],
-            "Other",
-            self.df['2ndLast'],
-            "No Mode",
-            self.df['Step_1']
+            v.code("Other"),
+            self.third_last,
+            v.code("Other"),
+            self.second_last,
+            v.code("No Mode"),
+            mode
         ]
         
-        return np.select(conditions, choices, default=np.nan)
+        return condition_mapping_utils.select_update(mode, conditions, choices, default=-1)
     
-    def step_3(self):
+    def step_3(self, mode):
+        v = self.vocabulary
+
+        tube = mode == v.code("Tube/Metro/Subway")
+
         conditions = [
-            (self.df['Step_2'] == "Tube/Metro/Subway") & (self.df['Contains_Heathrow_Express'] == True),
-            (self.df['Step_2'] == "Tube/Metro/Subway") & (self.df['2ndLast'] == "Elizabeth Line")
+            tube & self.contains_heathrow_express,
+            tube & (self.second_last == v.code("Elizabeth Line"))
         ]
 
         choices = [
-            "Heathrow Express",
-            "Elizabeth Line",
+            v.code("Heathrow Express"),
+            v.code("Elizabeth Line"),
         ]
 
-        return np.select(conditions, choices, default=self.df['Step_2'])
+        return condition_mapping_utils.select_update(mode, conditions, choices)
+
+    def step_4(self, mode):
+        v = self.vocabulary
 
-    def step_4(self):
         conditions = [
-            (self.df['Contains_Heathrow_Express'] == True) & (self.df['Contains_Elizabeth_Line'] == False)
+            self.contains_heathrow_express & ~self.contains_elizabeth_line
         ]
 
         choices = [
-            "Heathrow Express"
+            v.code("Heathrow Express")
         ]
 
-        return np.select(conditions, choices, default=self.df['Step_3'])
+        return condition_mapping_utils.select_update(mode, conditions, choices)
         
-    def step_5(self):
-        conditions = [
-            (self.df['Contains_Heathrow_Express'] == True) & 
-            (self.df['Contains_Elizabeth_Line'] == True) & 
-            (self.df['Terminal'] == 5),
+    def step_5(self, mode):
+        v = self.vocabulary
+
+        heathrow_express_and_elizabeth_line = self.contains_heathrow_express & self.contains_elizabeth_line
+        terminal_5 = (self.df['Terminal'] == 5).to_numpy()
 
-            (self.df['Contains_Heathrow_Express'] == True) & 
-            (self.df['Contains_Elizabeth_Line'] == True) & 
-            (self.df['Terminal'] != 5)
+        conditions = [
+            heathrow_express_and_elizabeth_line & terminal_5,
+            heathrow_express_and_elizabeth_line & ~terminal_5
         ]
 
         choices = [
-            "Elizabeth Line",
-            "Heathrow Express"
+            v.code("Elizabeth Line"),
+            v.code("Heathrow Express")
         ]
 
-        return np.select(conditions, choices, default=self.df['Step_4'])
+        return condition_mapping_utils.select_update(mode, conditions, choices)
+
+    def step_6(self, mode):
+        v = self.vocabulary
 
-    def step_6(self):
         conditions = [
-            (self.df['Contains_Rental'] == True) & 
-            ~(self.df['Contains_Heathrow_Express'] | self.df['Contains_Elizabeth_Line'] | self.df['Contains_Tube'])
+            self.contains_rental & 
+            ~(self.contains_heathrow_express | self.contains_elizabeth_line | self.contains_tube)
         ]
 
         choices = [
-            "Rentals"
+            v.code("Rentals")
         ]
 
-        return np.select(conditions, choices, default=self.df['Step_5'])
+        return condition_mapping_utils.select_update(mode, conditions, choices)
     
-    def step_7(self):
-        
+    def step_7(self, mode):
+        v = self.vocabulary
+
         included_mode = ['Private car - driven away', 'Uber', 'Minicab', 'Taxi', 'Chauffer', 'Taxi/Minicab Unspecified']
         incuded_2ndlast_mode = ['National Rail', 'London Underground', 
                                 'London bus companies', 'Local bus companies', 'Bus Unspecified', 'Charter coach', 
@@ -146,110 +211,158 @@ class ModeConditionMapper:
                                 'Tube/Metro/Subway', 'LHR-LTN Coach Service', 'Airport to airport coach service']
 
         conditions = [
-            (self.df['Step_6'].isin(included_mode)) & 
-            (self.df['2ndLast'].isin(incuded_2ndlast_mode))
+            v.isin(mode, included_mode) & 
+            v.isin(self.second_last, incuded_2ndlast_mode)
         ]
 
         choices = [
-            self.df['2ndLast']
+            self.second_last
         ]
         
-        return np.select(conditions, choices, default=self.df['Step_6'])
+        return condition_mapping_utils.select_update(mode, conditions, choices)
+
+    def step_8(self, mode):
+        v = self.vocabulary
 
-    def step_8(self):
         conditions = [
-            (self.df['Last']=='Hotel bus') & (self.df['2ndLast']=='Charter coach')
+            (self.last == v.code('Hotel bus')) & (self.second_last == v.code('Charter coach'))
         ]
 
         choices = [
-            "Charter coach"
+            v.code("Charter coach")
         ]
 
-        return np.select(conditions, choices, default=self.df['Step_7'])
+        return condition_mapping_utils.select_update(mode, conditions, choices)
+
+    def step_9(self, mode):
+        v = self.vocabulary
+
+        car_unspecified = mode == v.code('Car Unspecified')
 
-    def step_9(self):
         conditions = [
-            (self.df['Step_8'] == 'Car Unspecified') & (self.df['SYSTEM_COUNTRY']=='UK'),
-            (self.df['Step_8'] == 'Car Unspecified') & (self.df['SYSTEM_COUNTRY']=='Foreign'),
-            (self.df['Step_8'] != 'Car Unspecified')
+            car_unspecified & (self.df['SYSTEM_COUNTRY']=='UK').to_numpy(),
+            car_unspecified & (self.df['SYSTEM_COUNTRY']=='Foreign').to_numpy(),
+            ~car_unspecified
         ]
 
         choices = [
-            "Car Unspecified UK",
-            "Car Unspecified Foreign",
-            self.df['Step_8']
+            v.code("Car Unspecified UK"),
+            v.code("Car Unspecified Foreign"),
+            mode
         ]
 
-        return np.select(conditions, choices, default=np.nan)
+        return condition_mapping_utils.select_update(mode, conditions, choices, default=-1)
     
-    def step_10(self):
+    def step_10(self, mode):
+        v = self.vocabulary
+
+        airport_to_airport_coach = mode == v.code('Airport to airport coach service')
+
         conditions = [
-            ((self.df['Step_9'] == 'Airport to airport coach service') & 
+            (airport_to_airport_coach & 
             (
                 (self.df['Origin'] == 'AIRPORT') | 
                 (self.df['SYSTEM_District'].str.contains('airport', case=False, na=False)) |
                 (self.df['SYSTEM_District']=='Crawley District (SE)')
-            )),
+            ).to_numpy()),
 
-            (self.df['Step_9'] == 'Airport to airport coach service')
+            airport_to_airport_coach
         ]
 
         choices = [
-            'Airport to airport coach service',
-            'National Express Coach'
+            v.code('Airport to airport coach service'),
+            v.code('National Express Coach')
         ]
 
-        return np.select(conditions, choices, default=self.df['Step_9'])
+        return condition_mapping_utils.select_update(mode, conditions, choices)
     
-    def step_11(self):
-        def apply_condition(row):
-            columns_to_check = ['Last', '2ndLast', '3rdLast']
-            preceding_modes = ["Tube/Metro/Subway", "Elizabeth Line", "TfL Rail (formerly Heathrow Connect)", "National railways", "Rail Unspecified"]
-            
-            railair_bus = 'RailAir Bus (Reading/Woking/Feltham)'
-            
-            for i, col in enumerate(columns_to_check):
-                if railair_bus in str(row[col]):
-                    # Check preceding columns for preceding_modes
-                    for prev_col in columns_to_check[i+1:]:
-                        if any(mode in str(row[prev_col]) for mode in preceding_modes):
-                            return railair_bus
-                    # If we've checked all preceding columns and found no preceding_modes
-                    return 'Other National/Regional coach service'
-            
-            # If RailAir Bus is not found in any column
-            return row['Step_10']
-        
-        return self.df.apply(apply_condition, axis=1)
+    def step_11(self, mode):
+        v = self.vocabulary
+
+        preceding_modes = ["Tube/Metro/Subway", "Elizabeth Line", "TfL Rail (formerly Heathrow Connect)", "National railways", "Rail Unspecified"]
+        railair_bus = 'RailAir Bus (Reading/Woking/Feltham)'
+        other_coach = v.code('Other National/Regional coach service')
+
+        # the modes are matched on substrings, so the flags are looked up for every mode in the vocabulary
+        is_railair_bus = v.match(lambda m: railair_bus in m)
+        is_preceding_mode = v.match(lambda m: any(preceding_mode in m for preceding_mode in preceding_modes))
+
+        # the first of Last, 2ndLast and 3rdLast with the RailAir bus is the RailAir bus if a later column has a preceding mode,
+        # otherwise it is another national/regional coach service
+        conditions = [
+            is_railair_bus[self.last] & (is_preceding_mode[self.second_last] | is_preceding_mode[self.third_last]),
+            is_railair_bus[self.last],
+            is_railair_bus[self.second_last] & is_preceding_mode[self.third_last],
+            is_railair_bus[self.second_last],
+            is_railair_bus[self.third_last]
+        ]
+
+        choices = [
+            v.code(railair_bus),
+            other_coach,
+            v.code(railair_bus),
+            other_coach,
+            other_coach
+        ]
+
+        return condition_mapping_utils.select_update(mode, conditions, choices)
+
+    def apply_steps(self, trace=False, record_steps=False):
+        """
+        Apply the steps to one working array of mode codes, updated in place by each step.
+
+        The result is stored as the categorical 'Mode_Allocated'. If trace is True the result
+        of every step is also stored in the step columns, as categoricals sharing the same categories.
+        If record_steps is True the codes after every step are kept in self.step_codes, a rows x steps
+        int16 array (-1 for missing), so the rows each step changed can be found without decoding.
+        """
+        self.encode_modes()
+        mode = np.full(len(self.df), -1, dtype=np.int16)
+        step_results = []
 
-    def apply_steps(self):
-        
         steps = [self.step_1, self.step_2, self.step_3, self.step_4, self.step_5, self.step_6, self.step_7, self.step_8, self.step_9, self.step_10, self.step_11]
         
-        for i, step in enumerate(steps, 1):
-            result = step()
-            self.df[f'Step_{i}'] = result
+        for step in steps:
+            step(mode)
+            if trace or record_steps:
+                step_results.append(mode.copy())
+
+        if record_steps:
+            self.step_codes = np.column_stack(step_results)
+
+        # decoded once all steps are done, so every column has the complete vocabulary as categories
+        for step_column, step_result in zip(self.step_columns if trace else [], step_results):
+            self.df[step_column] = self.vocabulary.decode(step_result)
+
+        self.df['Mode_Allocated'] = self.vocabulary.decode(mode)
 
         return self.df
     
     def assign_lasam_mode(self):
-        self.df = self.df.merge(self.mode_condition_lu, 
-                                left_on='Step_11',
-                                right_on='Mode_Allocated', how='left')
+        self.df = self.df.merge(self.mode_condition_lu, on='Mode_Allocated', how='left')
+
+        return self.df
+
+    def set_output_schema(self):
+        """
+        Store the allocated mode and the LASAM mode lookup columns as categoricals.
+
+        The step columns are only created when the steps are traced (see apply_steps).
+        """
+        self.df = condition_mapping_utils.to_categorical(self.df, self.mode_condition_lu.columns.tolist())
 
         return self.df
-    
 
-    def main_run_all(self):
+    def main_run_all(self, trace=False, record_steps=False):
 
         # Step 1: apply conditions
-        self.df = self.apply_steps()
+        self.df = self.apply_steps(trace=trace, record_steps=record_steps)
 
         # Step 2: assign LASAM main mode and mode based on mode allocated
         self.df = self.assign_lasam_mode()
 
-        # # drop condition columns
-        # df_mode_mapped.drop(columns=self.step_columns, inplace=True)
+        # Step 3: categorical output columns
+        self.df = self.set_output_schema()
 
         return self.df
 
@@ -0,0 +1,246 @@
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from src import arrow_backend, caa_survey_utils, condition_mapping_utils, config, mapping_runner
+
+############################
+##### SYNTHETIC SURVEY #####
+############################
+
+# CAA modes of the prepared survey (after TfL Rail is renamed to Elizabeth Line)
+SYNTHETIC_MODES = [
+    'Airline courtesy car', 'Airport to airport coach service', 'Boat', 'Bus Unspecified', 'Bus/coach company unknown',
+    'Car Unspecified', 'Chauffer', 'Charter coach', 'Courtesy bus (travel agent)', 'Cycle', 'Docklands Light Railway',
+    'Elizabeth Line', 'Gatwick Express', 'Heathrow Express', 'Hotel bus', 'LHR-LTN Coach Service', 'Local bus companies',
+    'London bus companies', 'Luton airport parkway DART', 'Minicab', 'Motorcycle', 'National Express Coach',
+    'National railways', 'National railways (MAN only) - changed trains', 'National railways (MAN only) - not changed trains',
+    'Other', 'Other National/Regional coach service', 'Private car - airport long term car park bus',
+    'Private car - business car park', 'Private car - driven away', 'Private car - hotel car park bus',
+    'Private car - mid stay car park bus', 'Private car - private long term car park bus', 'Private car - short term car park',
+    'Private car - short term car park - meet/greet', 'Private car - staff car park bus', 'Private car - type of car park unknown',
+    'Private car - valet service - Off airport', 'Private car - valet service - On airport', 'Rail Unspecified',
+    'RailAir Bus (Reading/Woking/Feltham)', 'Rental car - hire car courtesy bus', 'Rental car - short term car park',
+    'Stansted Express', 'Taxi', 'Taxi/Minicab Unspecified', 'Tram', 'Tube/Metro/Subway', 'Uber', 'Walk (where only mode)'
+]
+
+SYNTHETIC_DISTRICTS = {
+    'Heathrow Airport (SE)': 'Greater London', 'Gatwick Airport (SE)': 'West Sussex', 'Crawley District (SE)': 'West Sussex',
+    'Camden': 'Greater London', 'Westminster': 'Greater London', 'Hillingdon': 'Greater London', 'Reading': 'Berkshire',
+    'Oxford': 'Oxfordshire', 'Birmingham': 'West Midlands'
+}
+
+SYNTHETIC_FINAL_LASAM_MODES = ['Rail', 'Bus', 'Coach', 'Taxi', 'Kiss&Fly', 'Park&Fly', 'Rental', 'Other']
+
+
+def make_synthetic_survey(n_rows: int = 5000, seed: int = 0) -> pd.DataFrame:
+    """
+    Make a prepared CAA survey of random journeys, the same for a given n_rows and seed.
+
+    Journeys have one to three legs of SYNTHETIC_MODES, with 'No Mode' or missing values after the last leg, and the
+    other columns the mappers read. A few journeys have no mode at all, so the missing mode paths are covered too. The
+    Last, Origin and Contains_* columns are derived as in preprocess_caa. It does not depend on any lookup, so a change
+    in the mapped output is a change in the mapper or its lookup.
+    """
+    rng = np.random.default_rng(seed)
+    modes = np.array(SYNTHETIC_MODES, dtype=object)
+    districts = np.array(list(SYNTHETIC_DISTRICTS), dtype=object)
+
+    legs = rng.choice([0, 1, 2, 3], n_rows, p=[0.02, 0.48, 0.35, 0.15])
+    mode_columns = {}
+    for leg, column in enumerate(caa_survey_utils.MODE_COLUMNS, start=1):
+        values = rng.choice(modes, n_rows)
+        # an object array, so that the missing legs are NaN rather than the string 'nan'
+        unused = np.full(n_rows, 'No Mode', dtype=object)
+        unused[rng.random(n_rows) < 0.2] = np.nan
+        mode_columns[column] = np.where(legs >= leg, values, unused)
+
+    caa_df = pd.DataFrame(mode_columns)
+    caa_df['Row_ID'] = np.arange(n_rows)
+    caa_df['AIRPORT_Prefix'] = rng.choice(['LHR', 'LGW', 'STN'], n_rows, p=[0.8, 0.15, 0.05])
+    caa_df['SYSTEM_District'] = rng.choice(districts, n_rows)
+    caa_df['SYSTEM_County'] = caa_df['SYSTEM_District'].map(SYNTHETIC_DISTRICTS)
+    caa_df['SYSTEM_COUNTRY'] = rng.choice(['UK', 'Foreign', 'Other'], n_rows, p=[0.5, 0.45, 0.05])
+    caa_df['Segment_4_ID'] = rng.integers(1, 5, n_rows)
+    caa_df['Terminal'] = rng.choice([2, 3, 4, 5], n_rows)
+    caa_df['Year'] = 2024
+    caa_df['POP'] = rng.gamma(2.0, 50.0, n_rows)
+
+    final_modes = rng.integers(0, len(SYNTHETIC_FINAL_LASAM_MODES), n_rows)
+    caa_df['SYSTEM_FINALMODE'] = caa_df['MODEA']
+    caa_df['SYSTEM_FINALMODE_LASAM_Mode'] = np.array(SYNTHETIC_FINAL_LASAM_MODES, dtype=object)[final_modes]
+    caa_df['SYSTEM_FINALMODE_LASAM_Mode_Code'] = final_modes + 1
+
+    vocabulary = condition_mapping_utils.ModeVocabulary()
+    caa_df = caa_survey_utils.add_last_modes(caa_df, caa_survey_utils.get_ragged_modes(caa_df, vocabulary, caa_survey_utils.MODE_COLUMNS))
+    caa_df['Origin'] = caa_survey_utils.get_origin(caa_df)
+
+    modes_used = caa_survey_utils.get_modes_used(caa_df, vocabulary)
+    caa_df['Contains_Elizabeth_Line'] = caa_survey_utils.get_contains_mode(modes_used, vocabulary, 'Elizabeth Line')
+    caa_df['Contains_Heathrow_Express'] = caa_survey_utils.get_contains_mode(modes_used, vocabulary, 'Heathrow Express')
+    caa_df['Contains_Tube'] = caa_survey_utils.get_contains_mode(modes_used, vocabulary, 'Tube/Metro/Subway')
+    caa_df['Contains_Rental'] = caa_survey_utils.get_contains_mode(modes_used, vocabulary, ['Rental car - short term car park', 'Rental car - hire car courtesy bus'])
+
+    return caa_df
+
+
+##########################
+##### GOLDEN OUTPUTS #####
+##########################
+
+# Mapper output columns kept in the golden outputs, those present in the output are used
+GOLDEN_COLUMNS = ['Condition ID', 'Mode Process Check', 'Mode_Allocated', 'LASAM Mode', 'LASAM Mode Code', 'LASAM_Mode', 'LASAM_Mode_Code']
+
+
+def normalise_column(values: pd.Series) -> pd.Series:
+    # Compare values rather than dtypes: numbers as float64, anything else as strings, missing values as None
+    values = values.astype(object)
+    numbers = pd.to_numeric(values, errors='coerce')
+    if numbers.notna().sum() == values.notna().sum():
+        return numbers.astype(float)
+    return values.map(lambda value: None if pd.isna(value) else str(value))
+
+
+def hash_column(values: pd.Series) -> str:
+    # Content hash of a normalised column, hashed per row by pandas and combined with blake2b
+    row_hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+    return hashlib.blake2b(row_hashes.tobytes(), digest_size=16).hexdigest()
+
+
+def get_golden(mapped_df: pd.DataFrame, id_col: str = 'Row_ID') -> pd.DataFrame:
+    # Row ID and normalised golden columns of a mapper output, sorted on the row ID
+    columns = [column for column in GOLDEN_COLUMNS if column in mapped_df.columns]
+    golden_df = mapped_df[[id_col] + columns].sort_values(id_col, kind='stable', ignore_index=True)
+    for column in columns:
+        golden_df[column] = normalise_column(golden_df[column])
+    return golden_df
+
+
+def map_survey(mapper, caa_df: pd.DataFrame, mode_condition_lu: pd.DataFrame, backend: str, run_kwargs: dict) -> pd.DataFrame:
+    # Arrow only has its own rules for the V4 conditions, the other mappers are checked by running them
+    if backend == 'arrow' and not hasattr(mapper, 'get_condition_priority_order'):
+        raise ValueError(f'the arrow backend only maps the V4 conditions, map {mapper.__module__} with the pandas backend')
+    if backend == 'arrow':
+        return arrow_backend.map_table(mapper, caa_df.copy(), mode_condition_lu, **run_kwargs)
+    return mapping_runner.map_partition(mapper, caa_df.copy(), mode_condition_lu, run_kwargs=run_kwargs)
+
+
+def get_golden_paths(name: str, golden_dir: str = None) -> tuple[str, str]:
+    # Golden output (Parquet) and column hashes (JSON) of a name, e.g. 'V4_Corrected_synthetic'
+    golden_dir = golden_dir or config.GOLDEN_DIR
+    return os.path.join(golden_dir, f'{name}.parquet'), os.path.join(golden_dir, f'{name}.json')
+
+
+def write_golden(name: str, mapper, caa_df: pd.DataFrame, golden_dir: str = None, backend: str = 'pandas', id_col: str = 'Row_ID',
+                 mode_condition_lu: pd.DataFrame = None, **run_kwargs):
+    """
+    Map a survey and store the result as the golden output of a name.
+
+    Parameters
+    ----------
+    name : str
+        Name of the golden output, e.g. f'{version}_synthetic' for make_synthetic_survey() or f'{version}_sample' for a
+        sample of the real survey.
+    mapper : type
+        A ModeConditionMapper class.
+    caa_df : pd.DataFrame
+        Prepared CAA survey data with a unique row ID.
+    golden_dir : str, optional
+        Directory of the golden outputs, config.GOLDEN_DIR by default.
+    backend : str, optional
+        'pandas' to map with the mapper itself, 'arrow' with arrow_backend (V4 mappers only). It is stored with the
+        hashes and used by check_golden.
+    id_col : str, optional
+        Column identifying the rows.
+    mode_condition_lu : pd.DataFrame, optional
+        Lookup of the mapper, read with mapping_runner.load_mapper_lookup if not given.
+    **run_kwargs
+        Passed to main_run_all, e.g. short_circuit=True. They are stored with the hashes and used by check_golden.
+    """
+    mode_condition_lu = mode_condition_lu if mode_condition_lu is not None else mapping_runner.load_mapper_lookup(mapper)
+    golden_df = get_golden(map_survey(mapper, caa_df, mode_condition_lu, backend, run_kwargs), id_col)
+
+    golden_path, hash_path = get_golden_paths(name, golden_dir)
+    os.makedirs(os.path.dirname(golden_path), exist_ok=True)
+
+    # strings stored as categoricals, so the file holds one code per row
+    golden_df.astype({column: 'category' for column in golden_df.columns if golden_df[column].dtype == object}).to_parquet(golden_path, index=False)
+
+    with open(hash_path, 'w') as hash_file:
+        json.dump({
+            'mapper': mapper.__module__,
+            'backend': backend,
+            'run_kwargs': run_kwargs,
+            'id_col': id_col,
+            'rows': len(golden_df),
+            'ids': hash_column(golden_df[id_col]),
+            'lookup': hash_column(pd.Series(pd.util.hash_pandas_object(mode_condition_lu, index=False))),
+            'columns': {column: hash_column(golden_df[column]) for column in golden_df.columns if column != id_col},
+        }, hash_file, indent=4)
+
+    print(f'wrote golden output {name}: {len(golden_df)} rows of {golden_df.columns.tolist()[1:]}')
+
+
+def check_golden(name: str, mapper, caa_df: pd.DataFrame, golden_dir: str = None, backend: str = None,
+                 mode_condition_lu: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Map a survey and compare the result with the golden output of a name, see write_golden.
+
+    The column hashes are compared first, and the golden rows are only read and diffed if a hash differs.
+    The survey is mapped with the backend the golden output was written with (the mapper's own main_run_all by
+    default). For the V4 mappers backend='arrow' evaluates their conditions in a fraction of the time of the row-wise
+    conditions, so the check can be run on every edit of a condition. The other mappers are always run themselves, so
+    an edit of a step is always checked.
+
+    Returns
+    -------
+    pd.DataFrame
+        The rows whose output changed, with the golden ('_golden') and new ('_new') values of the changed columns.
+        Empty if the output matches.
+    """
+    start = time.perf_counter()
+    golden_path, hash_path = get_golden_paths(name, golden_dir)
+
+    with open(hash_path) as hash_file:
+        golden_hashes = json.load(hash_file)
+    id_col = golden_hashes['id_col']
+
+    backend = backend or golden_hashes.get('backend', 'pandas')
+
+    mode_condition_lu = mode_condition_lu if mode_condition_lu is not None else mapping_runner.load_mapper_lookup(mapper)
+    if hash_column(pd.Series(pd.util.hash_pandas_object(mode_condition_lu, index=False))) != golden_hashes['lookup']:
+        print(f'the lookup of {mapper.__module__} has changed since the golden output {name} was written')
+
+    new_df = get_golden(map_survey(mapper, caa_df, mode_condition_lu, backend, golden_hashes['run_kwargs']), id_col)
+
+    new_hashes = {column: hash_column(new_df[column]) for column in new_df.columns if column != id_col}
+    changed_columns = sorted(
+        set(golden_hashes['columns']) ^ set(new_hashes) |
+        {column for column in new_hashes if golden_hashes['columns'].get(column) not in (None, new_hashes[column])}
+    )
+
+    if not changed_columns and hash_column(new_df[id_col]) == golden_hashes['ids']:
+        print(f'{name} matches its golden output ({len(new_df)} rows, {time.perf_counter() - start:.2f}s)')
+        return pd.DataFrame()
+
+    # Full row diff of the changed columns
+    golden_df = pd.read_parquet(golden_path)
+    diff_df = golden_df.merge(new_df, on=id_col, how='outer', suffixes=('_golden', '_new'), indicator=True)
+
+    changed = diff_df['_merge'] != 'both'
+    for column in changed_columns:
+        golden_values = diff_df.get(f'{column}_golden', pd.Series(None, index=diff_df.index)).astype(object)
+        new_values = diff_df.get(f'{column}_new', pd.Series(None, index=diff_df.index)).astype(object)
+        column_changed = ~((golden_values == new_values) | (golden_values.isna() & new_values.isna()))
+        print(f'{column}: {column_changed.sum()} rows changed')
+        changed |= column_changed
+
+    diff_columns = [id_col, '_merge'] + [f'{column}{suffix}' for column in changed_columns for suffix in ['_golden', '_new'] if f'{column}{suffix}' in diff_df.columns]
+    diff_df = diff_df.loc[changed, diff_columns].reset_index(drop=True)
+
+    print(f'{name} differs from its golden output in {len(diff_df)} rows ({time.perf_counter() - start:.2f}s)')
+    return diff_df
@@ -0,0 +1,188 @@
+import itertools
+import logging
+import re
+
+import pandas as pd
+import numpy as np
+
+from src import condition_mapping_utils
+
+#####################
+##### SCENARIOS #####
+#####################
+
+def get_parameter_condition(parameter: str) -> int:
+    # Rule parameters are the mapper class attributes named after their condition, e.g. condition_100_segment_limit
+    match = re.match(r'condition_(\d+)_', parameter)
+    if match is None:
+        raise ValueError(f'{parameter} is not a condition parameter, expected a name like condition_<number>_...')
+    return int(match.group(1))
+
+
+def get_parameter_grid(mappers: dict, parameters: list[str]) -> dict[str, dict]:
+    """
+    Get a parameter grid with the values the given mapper classes use for the parameters.
+
+    For example get_parameter_grid({'V4': ModeConditionMapperV4, 'Corrected': ModeConditionMapperV4_Corrected},
+    ['condition_100_segment_limit']) gives {'condition_100_segment_limit': {'V4': 2, 'Corrected': 3}}.
+    """
+    return {parameter: {label: getattr(mapper, parameter) for label, mapper in mappers.items()} for parameter in parameters}
+
+
+def grid_values(grid: dict, parameter: str) -> dict:
+    # Labelled values of a parameter: a dict of values by label, or a list of values labelled by their str()
+    values = grid[parameter]
+    return values if isinstance(values, dict) else {str(value): value for value in values}
+
+
+def get_scenarios(grid: dict) -> pd.DataFrame:
+    """
+    Get every combination of the parameter values in the grid.
+
+    Parameters
+    ----------
+    grid : dict
+        Values of each parameter, either as a dict of labelled values or as a list of values labelled by their str().
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per scenario, indexed by the scenario name, with the label of each parameter's value.
+    """
+    labels = [list(grid_values(grid, parameter)) for parameter in grid]
+
+    scenarios = pd.DataFrame(list(itertools.product(*labels)), columns=list(grid))
+    scenarios.index = scenarios.apply(lambda labels: ' | '.join(labels), axis=1) if len(grid) else ['base']
+    scenarios.index.name = 'Scenario'
+    return scenarios
+
+
+#################
+##### SWEEP #####
+#################
+
+def get_condition_hits(mapper, condition: int, rows: pd.DataFrame, parameters: dict = None) -> np.ndarray:
+    # Evaluate one condition with the given parameters set on the mapper instance, so the class values are not changed
+    parameters = parameters or {}
+    for parameter, value in parameters.items():
+        setattr(mapper, parameter, value)
+
+    try:
+        if rows.empty:
+            return np.zeros(0, dtype=bool)
+        return (rows.apply(getattr(mapper, f'condition_{condition}'), axis=1) != 0).to_numpy(dtype=bool)
+    finally:
+        for parameter in parameters:
+            delattr(mapper, parameter)
+
+
+def sweep_mode_shares(mapper, caa_df: pd.DataFrame, grid: dict, mode_condition_lu: pd.DataFrame = None, weight_col: str = 'POP') -> pd.DataFrame:
+    """
+    Get the LASAM mode shares of every scenario in a grid of rule parameters, sharing one evaluation of the conditions.
+
+    The conditions that do not depend on a swept parameter are evaluated once, in priority order and only on the rows
+    that no higher priority condition has met. The swept conditions are evaluated once per distinct value of their
+    parameters, and only on the rows where they could still change the result. The condition ID of every scenario is
+    then the highest priority condition met, found for all scenarios at once from these hit masks.
+    Rows meeting no condition get the LASAM mode of their system final mode, as in the mapper ('Not Assigned - Logic'),
+    unless their last mode is missing ('Not Assigned - Data').
+
+    Parameters
+    ----------
+    mapper : type
+        A V4 ModeConditionMapper class, e.g. ModeConditionMapperV4_Corrected, whose values are used for the parameters
+        that are not swept.
+    caa_df : pd.DataFrame
+        Prepared CAA survey data, as passed to the mapper.
+    grid : dict
+        Values of each swept parameter, see get_scenarios and get_parameter_grid. The parameters are the mapper's
+        condition class attributes, e.g. condition_100_segment_limit or condition_36_included_2ndlast_modes.
+    mode_condition_lu : pd.DataFrame, optional
+        Mode condition lookup passed to the mapper.
+    weight_col : str, optional
+        Column with the weight of each row.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per scenario and LASAM mode with the labels of the scenario's parameter values, the total weight and
+        'prop', the share in percent.
+    """
+    scenarios = get_scenarios(grid)
+    condition_mapper = mapper(caa_df, mode_condition_lu)
+
+    for parameter in grid:
+        if not hasattr(condition_mapper, parameter):
+            raise ValueError(f'{type(condition_mapper).__name__} has no rule parameter {parameter}')
+
+    swept_parameters = {}
+    for parameter in grid:
+        swept_parameters.setdefault(get_parameter_condition(parameter), []).append(parameter)
+
+    condition_order = condition_mapper.get_condition_priority_order()
+    unmet = len(condition_order)
+    n_rows = len(caa_df)
+
+    logging.info(f'skipped {len(condition_mapper.disabled_conditions)} disabled conditions: {condition_mapper.disabled_conditions}')
+
+    # Priority rank of the first condition met by each row among the conditions that are not swept
+    fixed_rank = np.full(n_rows, unmet)
+    for rank, condition in enumerate(condition_order):
+        if condition in swept_parameters:
+            continue
+
+        unresolved = np.flatnonzero(fixed_rank == unmet)
+        if len(unresolved) == 0:
+            break
+
+        hits = get_condition_hits(condition_mapper, condition, caa_df.iloc[unresolved])
+        fixed_rank[unresolved[hits]] = rank
+
+    # Rank of the first condition met in each scenario, one row per scenario
+    scenario_rank = np.tile(fixed_rank, (len(scenarios), 1))
+    for condition, parameters in swept_parameters.items():
+        if condition not in condition_order:
+            continue
+        rank = condition_order.index(condition)
+
+        # Only rows without a higher priority condition met can be assigned by this condition
+        candidates = np.flatnonzero(fixed_rank > rank)
+        rows = caa_df.iloc[candidates]
+
+        # Hits for each distinct combination of this condition's parameter values
+        for labels, scenario_numbers in scenarios.reset_index(drop=True).groupby(parameters).groups.items():
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            values = {parameter: grid_values(grid, parameter)[label] for parameter, label in zip(parameters, labels)}
+            hits = get_condition_hits(condition_mapper, condition, rows, values)
+
+            scenario_numbers = np.asarray(scenario_numbers)
+            hit_rows = candidates[hits]
+            scenario_rank[np.ix_(scenario_numbers, hit_rows)] = np.minimum(scenario_rank[np.ix_(scenario_numbers, hit_rows)], rank)
+
+    # LASAM mode code of each rank, with the system final mode fallback for rows meeting no condition
+    vocabulary = condition_mapping_utils.ModeVocabulary()
+    lasam_modes = condition_mapper.mode_condition_lu.drop_duplicates('Condition ID').set_index('Condition ID')['LASAM Mode']
+    rank_mode = vocabulary.encode(lasam_modes.reindex(condition_order).to_numpy())
+
+    status = condition_mapping_utils.get_mode_process_check(np.zeros(n_rows), caa_df['Last']).codes
+    fallback_mode = np.where(
+        status == condition_mapping_utils.NOT_ASSIGNED_LOGIC, vocabulary.encode(caa_df['SYSTEM_FINALMODE_LASAM_Mode']), -1
+    )
+
+    scenario_mode = np.where(scenario_rank == unmet, fallback_mode, np.append(rank_mode, -1)[scenario_rank])
+
+    # Weight by scenario and mode with one bincount over all scenarios
+    weight = np.broadcast_to(caa_df[weight_col].to_numpy(dtype=float), scenario_mode.shape)
+    scenario_number = np.broadcast_to(np.arange(len(scenarios))[:, None], scenario_mode.shape)
+    mapped = scenario_mode >= 0
+
+    mode_weight = np.bincount(
+        scenario_number[mapped] * len(vocabulary) + scenario_mode[mapped], weights=weight[mapped], minlength=len(scenarios) * len(vocabulary)
+    ).reshape(len(scenarios), len(vocabulary))
+
+    shares_df = pd.DataFrame(mode_weight, index=scenarios.index, columns=pd.Index(vocabulary.modes, name='LASAM Mode'))
+    shares_df = shares_df.loc[:, shares_df.sum(axis=0) > 0].stack().rename(weight_col).reset_index()
+    shares_df['prop'] = shares_df[weight_col] / shares_df.groupby('Scenario')[weight_col].transform('sum') * 100
+
+    return scenarios.reset_index().merge(shares_df, on='Scenario')
+
@@ -0,0 +1,185 @@
+import ast
+import difflib
+import inspect
+
+import pandas as pd
+
+############################
+##### VOCABULARY CHECK #####
+############################
+
+# Survey columns holding CAA modes
+SURVEY_MODE_COLUMNS = ['MODEA', 'MODEB', 'MODEC', 'Last', '2ndLast', '3rdLast', 'SYSTEM_FINALMODE']
+
+# Placeholders that are not modes, so are not expected in the lookups
+NON_MODE_VALUES = frozenset(['No Mode'])
+
+# Calls on a ModeVocabulary whose string arguments are modes
+VOCABULARY_CALLS = frozenset(['code', 'isin', 'table', 'mask', 'contains', 'match'])
+
+# Parsed rule literals by mapper class, the source of a class does not change within a session
+_rule_modes_cache = {}
+
+
+def get_survey_modes(caa_df: pd.DataFrame, mode_columns: list[str] = SURVEY_MODE_COLUMNS) -> dict[str, pd.Series]:
+    # Row count of each distinct mode in each mode column present in the survey
+    return {
+        column: caa_df[column].value_counts(dropna=True).loc[lambda counts: counts > 0]
+        for column in mode_columns if column in caa_df.columns
+    }
+
+
+def get_string_literals(node: ast.AST) -> set[str]:
+    # String constants of a node and of any list, tuple or set literal it holds
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return {node.value}
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return set().union(*[get_string_literals(element) for element in node.elts])
+    return set()
+
+
+def get_local_literals(function: ast.FunctionDef) -> dict[str, set[str]]:
+    # String literals of the list, tuple and set literals assigned to a local name, e.g. included_mode = ['Taxi', ...]
+    local_literals = {}
+    for node in ast.walk(function):
+        if isinstance(node, ast.Assign) and isinstance(node.value, (ast.List, ast.Tuple, ast.Set)):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    local_literals[target.id] = local_literals.get(target.id, set()) | get_string_literals(node.value)
+    return local_literals
+
+
+def get_operand_literals(node: ast.AST, local_literals: dict[str, set[str]]) -> set[str]:
+    # String literals of an operand or argument, and of the local lists named anywhere in it (e.g. inside a lambda)
+    literals = get_string_literals(node)
+    for name in ast.walk(node):
+        if isinstance(name, ast.Name) and name.id in local_literals:
+            literals |= local_literals[name.id]
+    return literals
+
+
+def is_mode_column(node: ast.AST) -> bool:
+    # row['Last'], self.df['2ndLast'], ...
+    return isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Constant) and node.slice.value in SURVEY_MODE_COLUMNS
+
+
+def is_vocabulary_call(node: ast.AST) -> bool:
+    # v.code('Taxi'), self.modes.contains([...]), but not string methods such as df['col'].str.contains('airport')
+    return (
+        isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.func.attr in VOCABULARY_CALLS and
+        not (isinstance(node.func.value, ast.Attribute) and node.func.value.attr == 'str')
+    )
+
+
+def get_rule_modes(mapper) -> dict[str, set[str]]:
+    """
+    Get the mode strings used by the rules of a mapper class.
+
+    These are the members of the mode set class attributes (e.g. condition_30_included_last_modes) and, by parsing the
+    class source, the string literals compared with a mode column (row['Last'] == 'Taxi') or passed to a ModeVocabulary
+    (v.code('Taxi')) in each method. Local names bound to a list, tuple or set literal in the method are resolved, so
+    v.isin(mode, included_mode) gives the modes of included_mode.
+
+    Returns
+    -------
+    dict[str, set[str]]
+        Mode strings by class attribute or method name.
+    """
+    if mapper in _rule_modes_cache:
+        return _rule_modes_cache[mapper]
+
+    rule_modes = {}
+
+    for name, value in vars(mapper).items():
+        if isinstance(value, (set, frozenset)):
+            rule_modes[name] = set(value)
+
+    for function in ast.walk(ast.parse(inspect.getsource(mapper))):
+        if not isinstance(function, ast.FunctionDef):
+            continue
+
+        local_literals = get_local_literals(function)
+        literals = set()
+        for node in ast.walk(function):
+            if isinstance(node, ast.Compare) and any(is_mode_column(operand) for operand in [node.left, *node.comparators]):
+                for operand in [node.left, *node.comparators]:
+                    literals |= get_operand_literals(operand, local_literals)
+            elif is_vocabulary_call(node):
+                for argument in node.args:
+                    literals |= get_operand_literals(argument, local_literals)
+
+        if literals:
+            rule_modes[function.name] = rule_modes.get(function.name, set()) | literals
+
+    _rule_modes_cache[mapper] = rule_modes
+    return rule_modes
+
+
+def get_suggestion(mode: str, known_modes: set[str]) -> str:
+    # The known mode differing only in case, otherwise the closest match if there is a close one
+    casefolded = {known_mode.casefold(): known_mode for known_mode in known_modes}
+    if mode.casefold() in casefolded:
+        return casefolded[mode.casefold()]
+
+    matches = difflib.get_close_matches(mode, known_modes, n=1, cutoff=0.85)
+    return matches[0] if matches else None
+
+
+def get_vocabulary_report(caa_df: pd.DataFrame = None, mapper=None, mode_allocation_lu: pd.DataFrame = None,
+                          ignore=NON_MODE_VALUES) -> pd.DataFrame:
+    """
+    Find the modes in the survey and in the mapper rules that are not in the mode allocation lookup.
+
+    Parameters
+    ----------
+    caa_df : pd.DataFrame, optional
+        Prepared CAA survey data. Its mode columns (see SURVEY_MODE_COLUMNS) are checked.
+    mapper : type, optional
+        A ModeConditionMapper class whose rule literals are checked.
+    mode_allocation_lu : pd.DataFrame, optional
+        Lookup with the known modes in 'Mode_Allocated'. Defaults to config.caa_mode_allocation_lasam_mode_lu.
+    ignore : iterable, optional
+        Values that are not reported, 'No Mode' by default.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per unknown mode and place it was found, with the number of survey rows (for survey columns) and
+        the known mode it was probably meant to be. Empty if every mode is known.
+    """
+    if mode_allocation_lu is None:
+        from src import config
+        mode_allocation_lu = config.caa_mode_allocation_lasam_mode_lu
+
+    known_modes = set(mode_allocation_lu['Mode_Allocated'].dropna()) | set(ignore)
+    report = []
+
+    if caa_df is not None:
+        for column, counts in get_survey_modes(caa_df).items():
+            for mode in set(counts.index) - known_modes:
+                report.append({'Source': column, 'Mode': mode, 'Rows': counts[mode]})
+
+    if mapper is not None:
+        for name, modes in get_rule_modes(mapper).items():
+            for mode in modes - known_modes:
+                report.append({'Source': f'{mapper.__module__.rsplit(".", 1)[-1]}.{name}', 'Mode': mode, 'Rows': None})
+
+    report_df = pd.DataFrame(report, columns=['Source', 'Mode', 'Rows'])
+    report_df['Suggestion'] = [get_suggestion(mode, known_modes) for mode in report_df['Mode']]
+
+    return report_df.sort_values(['Source', 'Mode'], ignore_index=True)
+
+
+def check_vocabulary(caa_df: pd.DataFrame = None, mapper=None, mode_allocation_lu: pd.DataFrame = None, ignore=NON_MODE_VALUES):
+    """
+    Check the survey and mapper modes against the mode allocation lookup before mapping, see get_vocabulary_report.
+
+    Raises
+    ------
+    ValueError
+        If any mode is not in the lookup. Those rows would otherwise be mapped to NaN LASAM modes without an error.
+    """
+    report_df = get_vocabulary_report(caa_df, mapper, mode_allocation_lu, ignore)
+
+    if not report_df.empty:
+        raise ValueError(f'{len(report_df)} modes are not in the mode allocation lookup:\n{report_df.to_string(index=False)}')
@@ -0,0 +1,17 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import regression_utils
+
+
+@pytest.fixture
+def synthetic_lookup() -> pd.DataFrame:
+    # Mode allocation lookup of the synthetic modes, so that the V5 and V6 mappers run without the lookup files
+    modes = regression_utils.SYNTHETIC_MODES
+    lasam_modes = np.array(regression_utils.SYNTHETIC_FINAL_LASAM_MODES, dtype=object)
+    return pd.DataFrame({
+        'Mode_Allocated': modes,
+        'LASAM_Mode': lasam_modes[np.arange(len(modes)) % len(lasam_modes)],
+        'LASAM_Mode_Code': np.arange(len(modes)) % len(lasam_modes) + 1,
+    })
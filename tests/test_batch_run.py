@@ -0,0 +1,42 @@
+import os
+import threading
+import time
+
+import pytest
+
+from src import batch_run, caa_survey_utils, config, mapping_runner, regression_utils
+
+
+def test_partitions_before_an_error_are_written(tmp_path, monkeypatch, synthetic_lookup):
+    extract_path = os.path.join(tmp_path, 'extract.parquet')
+    regression_utils.make_synthetic_survey(1000).to_parquet(extract_path, index=False)
+
+    # the synthetic survey is already prepared, and the lookups are not read from the data directory
+    monkeypatch.setattr(caa_survey_utils, 'preprocess_caa', lambda airport_df, segment_lu, final_mode_lasam_mode_lu: airport_df)
+    monkeypatch.setattr(mapping_runner, 'load_mapper_lookup', lambda mapper: synthetic_lookup)
+    monkeypatch.setitem(vars(config), 'segment_lu', None)
+    monkeypatch.setitem(vars(config), 'caa_final_mode_lasam_mode_lu', None)
+
+    # LGW is only written once LHR has failed, so its output is still waiting in the writer when the run stops
+    map_partition, write = mapping_runner.map_partition, batch_run.BackgroundWriter._write
+    failed = threading.Event()
+
+    def fail_at_lhr(mapper, partition_df, mode_condition_lu, airport=None, run_kwargs=None):
+        if airport == 'LHR':
+            failed.set()
+            raise RuntimeError('mapping failed at LHR')
+        return map_partition(mapper, partition_df, mode_condition_lu, airport, run_kwargs)
+
+    def write_after_failure(writer, df, path, partition):
+        failed.wait(timeout=10)
+        time.sleep(0.2)
+        write(writer, df, path, partition)
+
+    monkeypatch.setattr(mapping_runner, 'map_partition', fail_at_lhr)
+    monkeypatch.setattr(batch_run.BackgroundWriter, '_write', write_after_failure)
+
+    output_dir = os.path.join(tmp_path, 'outputs')
+    with pytest.raises(RuntimeError, match='mapping failed at LHR'):
+        batch_run.run({'input': extract_path, 'mapper': 'V6', 'check_vocabulary': False, 'prefetch': 2, 'output_dir': output_dir})
+
+    assert os.listdir(output_dir) == ['V6_LGW_2024.parquet']
@@ -0,0 +1,26 @@
+import pytest
+
+from src import regression_utils
+from src.old_mappers.ModeConditionMapperV6 import ModeConditionMapper as ModeConditionMapperV6
+
+
+def test_check_golden_finds_a_changed_v6_step(tmp_path, monkeypatch, synthetic_lookup):
+    caa_df = regression_utils.make_synthetic_survey(2000)
+
+    regression_utils.write_golden('V6_synthetic', ModeConditionMapperV6, caa_df, str(tmp_path), mode_condition_lu=synthetic_lookup)
+    assert regression_utils.check_golden('V6_synthetic', ModeConditionMapperV6, caa_df, str(tmp_path), mode_condition_lu=synthetic_lookup).empty
+
+    # step_7 no longer moves taxi journeys onto the public transport leg before them
+    monkeypatch.setattr(ModeConditionMapperV6, 'step_7', lambda self, mode: mode)
+    diff_df = regression_utils.check_golden('V6_synthetic', ModeConditionMapperV6, caa_df, str(tmp_path), mode_condition_lu=synthetic_lookup)
+
+    assert len(diff_df) > 0
+    assert 'Mode_Allocated_golden' in diff_df.columns
+    assert (diff_df['Mode_Allocated_golden'] != diff_df['Mode_Allocated_new']).all()
+
+
+def test_arrow_backend_is_only_for_v4_conditions(tmp_path, synthetic_lookup):
+    caa_df = regression_utils.make_synthetic_survey(100)
+
+    with pytest.raises(ValueError, match='V4 conditions'):
+        regression_utils.write_golden('V6_synthetic', ModeConditionMapperV6, caa_df, str(tmp_path), backend='arrow', mode_condition_lu=synthetic_lookup)
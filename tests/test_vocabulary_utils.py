@@ -0,0 +1,21 @@
+import pandas as pd
+
+from src import vocabulary_utils
+from src.old_mappers.ModeConditionMapperV6 import ModeConditionMapper as ModeConditionMapperV6
+
+
+def test_rule_modes_resolve_local_lists():
+    rule_modes = vocabulary_utils.get_rule_modes(ModeConditionMapperV6)
+
+    # step_7 passes lists bound to local names to v.isin, step_11 names its list inside a v.match lambda
+    assert {'National Rail', 'London Underground', 'Bus/coach company unknown'} <= rule_modes['step_7']
+    assert {'National railways', 'Rail Unspecified'} <= rule_modes['step_11']
+
+
+def test_vocabulary_report_finds_local_list_modes():
+    mode_allocation_lu = pd.DataFrame({'Mode_Allocated': ['Taxi', 'Uber', 'Minicab']})
+    report_df = vocabulary_utils.get_vocabulary_report(mapper=ModeConditionMapperV6, mode_allocation_lu=mode_allocation_lu)
+
+    reported = set(report_df.loc[report_df['Source'] == 'ModeConditionMapperV6.step_7', 'Mode'])
+    assert {'National Rail', 'London Underground', 'Bus/coach company unknown'} <= reported
+    assert 'Taxi' not in reported